@@ -1,14 +1,39 @@
-from flask import Flask, request, abort
+from flask import Flask, Response, request, abort, g
 import os
 import json
 import requests
 import random
+import asyncio
+import atexit
 import base64
+import fcntl
+import contextvars
+import functools
 import hashlib
+import heapq
 import hmac
+import logging
+import logging.handlers
+import math
+import queue
 import re
+import sys
+import threading
+import time
+import uuid
+from array import array
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait as wait_futures
+from contextlib import contextmanager
+from itertools import combinations
 from datetime import datetime, timedelta, timezone, date
 import psycopg2
+from psycopg2.extras import execute_values
+
+try:
+    import aiohttp
+except ImportError:  # 非同步模式未安裝 aiohttp 時推播改用執行緒池
+    aiohttp = None
 
 app = Flask(__name__)
 
@@ -18,11 +43,53 @@ CHANNEL_SECRET = os.getenv("CHANNEL_SECRET", "").strip()
 ADMIN_SECRET = os.getenv("ADMIN_SECRET", "1234").strip()
 CRON_SECRET = os.getenv("CRON_SECRET", "push8899").strip()
 DATABASE_URL = os.getenv("DATABASE_URL", "").strip()
+# 本機 Postgres（壓測 / 模擬）沒有 SSL 時設為 disable
+DATABASE_SSLMODE = os.getenv("DATABASE_SSLMODE", "require").strip()
+# LINE Messaging API 位址（壓測時指向本機替身）
+LINE_API_BASE = os.getenv("LINE_API_BASE", "https://api.line.me").strip().rstrip("/")
+# push 遇到 429 / 5xx 的重試次數與退避基準秒數
+PUSH_MAX_RETRIES = int(os.getenv("PUSH_MAX_RETRIES", "2"))
+PUSH_RETRY_BASE_SECONDS = float(os.getenv("PUSH_RETRY_BASE_SECONDS", "0.5"))
+# 一次 cron 推播的總秒數預算（需小於 gunicorn --timeout）與連續 429 停送門檻
+PUSH_RUN_SECONDS = float(os.getenv("PUSH_RUN_SECONDS", "90"))
+PUSH_THROTTLE_STOP = int(os.getenv("PUSH_THROTTLE_STOP", "20"))
 
 TZ_TW = timezone(timedelta(hours=8))
 
 # ========= 資料來源 =========
-SOURCE_539_URL = "https://www.pilio.idv.tw/lto539/list539BIG.asp"
+SOURCE_539_URL = os.getenv("SOURCE_539_URL", "https://www.pilio.idv.tw/lto539/list539BIG.asp").strip()
+
+# Bingo 開獎來源：官方格式結果頁網址，或本機檔案（測試 / 離線替身）
+# 兩者皆未設定時使用備援模式
+SOURCE_BINGO_URL = os.getenv("SOURCE_BINGO_URL", "").strip()
+BINGO_SOURCE_FILE = os.getenv("BINGO_SOURCE_FILE", "").strip()
+BINGO_RING_SIZE = int(os.getenv("BINGO_RING_SIZE", "200"))
+
+
+
+def _parse_bingo_windows(spec):
+    """回傳 (視窗 tuple, 被忽略的值)；非整數或小於 1 的值忽略。"""
+    windows, ignored = {1, 5, 10}, []
+    for x in spec.split(","):
+        x = x.strip()
+        if not x:
+            continue
+        try:
+            n = int(x)
+        except ValueError:
+            n = 0
+        if n >= 1:
+            windows.add(n)
+        else:
+            ignored.append(x)
+    return tuple(sorted(windows)), ignored
+
+
+# Bingo 統計視窗（期數，逗號分隔；1/5/10 期分析固定包含）
+BINGO_WINDOWS, _BINGO_WINDOWS_IGNORED = _parse_bingo_windows(os.getenv("BINGO_WINDOWS", "1,5,10"))
+
+# Bingo 分析結果是否另存一份到 Postgres（多個 worker 共用）
+BINGO_BUNDLE_PG_CACHE = os.getenv("BINGO_BUNDLE_PG_CACHE", "").strip() in ("1", "true", "yes")
 
 # =========================
 # 每日陪跑語錄
@@ -61,12 +128,566 @@ QUOTES = [
 ]
 
 
-def get_daily_quote():
-    today = datetime.now(TZ_TW).date()
+def get_daily_quote(day=None):
+    today = day or datetime.now(TZ_TW).date()
     idx = today.toordinal() % len(QUOTES)
     return QUOTES[idx]
 
 
+# =========================
+# Logging
+# =========================
+# JSON 一行一筆，經由佇列交給背景執行緒輸出；request 執行緒只做 put_nowait
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").strip().upper()
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", "0.05"))
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+LOG_USER_SALT = os.getenv("LOG_USER_SALT", CHANNEL_SECRET or "linebot").encode("utf-8")
+
+
+class JsonLogFormatter(logging.Formatter):
+    def format(self, record):
+        data = {
+            "ts": datetime.fromtimestamp(record.created, TZ_TW).isoformat(timespec="milliseconds"),
+            "level": record.levelname.lower(),
+            "event": record.getMessage(),
+        }
+        data.update(getattr(record, "fields", {}))
+        if record.exc_info:
+            data["exc"] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """佇列滿了就丟棄並計數，絕不阻塞呼叫端；格式化留給背景執行緒。"""
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            METRICS.inc("log_dropped_total")
+
+
+LOG = logging.getLogger("linebot")
+LOG.setLevel(LOG_LEVEL)
+LOG.propagate = False
+_LOG_QUEUE = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+_LOG_LISTENER = None
+
+
+def _start_log_listener():
+    global _LOG_LISTENER
+    stream = logging.StreamHandler(sys.stdout)
+    stream.setFormatter(JsonLogFormatter())
+    _LOG_LISTENER = logging.handlers.QueueListener(_LOG_QUEUE, stream)
+    _LOG_LISTENER.start()
+
+
+def _stop_log_listener():
+    # 結束前把佇列內剩下的 log 寫完
+    if _LOG_LISTENER is not None:
+        _LOG_LISTENER.stop()
+
+
+LOG.addHandler(NonBlockingQueueHandler(_LOG_QUEUE))
+_start_log_listener()
+atexit.register(_stop_log_listener)
+# gunicorn --preload 之類先 fork 的情況，子 process 需要自己的背景執行緒
+os.register_at_fork(after_in_child=_start_log_listener)
+
+
+def log_event(level, event, **fields):
+    if LOG.isEnabledFor(level):
+        trace_id = current_trace_id()
+        if trace_id:
+            fields["trace_id"] = trace_id
+        LOG.log(level, event, extra={"fields": fields})
+
+
+def log_sampled(event, rate=None, **fields):
+    """高頻事件（每次 webhook / LINE 呼叫）只抽樣記錄。"""
+    rate = LOG_SAMPLE_RATE if rate is None else rate
+    if rate > 0 and random.random() < rate:
+        log_event(logging.INFO, event, sample_rate=rate, **fields)
+
+
+def user_ref(user_id):
+    """log 不寫原始 userId，只留可對照的雜湊。"""
+    if not user_id:
+        return ""
+    return "u_" + hmac.new(LOG_USER_SALT, user_id.encode("utf-8"), hashlib.sha256).hexdigest()[:12]
+
+
+# =========================
+# Metrics
+# =========================
+# gunicorn 多個 worker 時設定共用目錄，各 process 定期寫入自己的快照，/metrics 彙總
+METRICS_DIR = os.getenv("METRICS_DIR", "").strip()
+# /metrics 需帶 ?secret= 或 Authorization: Bearer；未設定時沿用 CRON_SECRET
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "").strip() or CRON_SECRET
+METRICS_FLUSH_SECONDS = 5.0
+# 已結束 worker 的 counter / histogram 累計在這個檔案，彙總時一併加總
+METRICS_RETIRED_FILE = "metrics-retired.json"
+METRICS_LOCK_FILE = ".metrics.lock"
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+METRIC_HELP = {
+    "webhook_event_seconds": "Webhook 單一事件處理時間（依指令）",
+    "cron_job_seconds": "Cron 路由執行時間",
+    "line_api_seconds": "LINE API 呼叫時間（依端點與狀態）",
+    "line_push_retries_total": "LINE push 重試次數（依原因）",
+    "webhook_shed_total": "超過流量限制的事件數（依指令類別與處理方式）",
+    "admin_auth_failures_total": "管理密碼錯誤次數",
+    "delivery_log_rows_total": "寫入 message_deliveries 的筆數",
+    "push_outbox_enqueued_total": "排入 push_outbox 的推播數（依 job）",
+    "push_outbox_sent_total": "sender 送達並移出 outbox 的推播數",
+    "push_outbox_failed_total": "超過重試次數、標成 failed 的推播數",
+    "members_deactivated_total": "sweeper 標成失效的會員數",
+    "push_run_stopped_total": "cron 推播因時間預算或持續 429 提前停止的次數",
+    "delivery_log_dropped_total": "未寫入的送達紀錄筆數（依原因）",
+    "db_query_seconds": "資料庫 helper 執行時間",
+    "pick_build_seconds": "模型建立時間",
+    "cache_requests_total": "快取查詢次數（hit / miss）",
+}
+
+
+class MetricsRegistry:
+    """
+    行程內的 counter / histogram，輸出 Prometheus 文字格式。
+    key 為 (名稱, 排序後的 label tuple)。
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counters = {}
+        self.histograms = {}
+        self.lock = threading.Lock()
+        self.flushed_at = 0.0
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted((labels or {}).items()))
+
+    def inc(self, name, labels=None, value=1):
+        key = self._key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, labels=None):
+        key = self._key(name, labels)
+        with self.lock:
+            h = self.histograms.get(key)
+            if h is None:
+                h = self.histograms[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, b in enumerate(self.buckets):
+                if value <= b:
+                    h[i] += 1
+            h[-2] += value
+            h[-1] += 1
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "counters": [[n, list(map(list, l)), v] for (n, l), v in self.counters.items()],
+                "histograms": [[n, list(map(list, l)), list(h)] for (n, l), h in self.histograms.items()],
+            }
+
+    def flush(self, force=False):
+        """把本 process 的快照寫到 METRICS_DIR（最多每 METRICS_FLUSH_SECONDS 一次）。"""
+        if not METRICS_DIR:
+            return
+        now = time.monotonic()
+        if not force and now - self.flushed_at < METRICS_FLUSH_SECONDS:
+            return
+        self.flushed_at = now
+        try:
+            os.makedirs(METRICS_DIR, exist_ok=True)
+            path = os.path.join(METRICS_DIR, f"metrics-{os.getpid()}.json")
+            with open(path + ".tmp", "w", encoding="utf-8") as f:
+                json.dump(self.snapshot(), f)
+            os.replace(path + ".tmp", path)
+        except Exception as e:
+            log_event(logging.ERROR, "metrics_flush_error", error=repr(e))
+
+    @staticmethod
+    def _pid_alive(pid):
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            return True
+        return True
+
+    @staticmethod
+    def _merge(snapshots):
+        counters = {}
+        histograms = {}
+        for snap in snapshots:
+            for name, labels, value in snap["counters"]:
+                key = (name, tuple(map(tuple, labels)))
+                counters[key] = counters.get(key, 0) + value
+            for name, labels, h in snap["histograms"]:
+                key = (name, tuple(map(tuple, labels)))
+                if key in histograms:
+                    histograms[key] = [a + b for a, b in zip(histograms[key], h)]
+                else:
+                    histograms[key] = list(h)
+        return counters, histograms
+
+    @staticmethod
+    def _read_snapshot(path):
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def _retire(self, files):
+        """
+        已結束 worker 的快照併入 metrics-retired.json 後刪除，
+        counter 才不會因 gunicorn 重啟 worker 而倒退（Prometheus 會當成 reset）。
+        需持有 METRICS_DIR 的獨占鎖。
+        """
+        retired_path = os.path.join(METRICS_DIR, METRICS_RETIRED_FILE)
+        snapshots = []
+        if os.path.exists(retired_path):
+            snapshots.append(self._read_snapshot(retired_path))
+        for fn in files:
+            try:
+                snapshots.append(self._read_snapshot(os.path.join(METRICS_DIR, fn)))
+            except FileNotFoundError:
+                continue
+            except ValueError:
+                # 寫到一半就結束的 worker，檔案不完整也無從補回
+                log_event(logging.WARNING, "metrics_retire_unreadable", file=fn)
+        counters, histograms = self._merge(snapshots)
+        merged = {
+            "counters": [[n, list(map(list, l)), v] for (n, l), v in counters.items()],
+            "histograms": [[n, list(map(list, l)), h] for (n, l), h in histograms.items()],
+        }
+        with open(retired_path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(merged, f)
+        os.replace(retired_path + ".tmp", retired_path)
+        for fn in files:
+            try:
+                os.remove(os.path.join(METRICS_DIR, fn))
+            except FileNotFoundError:
+                pass
+
+    def _collect(self):
+        snapshots = [self.snapshot()]
+        if METRICS_DIR and os.path.isdir(METRICS_DIR):
+            own = f"metrics-{os.getpid()}.json"
+            # 併入 retired 與讀取快照互斥，避免同一份數字在一次 scrape 中被算兩次
+            with open(os.path.join(METRICS_DIR, METRICS_LOCK_FILE), "a") as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                dead = []
+                for fn in os.listdir(METRICS_DIR):
+                    pid = fn[len("metrics-"):-len(".json")]
+                    if fn.startswith("metrics-") and fn.endswith(".json") and pid.isdigit():
+                        if not self._pid_alive(int(pid)):
+                            dead.append(fn)
+                if dead:
+                    try:
+                        self._retire(dead)
+                    except Exception as e:
+                        log_event(logging.ERROR, "metrics_retire_error", error=repr(e))
+                names = [
+                    fn for fn in os.listdir(METRICS_DIR)
+                    if fn.startswith("metrics-") and fn.endswith(".json") and fn != own
+                ]
+                for fn in names:
+                    try:
+                        snapshots.append(self._read_snapshot(os.path.join(METRICS_DIR, fn)))
+                    except Exception:
+                        continue
+        return self._merge(snapshots)
+
+    def render(self):
+        counters, histograms = self._collect()
+
+        def fmt_labels(labels, extra=None):
+            items = list(labels) + (extra or [])
+            if not items:
+                return ""
+            return "{" + ",".join([f'{k}="{str(v)}"' for k, v in items]) + "}"
+
+        lines = []
+        seen = set()
+        for (name, labels), value in sorted(counters.items()):
+            if name not in seen:
+                seen.add(name)
+                lines.append(f"# HELP {name} {METRIC_HELP.get(name, name)}")
+                lines.append(f"# TYPE {name} counter")
+            lines.append(f"{name}{fmt_labels(labels)} {value}")
+
+        for (name, labels), h in sorted(histograms.items()):
+            if name not in seen:
+                seen.add(name)
+                lines.append(f"# HELP {name} {METRIC_HELP.get(name, name)}")
+                lines.append(f"# TYPE {name} histogram")
+            for b, count in zip(self.buckets, h):
+                lines.append(f"{name}_bucket{fmt_labels(labels, [('le', b)])} {count}")
+            lines.append(f"{name}_bucket{fmt_labels(labels, [('le', '+Inf')])} {h[-1]}")
+            lines.append(f"{name}_sum{fmt_labels(labels)} {h[-2]:.6f}")
+            lines.append(f"{name}_count{fmt_labels(labels)} {h[-1]}")
+        return "\n".join(lines) + "\n"
+
+
+METRICS = MetricsRegistry()
+
+
+@contextmanager
+def timed(name, **labels):
+    """量測區塊時間；在 trace 內時同時記成一個 span（名稱去掉 _seconds）。"""
+    started = time.perf_counter()
+    try:
+        with span(name[:-8] if name.endswith("_seconds") else name, **labels):
+            yield labels
+    finally:
+        METRICS.observe(name, time.perf_counter() - started, labels)
+
+
+def observe_db(fn):
+    """資料庫 helper 依函式名稱記錄執行時間。"""
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        with timed("db_query_seconds", helper=fn.__name__):
+            return fn(*args, **kwargs)
+    return wrapper
+
+
+def count_cache(cache, hit):
+    METRICS.inc("cache_requests_total", {"cache": cache, "result": "hit" if hit else "miss"})
+
+
+# =========================
+# Tracing
+# =========================
+# 每個 HTTP request 一條 trace；timed() 區塊（DB helper、模型建立、webhook 事件、cron）、
+# @traced 的引擎 / 抓取函式與 LINE API 呼叫都記成其中的 span。
+# 不在 request 內（CLI 回測、調校）時 span 不做任何事。
+TRACE_ENABLED = os.getenv("TRACE_ENABLED", "1").strip() != "0"
+# 檔案路徑（每條 trace 一行 JSON）或 http(s):// 的 OTLP/HTTP collector（JSON 編碼）
+TRACE_EXPORT = os.getenv("TRACE_EXPORT", "").strip()
+TRACE_KEEP = int(os.getenv("TRACE_KEEP", "200"))
+TRACE_MAX_SPANS = int(os.getenv("TRACE_MAX_SPANS", "500"))
+TRACE_EXPORT_QUEUE_SIZE = 1000
+
+_CURRENT_SPAN = contextvars.ContextVar("current_span", default=None)
+_RECENT_TRACES = deque(maxlen=TRACE_KEEP)
+_TRACE_EXPORTER = {"pid": None, "queue": None}
+_TRACE_EXPORTER_LOCK = threading.Lock()
+
+
+class Trace:
+    """一條 trace：spans[0] 為 root，其餘依開始順序；超過 TRACE_MAX_SPANS 只計數。"""
+
+    __slots__ = ("trace_id", "started_at", "started", "spans", "dropped")
+
+    def __init__(self):
+        self.trace_id = os.urandom(16).hex()
+        self.started_at = time.time()
+        self.started = time.perf_counter()
+        self.spans = []
+        self.dropped = 0
+
+    def add(self, item):
+        if len(self.spans) >= TRACE_MAX_SPANS:
+            self.dropped += 1
+            return False
+        self.spans.append(item)
+        return True
+
+    @property
+    def name(self):
+        return self.spans[0]["name"] if self.spans else ""
+
+    @property
+    def duration_ms(self):
+        return (self.spans[0]["duration_ms"] or 0.0) if self.spans else 0.0
+
+    def as_dict(self):
+        return {
+            "trace_id": self.trace_id,
+            "name": self.name,
+            "started_at": datetime.fromtimestamp(self.started_at, TZ_TW).isoformat(timespec="milliseconds"),
+            "duration_ms": self.duration_ms,
+            "dropped_spans": self.dropped,
+            "spans": self.spans,
+        }
+
+
+def _open_span(name, attrs, root=False):
+    """回傳 (trace, span, contextvar token)；不在 trace 內且非 root 時回傳 None。"""
+    if not TRACE_ENABLED:
+        return None
+    parent = _CURRENT_SPAN.get()
+    if parent is None and not root:
+        return None
+
+    trace = Trace() if parent is None else parent[0]
+    now = time.perf_counter()
+    item = {
+        "span_id": os.urandom(8).hex(),
+        "parent_id": parent[1]["span_id"] if parent is not None else None,
+        "name": name,
+        "attrs": attrs,
+        "start_ms": round((now - trace.started) * 1000, 3),
+        "duration_ms": None,
+    }
+    if not trace.add(item):
+        return None
+    return trace, item, _CURRENT_SPAN.set((trace, item)), now
+
+
+def _close_span(state, error=None):
+    if state is None:
+        return
+    trace, item, token, started = state
+    item["duration_ms"] = round((time.perf_counter() - started) * 1000, 3)
+    if error is not None:
+        item["error"] = repr(error)
+    try:
+        _CURRENT_SPAN.reset(token)
+    except ValueError:
+        # 在不同 context 結束（例如 teardown 跑在複製的 context）時直接清掉
+        _CURRENT_SPAN.set(None)
+    if item["parent_id"] is None:
+        _finish_trace(trace)
+
+
+@contextmanager
+def span(name, **attrs):
+    state = _open_span(name, attrs)
+    try:
+        yield attrs
+    except BaseException as e:
+        _close_span(state, e)
+        state = None
+        raise
+    finally:
+        _close_span(state)
+
+
+def record_span(name, started, **attrs):
+    """事後補記一個已結束的葉節點 span（started 為 perf_counter 值）。"""
+    current = _CURRENT_SPAN.get()
+    if current is None:
+        return
+    trace = current[0]
+    trace.add({
+        "span_id": os.urandom(8).hex(),
+        "parent_id": current[1]["span_id"],
+        "name": name,
+        "attrs": attrs,
+        "start_ms": round((started - trace.started) * 1000, 3),
+        "duration_ms": round((time.perf_counter() - started) * 1000, 3),
+    })
+
+
+def traced(fn):
+    """函式呼叫記成以函式名稱命名的 span。"""
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        if _CURRENT_SPAN.get() is None:
+            return fn(*args, **kwargs)
+        with span(fn.__name__):
+            return fn(*args, **kwargs)
+    return wrapper
+
+
+def current_trace_id():
+    current = _CURRENT_SPAN.get()
+    return current[0].trace_id if current is not None else None
+
+
+def _finish_trace(trace):
+    _RECENT_TRACES.append(trace)
+    if not TRACE_EXPORT:
+        return
+    try:
+        _trace_export_queue().put_nowait(trace)
+    except queue.Full:
+        METRICS.inc("trace_dropped_total")
+
+
+def _trace_export_queue():
+    """每個 process 第一次匯出時才建立佇列與背景執行緒（fork 後重新建立）。"""
+    pid = os.getpid()
+    if _TRACE_EXPORTER["pid"] != pid:
+        with _TRACE_EXPORTER_LOCK:
+            if _TRACE_EXPORTER["pid"] != pid:
+                q = queue.Queue(maxsize=TRACE_EXPORT_QUEUE_SIZE)
+                threading.Thread(target=_trace_export_loop, args=(q,), daemon=True).start()
+                _TRACE_EXPORTER.update(pid=pid, queue=q)
+    return _TRACE_EXPORTER["queue"]
+
+
+def _trace_export_loop(q):
+    while True:
+        batch = [q.get()]
+        while len(batch) < 100:
+            try:
+                batch.append(q.get_nowait())
+            except queue.Empty:
+                break
+        try:
+            export_traces(batch, TRACE_EXPORT)
+        except Exception as e:
+            log_event(logging.ERROR, "trace_export_error", error=repr(e))
+
+
+def _otlp_payload(traces):
+    spans = []
+    for trace in traces:
+        base = int(trace.started_at * 1e9)
+        for item in trace.spans:
+            start = base + int(item["start_ms"] * 1e6)
+            end = start + int((item["duration_ms"] or 0.0) * 1e6)
+            spans.append({
+                "traceId": trace.trace_id,
+                "spanId": item["span_id"],
+                "parentSpanId": item["parent_id"] or "",
+                "name": item["name"],
+                "kind": 2 if item["parent_id"] is None else 1,
+                "startTimeUnixNano": str(start),
+                "endTimeUnixNano": str(end),
+                "attributes": [
+                    {"key": k, "value": {"stringValue": str(v)}} for k, v in item["attrs"].items()
+                ],
+                "status": {"code": 2, "message": item["error"]} if "error" in item else {},
+            })
+    return {
+        "resourceSpans": [{
+            "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": "linebot"}}]},
+            "scopeSpans": [{"scope": {"name": "app"}, "spans": spans}],
+        }]
+    }
+
+
+def export_traces(traces, target):
+    if target.startswith(("http://", "https://")):
+        r = requests.post(target, json=_otlp_payload(traces), timeout=5)
+        if r.status_code >= 400:
+            log_event(logging.WARNING, "trace_export_failed", status=r.status_code, body=r.text[:200])
+        return
+    with open(target, "a", encoding="utf-8") as f:
+        for trace in traces:
+            f.write(json.dumps(trace.as_dict(), ensure_ascii=False, default=str) + "\n")
+
+
+def slowest_traces(limit=20, min_ms=0.0):
+    traces = [t for t in list(_RECENT_TRACES) if t.duration_ms >= min_ms]
+    traces.sort(key=lambda t: t.duration_ms, reverse=True)
+    return [t.as_dict() for t in traces[:limit]]
+
+
+# 環境變數解析時 log 尚未就緒，這裡補記被忽略的設定
+if _BINGO_WINDOWS_IGNORED:
+    log_event(logging.WARNING, "bingo_windows_ignored", values=_BINGO_WINDOWS_IGNORED, windows=list(BINGO_WINDOWS))
+
+
 # =========================
 # LINE Signature 驗證
 # =========================
@@ -84,10 +705,20 @@ def verify_line_signature(raw_body: bytes, signature: str) -> bool:
 def get_conn():
     if not DATABASE_URL:
         raise RuntimeError("DATABASE_URL 未設定")
-    return psycopg2.connect(DATABASE_URL, sslmode="require")
+    with span("db_connect"):
+        return psycopg2.connect(DATABASE_URL, sslmode=DATABASE_SSLMODE)
+
 
+_DB_READY = False
 
+
+@observe_db
 def init_db():
+    """建表 / 補欄位；每個 process 只需要跑一次。"""
+    global _DB_READY
+    if _DB_READY:
+        return
+
     conn = get_conn()
     cur = conn.cursor()
 
@@ -114,6 +745,12 @@ def init_db():
         );
     """)
 
+    # 待確認清單依建立時間倒序分頁
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS pending_accounts_created
+        ON pending_accounts (created_at DESC, game_account DESC);
+    """)
+
     cur.execute("""
         CREATE TABLE IF NOT EXISTS prediction_subscribers (
             user_id TEXT PRIMARY KEY,
@@ -148,6 +785,23 @@ def init_db():
         );
     """)
 
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS bingo_draws (
+            period BIGINT PRIMARY KEY,
+            draw_time TIMESTAMPTZ,
+            numbers TEXT NOT NULL,
+            created_at TIMESTAMPTZ NOT NULL
+        );
+    """)
+
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS bingo_bundle_cache (
+            cache_key TEXT PRIMARY KEY,
+            bundle TEXT NOT NULL,
+            created_at TIMESTAMPTZ NOT NULL
+        );
+    """)
+
     cur.execute("""
         CREATE TABLE IF NOT EXISTS push_state (
             push_key TEXT PRIMARY KEY,
@@ -156,6 +810,140 @@ def init_db():
         );
     """)
 
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS message_deliveries (
+            sent_at TIMESTAMPTZ NOT NULL,
+            kind TEXT NOT NULL,
+            job TEXT,
+            user_id TEXT,
+            status INTEGER,
+            ok BOOLEAN NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 1,
+            error TEXT
+        ) PARTITION BY RANGE (sent_at);
+    """)
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS message_deliveries_failed
+        ON message_deliveries (sent_at)
+        WHERE NOT ok;
+    """)
+
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS push_outbox_messages (
+            message_id BIGSERIAL PRIMARY KEY,
+            dedupe_key TEXT NOT NULL UNIQUE,
+            job TEXT NOT NULL,
+            text TEXT NOT NULL,
+            created_at TIMESTAMPTZ NOT NULL
+        );
+    """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS push_outbox (
+            id BIGSERIAL PRIMARY KEY,
+            message_id BIGINT NOT NULL REFERENCES push_outbox_messages (message_id) ON DELETE CASCADE,
+            user_id TEXT NOT NULL,
+            retry_key TEXT NOT NULL,
+            status TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            available_at TIMESTAMPTZ NOT NULL,
+            claimed_at TIMESTAMPTZ,
+            created_at TIMESTAMPTZ NOT NULL,
+            UNIQUE (message_id, user_id)
+        );
+    """)
+    # sender 只掃還沒送完的列
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS push_outbox_ready
+        ON push_outbox (id)
+        WHERE status IN ('pending', 'sending');
+    """)
+
+    # 推播進度：已送達的使用者，cron 中斷後重跑只送剩下的人
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS push_progress (
+            push_key TEXT NOT NULL,
+            user_id TEXT NOT NULL,
+            created_at TIMESTAMPTZ NOT NULL,
+            PRIMARY KEY (push_key, user_id)
+        );
+    """)
+
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS rate_limit_hits (
+            user_id TEXT NOT NULL,
+            command_class TEXT NOT NULL,
+            hit_at TIMESTAMPTZ NOT NULL
+        );
+    """)
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS rate_limit_hits_lookup
+        ON rate_limit_hits (user_id, command_class, hit_at);
+    """)
+    cur.execute("""
+        ALTER TABLE rate_limit_hits
+        ADD COLUMN IF NOT EXISTS rejected BOOLEAN NOT NULL DEFAULT FALSE;
+    """)
+
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS members_expiring_on (
+            expire_date DATE NOT NULL,
+            user_id TEXT NOT NULL,
+            expires_at TIMESTAMPTZ NOT NULL,
+            PRIMARY KEY (expire_date, user_id)
+        );
+    """)
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS members_expiring_on_user
+        ON members_expiring_on (user_id);
+    """)
+
+    # 到期 sweeper 維護的有效旗標；有效會員查詢走 partial index
+    cur.execute("""
+        ALTER TABLE members
+        ADD COLUMN IF NOT EXISTS is_active BOOLEAN NOT NULL DEFAULT TRUE;
+    """)
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS members_active_expires
+        ON members (expires_at, user_id)
+        WHERE is_active;
+    """)
+
+    # 推播對象（會員 × 訂閱設定）預先展開，cron 只讀這張表
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS push_audience (
+            audience TEXT NOT NULL,
+            user_id TEXT NOT NULL,
+            expires_at TIMESTAMPTZ NOT NULL,
+            PRIMARY KEY (audience, user_id)
+        );
+    """)
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS push_audience_lookup
+        ON push_audience (audience, expires_at, user_id);
+    """)
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS push_audience_user
+        ON push_audience (user_id);
+    """)
+
+    # 預先產生的訊息與新鮮度
+    cur.execute("""
+        ALTER TABLE daily_pick_cache
+        ADD COLUMN IF NOT EXISTS rendered TEXT;
+    """)
+    cur.execute("""
+        ALTER TABLE daily_pick_cache
+        ADD COLUMN IF NOT EXISTS source_draw_date DATE;
+    """)
+    cur.execute("""
+        ALTER TABLE daily_pick_cache
+        ADD COLUMN IF NOT EXISTS warmed_at TIMESTAMPTZ;
+    """)
+    cur.execute("""
+        ALTER TABLE daily_pick_cache
+        ADD COLUMN IF NOT EXISTS market_state TEXT;
+    """)
+
     # 舊版相容
     cur.execute("""
         ALTER TABLE push_state
@@ -177,24 +965,50 @@ def init_db():
             ALTER COLUMN last_bucket DROP NOT NULL;
         """)
     except Exception as e:
-        print("ALTER last_bucket DROP NOT NULL skipped:", repr(e))
+        log_event(logging.WARNING, "alter_last_bucket_skipped", error=repr(e))
         conn.rollback()
         cur = conn.cursor()
 
+    # push_audience 上線前的既有會員只需回填一次
+    cur.execute("SELECT 1 FROM push_state WHERE push_key = 'push_audience_backfill';")
+    if cur.fetchone() is None:
+        _rebuild_push_audience(cur)
+        cur.execute("""
+            INSERT INTO push_state (push_key, last_value, updated_at)
+            VALUES ('push_audience_backfill', 'done', NOW())
+            ON CONFLICT (push_key) DO NOTHING;
+        """)
+
     conn.commit()
     cur.close()
     conn.close()
+    _DB_READY = True
 
 
 # =========================
 # LINE Reply / Push
 # =========================
+def _observe_line(endpoint, started, status_code):
+    if status_code is None:
+        status = "error"
+    elif status_code == 429:
+        status = "429"
+    else:
+        status = f"{status_code // 100}xx"
+    METRICS.observe("line_api_seconds", time.perf_counter() - started, {"endpoint": endpoint, "status": status})
+    record_span("line_api", started, endpoint=endpoint, status=status)
+    # reply 不重試，每次呼叫就是最終結果；push 的結果在重試結束後另外記錄
+    if endpoint == "reply":
+        ok = status_code is not None and status_code < 400
+        record_delivery("reply", _DELIVERY_USER.get(), status_code, ok, job="webhook")
+
+
 def reply_message(reply_token: str, text: str):
     if not CHANNEL_ACCESS_TOKEN:
-        print("CHANNEL_ACCESS_TOKEN empty")
+        log_event(logging.WARNING, "channel_access_token_empty")
         return
 
-    url = "https://api.line.me/v2/bot/message/reply"
+    url = f"{LINE_API_BASE}/v2/bot/message/reply"
     headers = {
         "Content-Type": "application/json",
         "Authorization": f"Bearer {CHANNEL_ACCESS_TOKEN}",
@@ -204,19 +1018,22 @@ def reply_message(reply_token: str, text: str):
         "messages": [{"type": "text", "text": text}]
     }
 
+    started = time.perf_counter()
     try:
         r = requests.post(url, headers=headers, data=json.dumps(payload), timeout=10)
-        print("LINE REPLY STATUS:", r.status_code)
+        _observe_line("reply", started, r.status_code)
+        log_sampled("line_reply", status=r.status_code)
         if r.status_code >= 400:
-            print("LINE REPLY BODY:", r.text[:500])
+            log_event(logging.WARNING, "line_reply_failed", status=r.status_code, body=r.text[:500])
     except Exception as e:
-        print("LINE REPLY EXCEPTION:", repr(e))
+        _observe_line("reply", started, None)
+        log_event(logging.ERROR, "line_reply_exception", error=repr(e))
 def reply_bingo_menu(reply_token: str):
     if not CHANNEL_ACCESS_TOKEN:
-        print("CHANNEL_ACCESS_TOKEN empty")
+        log_event(logging.WARNING, "channel_access_token_empty")
         return
 
-    url = "https://api.line.me/v2/bot/message/reply"
+    url = f"{LINE_API_BASE}/v2/bot/message/reply"
     headers = {
         "Content-Type": "application/json",
         "Authorization": f"Bearer {CHANNEL_ACCESS_TOKEN}",
@@ -242,72 +1059,779 @@ def reply_bingo_menu(reply_token: str):
         ]
     }
 
+    started = time.perf_counter()
     try:
         r = requests.post(url, headers=headers, data=json.dumps(payload), timeout=10)
-        print("LINE BUTTON REPLY STATUS:", r.status_code)
+        _observe_line("reply", started, r.status_code)
+        log_sampled("line_button_reply", status=r.status_code)
         if r.status_code >= 400:
-            print("LINE BUTTON REPLY BODY:", r.text[:500])
+            log_event(logging.WARNING, "line_button_reply_failed", status=r.status_code, body=r.text[:500])
     except Exception as e:
-        print("LINE BUTTON REPLY EXCEPTION:", repr(e))
+        _observe_line("reply", started, None)
+        log_event(logging.ERROR, "line_button_reply_exception", error=repr(e))
 
 
-def push_message(user_id: str, text: str) -> bool:
-    if not CHANNEL_ACCESS_TOKEN:
-        print("CHANNEL_ACCESS_TOKEN empty")
-        return False
+class PushRun:
+    """
+    一次 cron fan-out 的總時間預算與持續 429 熔斷（多個執行緒 / coroutine 共用）。
+    預算用完或連續 PUSH_THROTTLE_STOP 則最終仍是 429 時停止送出，
+    避免重試等待把 cron 拖過 gunicorn timeout。
+    """
+
+    def __init__(self, seconds=None, throttle_stop=None):
+        self.deadline = time.monotonic() + (PUSH_RUN_SECONDS if seconds is None else seconds)
+        self.throttle_stop = PUSH_THROTTLE_STOP if throttle_stop is None else throttle_stop
+        self.throttled = 0
+        self.reason = None
+        self.lock = threading.Lock()
+
+    def remaining(self):
+        return self.deadline - time.monotonic()
+
+    def stopped(self):
+        if self.reason is None and self.remaining() <= 0:
+            self.reason = "deadline"
+        return self.reason is not None
+
+    def note(self, status_code, final):
+        """記錄一次推播結果；final 表示不再重試。"""
+        with self.lock:
+            if status_code == 429 and final:
+                self.throttled += 1
+                if self.throttled >= self.throttle_stop and self.reason is None:
+                    self.reason = "throttled"
+            elif status_code is not None and status_code < 400:
+                self.throttled = 0
+
+
+def _push_retry_delay(attempt, retry_after=None, run=None):
+    """指數退避加亂數；429 有 Retry-After 時以它為準（上限 30 秒），且不超過本次 fan-out 剩餘預算。"""
+    delay = None
+    if retry_after is not None:
+        try:
+            delay = min(30.0, float(retry_after))
+        except (TypeError, ValueError):
+            pass
+    if delay is None:
+        delay = PUSH_RETRY_BASE_SECONDS * (2 ** attempt) * (1 + random.random() / 2)
+    if run is not None:
+        delay = max(0.0, min(delay, run.remaining()))
+    return delay
 
-    url = "https://api.line.me/v2/bot/message/push"
+
+def _push_request(user_id, text, retry_key=None):
+    url = f"{LINE_API_BASE}/v2/bot/message/push"
     headers = {
         "Content-Type": "application/json",
         "Authorization": f"Bearer {CHANNEL_ACCESS_TOKEN}",
+        "X-Line-Retry-Key": retry_key or str(uuid.uuid4()),
     }
-    payload = {"to": user_id, "messages": [{"type": "text", "text": text}]}
+    return url, headers, json.dumps({"to": user_id, "messages": [{"type": "text", "text": text}]})
 
-    try:
-        r = requests.post(url, headers=headers, data=json.dumps(payload), timeout=10)
-        print("LINE PUSH STATUS:", r.status_code, "TO:", user_id)
-        if r.status_code >= 400:
-            print("LINE PUSH BODY:", r.text[:500])
-            return False
+
+def _push_should_retry(status_code, attempt, run=None):
+    """回傳 True 表示要重試（並已記錄重試次數）；fan-out 已停止時不再重試。"""
+    if attempt >= PUSH_MAX_RETRIES or (run is not None and run.stopped()):
+        return False
+    if status_code is None:
+        METRICS.inc("line_push_retries_total", {"reason": "error"})
         return True
-    except Exception as e:
-        print("LINE PUSH EXCEPTION:", repr(e))
+    if status_code == 429 or status_code >= 500:
+        METRICS.inc("line_push_retries_total", {"reason": str(status_code)})
+        return True
+    return False
+
+
+def push_message(user_id: str, text: str, job=None, retry_key=None, run=None) -> bool:
+    """
+    429 / 5xx / 連線錯誤時依 PUSH_MAX_RETRIES 重試。
+    同一則訊息的重試共用 X-Line-Retry-Key，LINE 已收過時回 409，視為成功，不會重複推播。
+    job 為推播來源（cron 名稱），寫進送達紀錄；retry_key 由 outbox 指定時跨 process 重送也不會重複。
+    run 為 cron 的 PushRun，重試等待受其預算限制。
+    """
+    if not CHANNEL_ACCESS_TOKEN:
+        log_event(logging.WARNING, "channel_access_token_empty")
+        return False
+
+    url, headers, data = _push_request(user_id, text, retry_key)
+
+    for attempt in range(PUSH_MAX_RETRIES + 1):
+        started = time.perf_counter()
+        try:
+            r = requests.post(url, headers=headers, data=data, timeout=10)
+        except Exception as e:
+            _observe_line("push", started, None)
+            if _push_should_retry(None, attempt, run):
+                time.sleep(_push_retry_delay(attempt, run=run))
+                continue
+            log_event(logging.ERROR, "line_push_exception", error=repr(e), attempts=attempt + 1)
+            record_delivery("push", user_id, None, False, job, attempt + 1, repr(e)[:500])
+            return False
+
+        _observe_line("push", started, r.status_code)
+        log_sampled("line_push", status=r.status_code, user=user_ref(user_id))
+        if r.status_code < 400 or r.status_code == 409:
+            if run is not None:
+                run.note(r.status_code, True)
+            record_delivery("push", user_id, r.status_code, True, job, attempt + 1)
+            return True
+        retry = _push_should_retry(r.status_code, attempt, run)
+        if run is not None:
+            run.note(r.status_code, not retry)
+        if retry:
+            time.sleep(_push_retry_delay(attempt, r.headers.get("Retry-After"), run))
+            continue
+        log_event(
+            logging.WARNING, "line_push_failed",
+            status=r.status_code, user=user_ref(user_id), attempts=attempt + 1, body=r.text[:500]
+        )
+        record_delivery("push", user_id, r.status_code, False, job, attempt + 1, r.text[:500])
         return False
+    return False
 
 
 # =========================
-# 會員系統
+# 非同步模式
 # =========================
-def set_expiry_plus_days(user_id: str, days: int = 30):
-    now_tw = datetime.now(TZ_TW)
-    target_date = (now_tw + timedelta(days=days)).date()
-    dt_tw = datetime.strptime(target_date.strftime("%Y-%m-%d"), "%Y-%m-%d").replace(
-        hour=23, minute=59, second=59, tzinfo=TZ_TW
-    )
+# ASYNC_MODE=1 時 webhook 事件交給背景 event loop 並行處理、立即回 200，
+# 推播 fan-out 以 aiohttp 同時送出多則（未安裝時改用執行緒池）。
+# psycopg2 / requests 的既有同步 helper 不變，在 loop 上以 asyncio.to_thread 執行，
+# 執行緒數上限 ASYNC_WORKER_THREADS 同時限制了資料庫連線數。
+ASYNC_MODE = os.getenv("ASYNC_MODE", "").strip() in ("1", "true", "yes")
+PUSH_CONCURRENCY = int(os.getenv("PUSH_CONCURRENCY", "100"))
+ASYNC_WORKER_THREADS = int(os.getenv("ASYNC_WORKER_THREADS", "16"))
+ASYNC_DRAIN_SECONDS = 10
+
+_ASYNC = {"pid": None, "loop": None, "session": None, "pending": set()}
+_ASYNC_LOCK = threading.Lock()
+
+
+def _async_loop():
+    """每個 process 第一次使用時建立背景 event loop（fork 後重新建立）。"""
+    pid = os.getpid()
+    if _ASYNC["pid"] != pid:
+        with _ASYNC_LOCK:
+            if _ASYNC["pid"] != pid:
+                loop = asyncio.new_event_loop()
+                loop.set_default_executor(
+                    ThreadPoolExecutor(max_workers=ASYNC_WORKER_THREADS, thread_name_prefix="async-io")
+                )
+                threading.Thread(target=loop.run_forever, name="async-loop", daemon=True).start()
+                _ASYNC.update(pid=pid, loop=loop, session=None, pending=set())
+    return _ASYNC["loop"]
+
+
+def run_async(coro):
+    """在背景 loop 上執行 coroutine，回傳 concurrent.futures.Future。"""
+    future = asyncio.run_coroutine_threadsafe(coro, _async_loop())
+    pending = _ASYNC["pending"]
+    pending.add(future)
+    future.add_done_callback(pending.discard)
+    return future
+
+
+def _drain_async():
+    # worker 結束前等還在處理的事件 / 推播做完
+    if _ASYNC["pid"] == os.getpid() and _ASYNC["pending"]:
+        wait_futures(list(_ASYNC["pending"]), timeout=ASYNC_DRAIN_SECONDS)
+
+
+atexit.register(_drain_async)
+
+
+async def _http_session():
+    # 只在 loop 執行緒內使用，不需要鎖
+    session = _ASYNC["session"]
+    if session is None or session.closed:
+        session = _ASYNC["session"] = aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(total=10),
+            connector=aiohttp.TCPConnector(limit=PUSH_CONCURRENCY),
+        )
+    return session
 
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("""
-        INSERT INTO members (user_id, expires_at)
-        VALUES (%s, %s)
-        ON CONFLICT (user_id) DO UPDATE SET expires_at = EXCLUDED.expires_at;
-    """, (user_id, dt_tw))
-    conn.commit()
-    cur.close()
-    conn.close()
-    return dt_tw
 
+async def push_message_async(user_id: str, text: str, job=None, retry_key=None, run=None) -> bool:
+    """push_message 的 aiohttp 版本，重試與 Retry-Key 規則相同。"""
+    if not CHANNEL_ACCESS_TOKEN:
+        log_event(logging.WARNING, "channel_access_token_empty")
+        return False
 
-def get_expiry(user_id: str):
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT expires_at FROM members WHERE user_id = %s;", (user_id,))
-    row = cur.fetchone()
-    cur.close()
-    conn.close()
-    return row[0] if row else None
+    session = await _http_session()
+    url, headers, data = _push_request(user_id, text, retry_key)
 
+    for attempt in range(PUSH_MAX_RETRIES + 1):
+        started = time.perf_counter()
+        try:
+            async with session.post(url, headers=headers, data=data) as r:
+                status = r.status
+                retry_after = r.headers.get("Retry-After")
+                body = await r.text() if status >= 400 else ""
+        except Exception as e:
+            _observe_line("push", started, None)
+            if _push_should_retry(None, attempt, run):
+                await asyncio.sleep(_push_retry_delay(attempt, run=run))
+                continue
+            log_event(logging.ERROR, "line_push_exception", error=repr(e), attempts=attempt + 1)
+            record_delivery("push", user_id, None, False, job, attempt + 1, repr(e)[:500])
+            return False
+
+        _observe_line("push", started, status)
+        log_sampled("line_push", status=status, user=user_ref(user_id))
+        if status < 400 or status == 409:
+            if run is not None:
+                run.note(status, True)
+            record_delivery("push", user_id, status, True, job, attempt + 1)
+            return True
+        retry = _push_should_retry(status, attempt, run)
+        if run is not None:
+            run.note(status, not retry)
+        if retry:
+            await asyncio.sleep(_push_retry_delay(attempt, retry_after, run))
+            continue
+        log_event(
+            logging.WARNING, "line_push_failed",
+            status=status, user=user_ref(user_id), attempts=attempt + 1, body=body[:500]
+        )
+        record_delivery("push", user_id, status, False, job, attempt + 1, body[:500])
+        return False
+    return False
+
+
+def _push_args(item):
+    # (user_id, text) 或 outbox 的 (user_id, text, retry_key)
+    return item[0], item[1], item[2] if len(item) > 2 else None
+
+
+async def _push_many_async(messages, concurrency, job=None, run=None):
+    it = iter(enumerate(messages))
+    results = [False] * len(messages)
+
+    async def worker():
+        # 所有 worker 共用同一個 iterator，同時最多 concurrency 則在途
+        for i, item in it:
+            if run is not None and run.stopped():
+                return
+            uid, text, retry_key = _push_args(item)
+            results[i] = await push_message_async(uid, text, job, retry_key, run)
+
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    return results
+
+
+def _push_many_threads(messages, concurrency, job=None, run=None):
+    it = iter(enumerate(messages))
+    lock = threading.Lock()
+    results = [False] * len(messages)
+
+    def worker():
+        while True:
+            with lock:
+                i, item = next(it, (None, None))
+            if item is None or (run is not None and run.stopped()):
+                return
+            uid, text, retry_key = _push_args(item)
+            results[i] = push_message(uid, text, job, retry_key, run)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for _ in range(concurrency):
+            pool.submit(worker)
+    return results
+
+
+def push_results(messages, job=None, concurrent=None, run=None):
+    """
+    messages 為 [(user_id, text[, retry_key]), ...]，回傳與 messages 同順序的成功與否。
+    concurrent 未指定時依 ASYNC_MODE；不並行時逐一呼叫 push_message（原本的行為）。
+    run（PushRun）停止後剩下的訊息不送，結果為 False。
+    """
+    messages = list(messages)
+    concurrent = ASYNC_MODE if concurrent is None else concurrent
+    concurrency = max(1, min(PUSH_CONCURRENCY, len(messages)))
+    if not concurrent or len(messages) <= 1:
+        results = [False] * len(messages)
+        for i, item in enumerate(messages):
+            if run is not None and run.stopped():
+                break
+            uid, text, retry_key = _push_args(item)
+            results[i] = push_message(uid, text, job, retry_key, run)
+        return results
+    if aiohttp is None:
+        return _push_many_threads(messages, concurrency, job, run)
+    return run_async(_push_many_async(messages, concurrency, job, run)).result()
+
+
+def push_many(messages, job=None, run=None):
+    """回傳成功則數。"""
+    return sum(push_results(messages, job, run=run))
+
+
+# =========================
+# 推播紀錄
+# =========================
+# 每則 push / reply 的最終結果先放在記憶體，滿 DELIVERY_FLUSH_ROWS 筆或每 DELIVERY_FLUSH_SECONDS 秒
+# 由背景執行緒以 execute_values 批次寫入 message_deliveries。
+# 資料表依台灣日期分區，每日推播時順手刪掉超過 DELIVERY_RETENTION_DAYS 天的分區。
+DELIVERY_LOG_ENABLED = os.getenv("DELIVERY_LOG_ENABLED", "1").strip() != "0"
+DELIVERY_FLUSH_ROWS = int(os.getenv("DELIVERY_FLUSH_ROWS", "500"))
+DELIVERY_FLUSH_SECONDS = float(os.getenv("DELIVERY_FLUSH_SECONDS", "2"))
+DELIVERY_BUFFER_MAX = int(os.getenv("DELIVERY_BUFFER_MAX", "50000"))
+DELIVERY_RETENTION_DAYS = int(os.getenv("DELIVERY_RETENTION_DAYS", "14"))
+
+# 回覆只有 replyToken，處理事件時把 userId 放在這裡
+_DELIVERY_USER = contextvars.ContextVar("delivery_user", default=None)
+
+_DELIVERY = {"pid": None, "rows": [], "wake": None, "days": set()}
+_DELIVERY_LOCK = threading.Lock()
+
+
+def record_delivery(kind, user_id, status, ok, job=None, attempts=1, error=None):
+    """記一筆送達結果（只進記憶體緩衝）；status 為 None 代表連線錯誤。"""
+    if not DELIVERY_LOG_ENABLED:
+        return
+    row = (datetime.now(TZ_TW), kind, job, user_id, status, ok, attempts, error)
+    _delivery_buffer()
+    with _DELIVERY_LOCK:
+        rows = _DELIVERY["rows"]
+        if len(rows) >= DELIVERY_BUFFER_MAX:
+            METRICS.inc("delivery_log_dropped_total", {"reason": "buffer_full"})
+            return
+        rows.append(row)
+        full = len(rows) >= DELIVERY_FLUSH_ROWS
+    if full:
+        _DELIVERY["wake"].set()
+
+
+def _delivery_buffer():
+    """每個 process 第一次記錄時才建立緩衝與背景執行緒（fork 後重新建立，不帶父 process 的資料）。"""
+    pid = os.getpid()
+    if _DELIVERY["pid"] != pid:
+        with _DELIVERY_LOCK:
+            if _DELIVERY["pid"] != pid:
+                wake = threading.Event()
+                _DELIVERY.update(pid=pid, rows=[], wake=wake, days=set())
+                threading.Thread(target=_delivery_flush_loop, args=(wake,), name="delivery-log", daemon=True).start()
+
+
+def _delivery_flush_loop(wake):
+    while True:
+        wake.wait(DELIVERY_FLUSH_SECONDS)
+        wake.clear()
+        flush_deliveries()
+
+
+def _delivery_partition(day):
+    return f"message_deliveries_{day:%Y%m%d}"
+
+
+def ensure_delivery_partitions(cur, days):
+    """建立指定台灣日期的分區（已建立過的略過）。"""
+    for day in sorted(set(days) - _DELIVERY["days"]):
+        start = datetime(day.year, day.month, day.day, tzinfo=TZ_TW)
+        cur.execute(f"""
+            CREATE TABLE IF NOT EXISTS {_delivery_partition(day)}
+            PARTITION OF message_deliveries
+            FOR VALUES FROM (%s) TO (%s);
+        """, (start, start + timedelta(days=1)))
+        _DELIVERY["days"].add(day)
+
+
+@observe_db
+def flush_deliveries():
+    """把緩衝內的紀錄寫入資料庫，回傳寫入筆數；失敗時整批丟棄並計數。"""
+    if _DELIVERY["pid"] != os.getpid():
+        return 0
+    with _DELIVERY_LOCK:
+        rows = _DELIVERY["rows"]
+        _DELIVERY["rows"] = []
+    if not rows:
+        return 0
+
+    try:
+        conn = get_conn()
+        cur = conn.cursor()
+        ensure_delivery_partitions(cur, {r[0].date() for r in rows})
+        execute_values(cur, """
+            INSERT INTO message_deliveries
+                (sent_at, kind, job, user_id, status, ok, attempts, error)
+            VALUES %s;
+        """, rows, page_size=1000)
+        conn.commit()
+        cur.close()
+        conn.close()
+    except Exception as e:
+        # 分區快取可能和資料庫不一致（例如被手動刪除），下一批重新建立
+        _DELIVERY["days"] = set()
+        METRICS.inc("delivery_log_dropped_total", {"reason": "flush_error"}, len(rows))
+        log_event(logging.ERROR, "delivery_flush_error", error=repr(e), rows=len(rows))
+        return 0
+
+    METRICS.inc("delivery_log_rows_total", value=len(rows))
+    return len(rows)
+
+
+atexit.register(flush_deliveries)
+
+
+@observe_db
+def drop_old_delivery_partitions(retention_days=DELIVERY_RETENTION_DAYS, today=None):
+    """刪除早於保留天數的分區，並預先建立今天與明天的分區；回傳刪除的分區名稱。"""
+    today = today or datetime.now(TZ_TW).date()
+    cutoff = _delivery_partition(today - timedelta(days=retention_days))
+
+    conn = get_conn()
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT c.relname
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        JOIN pg_class p ON p.oid = i.inhparent
+        WHERE p.relname = 'message_deliveries';
+    """)
+    # 分區名稱含 YYYYMMDD，字串比較即日期比較
+    dropped = sorted(r[0] for r in cur.fetchall() if r[0] < cutoff)
+    for name in dropped:
+        cur.execute(f"DROP TABLE IF EXISTS {name};")
+    _DELIVERY["days"] = set()
+    ensure_delivery_partitions(cur, {today, today + timedelta(days=1)})
+    conn.commit()
+    cur.close()
+    conn.close()
+    return dropped
+
+
+@observe_db
+def delivery_failure_report(hours=24, job=None, limit=10):
+    """
+    最近 hours 小時的送達統計：總數、失敗數、失敗狀態分布與最近幾筆失敗。
+    只查涵蓋時間範圍的分區。
+    """
+    flush_deliveries()
+    since = datetime.now(TZ_TW) - timedelta(hours=hours)
+    job_sql = "AND job = %s" if job else ""
+    params = (since, job) if job else (since,)
+
+    conn = get_conn()
+    cur = conn.cursor()
+    cur.execute(f"""
+        SELECT kind, COALESCE(status::text, 'error'), ok, COUNT(*)
+        FROM message_deliveries
+        WHERE sent_at >= %s {job_sql}
+        GROUP BY 1, 2, 3;
+    """, params)
+    counts = cur.fetchall()
+    cur.execute(f"""
+        SELECT sent_at, kind, job, user_id, status, attempts, error
+        FROM message_deliveries
+        WHERE sent_at >= %s AND NOT ok {job_sql}
+        ORDER BY sent_at DESC
+        LIMIT %s;
+    """, params + (limit,))
+    recent = cur.fetchall()
+    cur.close()
+    conn.close()
+
+    report = {"hours": hours, "job": job, "total": 0, "failed": 0, "by_status": {}, "recent": []}
+    for kind, status, ok, count in counts:
+        report["total"] += count
+        if not ok:
+            report["failed"] += count
+            key = f"{kind}:{status}"
+            report["by_status"][key] = report["by_status"].get(key, 0) + count
+    for sent_at, kind, job_name, uid, status, attempts, error in recent:
+        report["recent"].append({
+            "sent_at": sent_at.astimezone(TZ_TW).strftime("%Y-%m-%d %H:%M:%S"),
+            "kind": kind,
+            "job": job_name,
+            "user_id": uid,
+            "status": status,
+            "attempts": attempts,
+            "error": error,
+        })
+    return report
+
+
+def render_delivery_report(report):
+    lines = [
+        f"📮 最近 {report['hours']} 小時送達紀錄",
+        f"總數：{report['total']}　失敗：{report['failed']}",
+    ]
+    if report["by_status"]:
+        lines.append("")
+        for key, count in sorted(report["by_status"].items(), key=lambda x: -x[1]):
+            lines.append(f"{key}：{count}")
+    if report["recent"]:
+        lines.append("")
+        lines.append("最近失敗：")
+        for r in report["recent"]:
+            lines.append(
+                f"{r['sent_at']} {r['kind']}/{r['job'] or '-'} "
+                f"{r['status'] or 'error'} x{r['attempts']} {r['user_id'] or '-'}"
+            )
+    return "\n".join(lines)[:5000]
+
+
+# =========================
+# 推播 outbox
+# =========================
+# PUSH_OUTBOX_ENABLED=1 時 cron 只把推播整批寫進 push_outbox 就回應，
+# 由 sender.py 以 FOR UPDATE SKIP LOCKED 認領批次送出，可同時跑多個 sender。
+# 同一則內容只存一份（push_outbox_messages），每位收件人一列並帶固定的 retry_key，
+# sender 中途當掉、租約過期後被別的 sender 重送時，LINE 會以 409 擋下重複。
+PUSH_OUTBOX_ENABLED = os.getenv("PUSH_OUTBOX_ENABLED", "").strip() in ("1", "true", "yes")
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "500"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "3"))
+OUTBOX_LEASE_SECONDS = int(os.getenv("OUTBOX_LEASE_SECONDS", "300"))
+OUTBOX_RETRY_SECONDS = 60
+OUTBOX_KEEP_DAYS = 7
+
+
+@observe_db
+def enqueue_pushes(messages, job, dedupe_key):
+    """
+    messages 為 [(user_id, text), ...]，回傳新寫入的列數。
+    dedupe_key 相同（例如 push_state 的 key）時重複呼叫不會重複排入。
+    """
+    by_text = {}
+    for uid, text in messages:
+        by_text.setdefault(text, []).append(uid)
+    if not by_text:
+        return 0
+
+    conn = get_conn()
+    cur = conn.cursor()
+    queued = 0
+    for text, user_ids in by_text.items():
+        key = dedupe_key
+        if len(by_text) > 1:
+            key = f"{dedupe_key}:{hashlib.sha1(text.encode('utf-8')).hexdigest()[:12]}"
+        cur.execute("""
+            INSERT INTO push_outbox_messages (dedupe_key, job, text, created_at)
+            VALUES (%s, %s, %s, NOW())
+            ON CONFLICT (dedupe_key) DO UPDATE
+            SET dedupe_key = EXCLUDED.dedupe_key
+            RETURNING message_id;
+        """, (key, job, text))
+        message_id = cur.fetchone()[0]
+        rows = execute_values(cur, """
+            INSERT INTO push_outbox (message_id, user_id, retry_key, status, attempts, available_at, created_at)
+            VALUES %s
+            ON CONFLICT (message_id, user_id) DO NOTHING
+            RETURNING id;
+        """, [(message_id, uid, str(uuid.uuid4())) for uid in user_ids],
+            template="(%s, %s, %s, 'pending', 0, NOW(), NOW())", page_size=1000, fetch=True)
+        queued += len(rows)
+    conn.commit()
+    cur.close()
+    conn.close()
+
+    METRICS.inc("push_outbox_enqueued_total", {"job": job}, queued)
+    return queued
+
+
+PUSH_PROGRESS_CHUNK = 500
+
+
+def deliver_pushes(messages, job, dedupe_key, run=None):
+    """
+    cron 的推播出口，回傳 (排入或送達的則數, 是否完成)。
+    啟用 outbox 時排入佇列；否則分批直接送出，每批送達的使用者記進 push_progress，
+    run 預算用完或持續 429 停下時回傳未完成，下次 cron 以同一個 dedupe_key 只補送剩下的人。
+    """
+    if PUSH_OUTBOX_ENABLED:
+        return enqueue_pushes(messages, job, dedupe_key), True
+
+    run = run or PushRun()
+    done = get_push_progress(dedupe_key)
+    pending = [m for m in messages if m[0] not in done]
+    ok = 0
+    for i in range(0, len(pending), PUSH_PROGRESS_CHUNK):
+        if run.stopped():
+            break
+        chunk = pending[i:i + PUSH_PROGRESS_CHUNK]
+        results = push_results(chunk, job, run=run)
+        delivered = [m[0] for m, r in zip(chunk, results) if r]
+        save_push_progress(dedupe_key, delivered)
+        ok += len(delivered)
+
+    if run.stopped():
+        METRICS.inc("push_run_stopped_total", {"job": job, "reason": run.reason})
+        log_event(
+            logging.WARNING, "push_run_stopped",
+            job=job, reason=run.reason, delivered=ok, remaining=len(pending) - ok
+        )
+        return ok, False
+    return ok, True
+
+
+def finish_pushes(dedupe_key):
+    """推播已完成並寫入 push_state 後呼叫。"""
+    if PUSH_OUTBOX_ENABLED:
+        return
+    try:
+        clear_push_progress(dedupe_key)
+    except Exception as e:
+        log_event(logging.ERROR, "push_progress_clear_error", error=repr(e))
+
+
+@observe_db
+def claim_outbox_batch(limit=OUTBOX_BATCH_SIZE):
+    """
+    認領一批可送的列（pending 且到期，或 sending 但租約已過期），
+    回傳 [(id, user_id, retry_key, job, text, attempts), ...]。
+    """
+    conn = get_conn()
+    cur = conn.cursor()
+    cur.execute("""
+        WITH batch AS (
+            SELECT id
+            FROM push_outbox
+            WHERE (status = 'pending' AND available_at <= NOW())
+               OR (status = 'sending' AND claimed_at < NOW() - %s * INTERVAL '1 second')
+            ORDER BY id
+            LIMIT %s
+            FOR UPDATE SKIP LOCKED
+        )
+        UPDATE push_outbox o
+        SET status = 'sending',
+            claimed_at = NOW(),
+            attempts = o.attempts + 1
+        FROM batch, push_outbox_messages m
+        WHERE o.id = batch.id
+          AND m.message_id = o.message_id
+        RETURNING o.id, o.user_id, o.retry_key, m.job, m.text, o.attempts;
+    """, (OUTBOX_LEASE_SECONDS, limit))
+    rows = cur.fetchall()
+    conn.commit()
+    cur.close()
+    conn.close()
+    return rows
+
+
+@observe_db
+def complete_outbox_batch(rows, results):
+    """
+    依送出結果更新：成功的刪除（結果已在 message_deliveries），
+    失敗的延後重試，超過 OUTBOX_MAX_ATTEMPTS 標成 failed。
+    """
+    sent = [r[0] for r, ok in zip(rows, results) if ok]
+    retry = [r[0] for r, ok in zip(rows, results) if not ok and r[5] < OUTBOX_MAX_ATTEMPTS]
+    failed = [r[0] for r, ok in zip(rows, results) if not ok and r[5] >= OUTBOX_MAX_ATTEMPTS]
+
+    conn = get_conn()
+    cur = conn.cursor()
+    if sent:
+        cur.execute("DELETE FROM push_outbox WHERE id = ANY(%s);", (sent,))
+    if retry:
+        cur.execute("""
+            UPDATE push_outbox
+            SET status = 'pending',
+                available_at = NOW() + %s * INTERVAL '1 second'
+            WHERE id = ANY(%s);
+        """, (OUTBOX_RETRY_SECONDS, retry))
+    if failed:
+        cur.execute("UPDATE push_outbox SET status = 'failed' WHERE id = ANY(%s);", (failed,))
+    conn.commit()
+    cur.close()
+    conn.close()
+
+    METRICS.inc("push_outbox_sent_total", value=len(sent))
+    METRICS.inc("push_outbox_failed_total", value=len(failed))
+    return {"sent": len(sent), "retry": len(retry), "failed": len(failed)}
+
+
+def send_outbox_batch(limit=OUTBOX_BATCH_SIZE):
+    """認領一批並送出，回傳統計；佇列空時 claimed 為 0。"""
+    rows = claim_outbox_batch(limit)
+    if not rows:
+        return {"claimed": 0, "sent": 0, "retry": 0, "failed": 0}
+
+    # 同一批可能混有不同 job，分組送出以保留送達紀錄的 job
+    results = [False] * len(rows)
+    by_job = {}
+    for i, r in enumerate(rows):
+        by_job.setdefault(r[3], []).append(i)
+    for job, idxs in by_job.items():
+        ok = push_results([(rows[i][1], rows[i][4], rows[i][2]) for i in idxs], job, concurrent=True)
+        for i, v in zip(idxs, ok):
+            results[i] = v
+
+    stats = complete_outbox_batch(rows, results)
+    stats["claimed"] = len(rows)
+    return stats
+
+
+@observe_db
+def purge_outbox(keep_days=OUTBOX_KEEP_DAYS):
+    """刪掉太舊的 failed 列與已沒有收件人的訊息內容。"""
+    conn = get_conn()
+    cur = conn.cursor()
+    cur.execute("""
+        DELETE FROM push_outbox
+        WHERE status = 'failed'
+          AND created_at < NOW() - %s * INTERVAL '1 day';
+    """, (keep_days,))
+    cur.execute("""
+        DELETE FROM push_outbox_messages m
+        WHERE m.created_at < NOW() - %s * INTERVAL '1 day'
+          AND NOT EXISTS (SELECT 1 FROM push_outbox o WHERE o.message_id = m.message_id);
+    """, (keep_days,))
+    conn.commit()
+    cur.close()
+    conn.close()
 
+
+@observe_db
+def outbox_backlog():
+    """各狀態列數（監控 sender 是否跟得上）。"""
+    conn = get_conn()
+    cur = conn.cursor()
+    cur.execute("SELECT status, COUNT(*) FROM push_outbox GROUP BY status;")
+    rows = cur.fetchall()
+    cur.close()
+    conn.close()
+    return dict(rows)
+
+
+# =========================
+# 會員系統
+# =========================
+@observe_db
+def set_expiry_plus_days(user_id: str, days: int = 30):
+    now_tw = datetime.now(TZ_TW)
+    target_date = (now_tw + timedelta(days=days)).date()
+    dt_tw = datetime.strptime(target_date.strftime("%Y-%m-%d"), "%Y-%m-%d").replace(
+        hour=23, minute=59, second=59, tzinfo=TZ_TW
+    )
+
+    conn = get_conn()
+    cur = conn.cursor()
+    cur.execute("""
+        INSERT INTO members (user_id, expires_at, is_active)
+        VALUES (%s, %s, TRUE)
+        ON CONFLICT (user_id) DO UPDATE
+        SET expires_at = EXCLUDED.expires_at,
+            is_active = TRUE;
+    """, (user_id, dt_tw))
+    _sync_member_expiring(cur, user_id, dt_tw)
+    _sync_push_audience(cur, user_id)
+    conn.commit()
+    cur.close()
+    conn.close()
+    return dt_tw
+
+
+@observe_db
+def get_expiry(user_id: str):
+    conn = get_conn()
+    cur = conn.cursor()
+    cur.execute("SELECT expires_at FROM members WHERE user_id = %s;", (user_id,))
+    row = cur.fetchone()
+    cur.close()
+    conn.close()
+    return row[0] if row else None
+
+
+@observe_db
 def has_used_free_trial(user_id: str) -> bool:
     conn = get_conn()
     cur = conn.cursor()
@@ -318,6 +1842,7 @@ def has_used_free_trial(user_id: str) -> bool:
     return row is not None
 
 
+@observe_db
 def start_free_trial(user_id: str, hours: int = 24):
     """開通一次性免費試用。已開通會員或已試用者不重複開通。"""
     if not user_id:
@@ -336,10 +1861,13 @@ def start_free_trial(user_id: str, hours: int = 24):
     cur = conn.cursor()
     try:
         cur.execute("""
-            INSERT INTO members (user_id, expires_at)
-            VALUES (%s, %s)
-            ON CONFLICT (user_id) DO UPDATE SET expires_at = EXCLUDED.expires_at;
+            INSERT INTO members (user_id, expires_at, is_active)
+            VALUES (%s, %s, TRUE)
+            ON CONFLICT (user_id) DO UPDATE
+            SET expires_at = EXCLUDED.expires_at,
+                is_active = TRUE;
         """, (user_id, exp_tw))
+        _sync_member_expiring(cur, user_id, exp_tw)
 
         cur.execute("""
             INSERT INTO free_trials (user_id, started_at, expires_at)
@@ -353,6 +1881,7 @@ def start_free_trial(user_id: str, hours: int = 24):
             ON CONFLICT (user_id)
             DO UPDATE SET enabled = TRUE, updated_at = EXCLUDED.updated_at;
         """, (user_id, now_tw))
+        _sync_push_audience(cur, user_id)
 
         conn.commit()
     except Exception:
@@ -374,42 +1903,121 @@ def is_member(user_id: str) -> bool:
         exp_tw = exp.astimezone(TZ_TW)
         return exp_tw > now_tw
     except Exception as e:
-        print("IS_MEMBER ERROR:", repr(e))
+        log_event(logging.ERROR, "is_member_error", error=repr(e))
         return False
 
 
+@observe_db
 def get_active_member_ids():
     conn = get_conn()
     cur = conn.cursor()
     now_tw = datetime.now(TZ_TW)
-    cur.execute("SELECT user_id FROM members WHERE expires_at > %s;", (now_tw,))
+    cur.execute("SELECT user_id FROM members WHERE is_active AND expires_at > %s;", (now_tw,))
     rows = cur.fetchall()
     cur.close()
     conn.close()
     return [r[0] for r in rows]
 
 
-def get_expiring_members(days_before=3):
+@observe_db
+def get_expiring_members(days_before=3, today=None):
+    """
+    讀 sweeper 預先算好的 members_expiring_on；
+    超出預算天數時才回到 members 以到期時間範圍查詢。
+    """
+    today = today or datetime.now(TZ_TW).date()
+    target_date = today + timedelta(days=days_before)
+
     conn = get_conn()
     cur = conn.cursor()
+    if days_before <= MEMBER_EXPIRING_DAYS:
+        cur.execute("""
+            SELECT user_id, expires_at
+            FROM members_expiring_on
+            WHERE expire_date = %s;
+        """, (target_date,))
+    else:
+        start = _tw_day_start(target_date)
+        cur.execute("""
+            SELECT user_id, expires_at
+            FROM members
+            WHERE is_active
+              AND expires_at >= %s
+              AND expires_at < %s;
+        """, (start, start + timedelta(days=1)))
+    rows = cur.fetchall()
+    cur.close()
+    conn.close()
+    return rows
+
+
+# =========================
+# 會員到期 sweeper
+# =========================
+# 每天跑一次（/cron/sweep-members，每日推播也會先跑）：
+# 把已到期會員標成 is_active = FALSE，並把未來 MEMBER_EXPIRING_DAYS 天內到期的會員
+# 依台灣日期寫進 members_expiring_on。會員寫入 helper 會同步更新單一使用者的那一列，
+# 兩次 sweep 之間的續約 / 試用也不會漏掉。
+MEMBER_EXPIRING_DAYS = int(os.getenv("MEMBER_EXPIRING_DAYS", "7"))
 
-    today = datetime.now(TZ_TW).date()
-    target_date = today + timedelta(days=days_before)
 
+def _tw_day_start(d):
+    return datetime(d.year, d.month, d.day, tzinfo=TZ_TW)
+
+
+def _sync_member_expiring(cur, user_id, expires_at, today=None):
+    """在呼叫端的交易內更新單一會員的預算到期列。"""
+    today = today or datetime.now(TZ_TW).date()
+    expire_date = expires_at.astimezone(TZ_TW).date()
+    cur.execute("DELETE FROM members_expiring_on WHERE user_id = %s;", (user_id,))
+    if today <= expire_date <= today + timedelta(days=MEMBER_EXPIRING_DAYS):
+        cur.execute("""
+            INSERT INTO members_expiring_on (expire_date, user_id, expires_at)
+            VALUES (%s, %s, %s);
+        """, (expire_date, user_id, expires_at))
+
+
+@observe_db
+def sweep_members(now=None, days=None):
+    """回傳 {"deactivated": 標成失效的人數, "expiring": 預算到期列數}。"""
+    now = now or datetime.now(TZ_TW)
+    days = MEMBER_EXPIRING_DAYS if days is None else days
+    start = _tw_day_start(now.astimezone(TZ_TW).date())
+
+    conn = get_conn()
+    cur = conn.cursor()
     cur.execute("""
-        SELECT user_id, expires_at
+        UPDATE members
+        SET is_active = FALSE
+        WHERE is_active
+          AND expires_at <= %s;
+    """, (now,))
+    deactivated = cur.rowcount
+    cur.execute("DELETE FROM push_audience WHERE expires_at <= %s;", (now,))
+
+    # 整段重建，會員資料被直接改過也能在隔天回到一致
+    cur.execute("DELETE FROM members_expiring_on;")
+    cur.execute("""
+        INSERT INTO members_expiring_on (expire_date, user_id, expires_at)
+        SELECT (expires_at AT TIME ZONE 'Asia/Taipei')::date, user_id, expires_at
         FROM members
-        WHERE (expires_at AT TIME ZONE 'Asia/Taipei')::date = %s;
-    """, (target_date,))
-    rows = cur.fetchall()
+        WHERE is_active
+          AND expires_at >= %s
+          AND expires_at < %s;
+    """, (start, start + timedelta(days=days + 1)))
+    expiring = cur.rowcount
+    conn.commit()
     cur.close()
     conn.close()
-    return rows
+
+    METRICS.inc("members_deactivated_total", value=deactivated)
+    return {"deactivated": deactivated, "expiring": expiring}
 
 
 # =========================
 # 待確認帳號
 # =========================
+@observe_db
 def save_pending_account(game_account: str, user_id: str):
     created_at = datetime.now(TZ_TW)
     conn = get_conn()
@@ -426,6 +2034,7 @@ def save_pending_account(game_account: str, user_id: str):
     conn.close()
 
 
+@observe_db
 def pop_pending_user_id(game_account: str):
     conn = get_conn()
     cur = conn.cursor()
@@ -443,24 +2052,115 @@ def pop_pending_user_id(game_account: str):
     return user_id
 
 
-def get_latest_pending(limit=50):
+@observe_db
+def get_latest_pending(limit=50, after=None):
+    """
+    依建立時間由新到舊；after 為上一頁最後一列的 (created_at, game_account)，
+    以 keyset 接續，不論翻到第幾頁都只走索引的一小段。
+    """
     conn = get_conn()
     cur = conn.cursor()
-    cur.execute("""
-        SELECT game_account, user_id, created_at
-        FROM pending_accounts
-        ORDER BY created_at DESC
-        LIMIT %s;
-    """, (limit,))
+    if after is None:
+        cur.execute("""
+            SELECT game_account, user_id, created_at
+            FROM pending_accounts
+            ORDER BY created_at DESC, game_account DESC
+            LIMIT %s;
+        """, (limit,))
+    else:
+        cur.execute("""
+            SELECT game_account, user_id, created_at
+            FROM pending_accounts
+            WHERE (created_at, game_account) < (%s, %s)
+            ORDER BY created_at DESC, game_account DESC
+            LIMIT %s;
+        """, (after[0], after[1], limit))
     rows = cur.fetchall()
     cur.close()
     conn.close()
     return rows
 
 
+PENDING_PAGE_SIZE = 50
+LINE_TEXT_LIMIT = 5000
+
+
+def _pending_cursor_key(user_id):
+    return f"pending_cursor_{user_id}"
+
+
+PENDING_FOOTER_MORE = "\n輸入「待確認 <管理密碼> next」看下一頁"
+PENDING_FOOTER_END = "\n（已是最後一頁）"
+# 帳號是使用者自由輸入的文字，列表中每個欄位最多顯示這麼多字，確保單列一定放得進一頁
+PENDING_FIELD_MAX = 200
+
+
+def _pending_field(value):
+    value = str(value)
+    if len(value) <= PENDING_FIELD_MAX:
+        return value
+    return f"{value[:PENDING_FIELD_MAX]}…（共 {len(value)} 字）"
+
+
+def render_pending_page(rows, page, has_more, limit=LINE_TEXT_LIMIT):
+    """
+    回傳 (訊息, 實際放入的列數)。放不下的列整列留給下一頁；
+    過長的欄位先截成 PENDING_FIELD_MAX 字，每頁至少放得進一列，游標一定會前進。
+    """
+    header = f"📋 待確認帳號（第 {page} 頁，由新到舊）\n\n"
+    budget = limit - len(header) - max(len(PENDING_FOOTER_MORE), len(PENDING_FOOTER_END))
+
+    parts = []
+    for ga, uid, ts in rows:
+        ts_str = ts.astimezone(TZ_TW).strftime("%Y-%m-%d %H:%M")
+        item = f"帳號：{_pending_field(ga)}\nuserId：{_pending_field(uid)}\n時間：{ts_str}\n-----------------\n"
+        if len(item) > budget and parts:
+            break
+        parts.append(item)
+        budget -= len(item)
+
+    more = has_more or len(parts) < len(rows)
+    return header + "".join(parts) + (PENDING_FOOTER_MORE if more else PENDING_FOOTER_END), len(parts)
+
+
+def pending_accounts_page(user_id, next_page=False, page_size=PENDING_PAGE_SIZE):
+    """
+    管理員的待確認清單分頁；游標存在 push_state，next_page=False 時從第一頁開始。
+    回傳 (訊息, 本頁列數)；已到最後一頁時回傳 (None, 0)。
+    """
+    key = _pending_cursor_key(user_id)
+    after, page = None, 1
+    if next_page:
+        state = get_push_state(key)
+        if state:
+            cursor = json.loads(state)
+            if cursor.get("done"):
+                return None, 0
+            after = (datetime.fromisoformat(cursor["created_at"]), cursor["game_account"])
+            page = cursor["page"] + 1
+
+    # 多取一列判斷是否還有下一頁
+    rows = get_latest_pending(page_size + 1, after=after)
+    if not rows:
+        set_push_state(key, json.dumps({"done": True}))
+        return None, 0
+
+    text, shown = render_pending_page(rows[:page_size], page, len(rows) > page_size)
+    last_ga, _, last_ts = rows[shown - 1]
+    has_more = len(rows) > shown
+    set_push_state(key, json.dumps({
+        "created_at": last_ts.isoformat(),
+        "game_account": last_ga,
+        "page": page,
+        "done": not has_more,
+    }))
+    return text, shown
+
+
 # =========================
 # 訂閱控制
 # =========================
+@observe_db
 def enable_prediction(user_id: str):
     conn = get_conn()
     cur = conn.cursor()
@@ -471,11 +2171,13 @@ def enable_prediction(user_id: str):
         SET enabled = TRUE,
             updated_at = EXCLUDED.updated_at;
     """, (user_id, datetime.now(TZ_TW)))
+    _sync_push_audience(cur, user_id)
     conn.commit()
     cur.close()
     conn.close()
 
 
+@observe_db
 def disable_prediction(user_id: str):
     conn = get_conn()
     cur = conn.cursor()
@@ -486,27 +2188,18 @@ def disable_prediction(user_id: str):
         SET enabled = FALSE,
             updated_at = EXCLUDED.updated_at;
     """, (user_id, datetime.now(TZ_TW)))
+    _sync_push_audience(cur, user_id)
     conn.commit()
     cur.close()
     conn.close()
 
 
+@observe_db
 def get_prediction_subscribers():
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("""
-        SELECT p.user_id
-        FROM prediction_subscribers p
-        JOIN members m ON p.user_id = m.user_id
-        WHERE p.enabled = TRUE
-          AND m.expires_at > %s;
-    """, (datetime.now(TZ_TW),))
-    rows = cur.fetchall()
-    cur.close()
-    conn.close()
-    return [r[0] for r in rows]
+    return get_push_audience("prediction")
 
 
+@observe_db
 def enable_daily_push(user_id: str):
     conn = get_conn()
     cur = conn.cursor()
@@ -516,11 +2209,13 @@ def enable_daily_push(user_id: str):
         ON CONFLICT (user_id)
         DO UPDATE SET enabled = TRUE, updated_at = EXCLUDED.updated_at;
     """, (user_id, datetime.now(TZ_TW)))
+    _sync_push_audience(cur, user_id)
     conn.commit()
     cur.close()
     conn.close()
 
 
+@observe_db
 def disable_daily_push(user_id: str):
     conn = get_conn()
     cur = conn.cursor()
@@ -530,22 +2225,80 @@ def disable_daily_push(user_id: str):
         ON CONFLICT (user_id)
         DO UPDATE SET enabled = FALSE, updated_at = EXCLUDED.updated_at;
     """, (user_id, datetime.now(TZ_TW)))
+    _sync_push_audience(cur, user_id)
     conn.commit()
     cur.close()
     conn.close()
 
 
+@observe_db
 def get_daily_push_users():
-    # 舊會員如果尚未建立 daily_push_subscribers，視為預設開啟
+    return get_push_audience("daily")
+
+
+# =========================
+# 推播對象
+# =========================
+# push_audience 每個 (audience, user_id) 一列，帶會員到期時間：
+#   daily      有效會員且未關閉每日推播（舊會員沒有 daily_push_subscribers 列時視為開啟）
+#   prediction 有效會員且開啟預測分析
+# 會員 / 訂閱的寫入 helper 在同一個交易內重算該使用者的列，到期與否在讀取時以 expires_at 判斷，
+# 每 5 分鐘的 check-bingo 只需要一次 index-only 範圍查詢。
+_PUSH_AUDIENCE_SQL = """
+    SELECT 'daily', m.user_id, m.expires_at
+    FROM members m
+    LEFT JOIN daily_push_subscribers d ON m.user_id = d.user_id
+    WHERE COALESCE(d.enabled, TRUE) = TRUE {filter}
+    UNION ALL
+    SELECT 'prediction', m.user_id, m.expires_at
+    FROM members m
+    JOIN prediction_subscribers p ON p.user_id = m.user_id
+    WHERE p.enabled = TRUE {filter}
+"""
+
+
+def _sync_push_audience(cur, user_id):
+    """在呼叫端的交易內重算單一使用者的推播對象列。"""
+    cur.execute("DELETE FROM push_audience WHERE user_id = %s;", (user_id,))
+    cur.execute(
+        "INSERT INTO push_audience (audience, user_id, expires_at) "
+        + _PUSH_AUDIENCE_SQL.format(filter="AND m.user_id = %s")
+        + " ON CONFLICT (audience, user_id) DO NOTHING;",
+        (user_id, user_id)
+    )
+
+
+def _rebuild_push_audience(cur):
+    cur.execute("DELETE FROM push_audience;")
+    cur.execute(
+        "INSERT INTO push_audience (audience, user_id, expires_at) "
+        + _PUSH_AUDIENCE_SQL.format(filter="AND m.expires_at > NOW()")
+        + " ON CONFLICT (audience, user_id) DO NOTHING;"
+    )
+    return cur.rowcount
+
+
+@observe_db
+def rebuild_push_audience():
+    """整張重建（直接改過會員 / 訂閱資料表之後使用），回傳列數。"""
+    conn = get_conn()
+    cur = conn.cursor()
+    count = _rebuild_push_audience(cur)
+    conn.commit()
+    cur.close()
+    conn.close()
+    return count
+
+
+def get_push_audience(audience, now=None):
     conn = get_conn()
     cur = conn.cursor()
     cur.execute("""
-        SELECT m.user_id
-        FROM members m
-        LEFT JOIN daily_push_subscribers d ON m.user_id = d.user_id
-        WHERE m.expires_at > %s
-          AND COALESCE(d.enabled, TRUE) = TRUE;
-    """, (datetime.now(TZ_TW),))
+        SELECT user_id
+        FROM push_audience
+        WHERE audience = %s
+          AND expires_at > %s;
+    """, (audience, now or datetime.now(TZ_TW)))
     rows = cur.fetchall()
     cur.close()
     conn.close()
@@ -555,6 +2308,7 @@ def get_daily_push_users():
 # =========================
 # push state
 # =========================
+@observe_db
 def get_push_state(push_key: str):
     conn = get_conn()
     cur = conn.cursor()
@@ -565,6 +2319,7 @@ def get_push_state(push_key: str):
     return row[0] if row else None
 
 
+@observe_db
 def set_push_state(push_key: str, last_value: str):
     conn = get_conn()
     cur = conn.cursor()
@@ -581,35 +2336,88 @@ def set_push_state(push_key: str, last_value: str):
     conn.close()
 
 
-# =========================
-# 539 真實資料
-# =========================
-def fetch_recent_539_results(max_rows: int = 80):
-    r = requests.get(
-        SOURCE_539_URL,
-        timeout=15,
+@observe_db
+def get_push_progress(push_key: str):
+    conn = get_conn()
+    cur = conn.cursor()
+    cur.execute("SELECT user_id FROM push_progress WHERE push_key = %s;", (push_key,))
+    rows = cur.fetchall()
+    cur.close()
+    conn.close()
+    return {r[0] for r in rows}
+
+
+@observe_db
+def save_push_progress(push_key: str, user_ids):
+    if not user_ids:
+        return
+    conn = get_conn()
+    cur = conn.cursor()
+    execute_values(cur, """
+        INSERT INTO push_progress (push_key, user_id, created_at)
+        VALUES %s
+        ON CONFLICT (push_key, user_id) DO NOTHING;
+    """, [(push_key, uid) for uid in user_ids], template="(%s, %s, NOW())", page_size=1000)
+    conn.commit()
+    cur.close()
+    conn.close()
+
+
+@observe_db
+def clear_push_progress(push_key: str):
+    """推播完成（push_state 已標記）後進度不再需要；順手清掉放太久的。"""
+    conn = get_conn()
+    cur = conn.cursor()
+    cur.execute("""
+        DELETE FROM push_progress
+        WHERE push_key = %s
+           OR created_at < NOW() - INTERVAL '3 days';
+    """, (push_key,))
+    conn.commit()
+    cur.close()
+    conn.close()
+
+
+# =========================
+# 539 真實資料
+# =========================
+@traced
+def fetch_recent_539_results(max_rows: int = 80):
+    r = requests.get(
+        SOURCE_539_URL,
+        timeout=15,
         headers={"User-Agent": "Mozilla/5.0"}
     )
     r.encoding = "utf-8"
-    html = r.text
+    return parse_539_html(r.text, max_rows=max_rows)
 
-    pattern = re.compile(
-        r"開獎日期:(\d{4})/(\d{2})/(\d{2}).{0,20}?\s+(\d{2})[,\s]+(\d{2})[,\s]+(\d{2})[,\s]+(\d{2})[,\s]+(\d{2})",
-        re.MULTILINE
-    )
 
-    out = []
-    for m in pattern.finditer(html):
+PATTERN_539_HTML = re.compile(
+    r"開獎日期:(\d{4})/(\d{2})/(\d{2}).{0,20}?\s+(\d{2})[,\s]+(\d{2})[,\s]+(\d{2})[,\s]+(\d{2})[,\s]+(\d{2})",
+    re.MULTILINE
+)
+
+
+def iter_539_html(html: str):
+    """逐筆解析 pilio 格式頁面，回傳 (draw_date, "01 02 03 04 05")。"""
+    for m in PATTERN_539_HTML.finditer(html):
         y, mo, d = int(m.group(1)), int(m.group(2)), int(m.group(3))
         nums = [int(m.group(i)) for i in range(4, 9)]
         nums_sorted = sorted(nums)
         s = " ".join([f"{n:02d}" for n in nums_sorted])
-        out.append((date(y, mo, d), s))
-        if len(out) >= max_rows:
+        yield date(y, mo, d), s
+
+
+def parse_539_html(html: str, max_rows=None):
+    out = []
+    for row in iter_539_html(html):
+        out.append(row)
+        if max_rows and len(out) >= max_rows:
             break
     return out
 
 
+@observe_db
 def upsert_539_draws(rows):
     if not rows:
         return
@@ -625,14 +2433,92 @@ def upsert_539_draws(rows):
     conn.close()
 
 
+class _CopyRowStream:
+    """
+    把 (draw_date, numbers) 迭代器包成 COPY FROM STDIN 可讀的檔案物件，
+    邊讀邊產生，不把整份歷史資料放進記憶體。
+    """
+
+    def __init__(self, rows, progress_every=5000, on_progress=None):
+        self._rows = iter(rows)
+        self._buf = ""
+        self.count = 0
+        self._progress_every = progress_every
+        self._on_progress = on_progress
+
+    def _next_line(self):
+        d, nums = next(self._rows)
+        self.count += 1
+        if self._on_progress and self._progress_every and self.count % self._progress_every == 0:
+            self._on_progress(self.count)
+        return f"{d.isoformat()}\t{nums}\n"
+
+    def read(self, size=-1):
+        try:
+            while size < 0 or len(self._buf) < size:
+                self._buf += self._next_line()
+        except StopIteration:
+            pass
+        if size < 0:
+            out, self._buf = self._buf, ""
+        else:
+            out, self._buf = self._buf[:size], self._buf[size:]
+        return out
+
+
+@observe_db
+def bulk_load_539_draws(rows, progress_every=5000, on_progress=None):
+    """
+    大量匯入 539 歷史開獎：
+    - COPY FROM STDIN 串流進暫存表
+    - 一次 INSERT ... ON CONFLICT 合併回 lotto_539_draws
+    同一天重複出現時以檔案中較後面的那筆為準。
+    回傳 (讀入筆數, 合併筆數)。
+    """
+    stream = _CopyRowStream(rows, progress_every=progress_every, on_progress=on_progress)
+
+    conn = get_conn()
+    cur = conn.cursor()
+    try:
+        cur.execute("""
+            CREATE TEMP TABLE lotto_539_load (
+                seq BIGSERIAL,
+                draw_date DATE NOT NULL,
+                numbers TEXT NOT NULL
+            ) ON COMMIT DROP;
+        """)
+        cur.copy_expert(
+            "COPY lotto_539_load (draw_date, numbers) FROM STDIN",
+            stream
+        )
+        cur.execute("""
+            INSERT INTO lotto_539_draws (draw_date, numbers)
+            SELECT DISTINCT ON (draw_date) draw_date, numbers
+            FROM lotto_539_load
+            ORDER BY draw_date, seq DESC
+            ON CONFLICT (draw_date) DO UPDATE SET numbers = EXCLUDED.numbers;
+        """)
+        merged = cur.rowcount
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+        conn.close()
+
+    return stream.count, merged
+
+
 def ensure_latest_539_in_db():
     try:
         rows = fetch_recent_539_results(max_rows=80)
         upsert_539_draws(rows)
     except Exception as e:
-        print("FETCH_539_ERROR:", repr(e))
+        log_event(logging.ERROR, "fetch_539_error", error=repr(e))
 
 
+@observe_db
 def load_539_draws(limit=240):
     conn = get_conn()
     cur = conn.cursor()
@@ -703,6 +2589,7 @@ def build_daily_top_hot(ranked_candidates, pick_date):
     return " ".join([f"{n:02d}" for n in sorted(list(chosen)[:5])])
 
 
+@observe_db
 def get_prev_day_top_hot(prev_date):
     conn = get_conn()
     cur = conn.cursor()
@@ -717,6 +2604,66 @@ def get_prev_day_top_hot(prev_date):
     return row[0] if row else None
 
 
+# =========================
+# 539 引擎參數（可由 tune_539.py 調校）
+# =========================
+FEATURES_539 = ("f30", "f120", "f240", "gap", "head", "tail", "adj")
+
+ENGINE_CONFIG_539_DEFAULT = {
+    "version": 0,
+    "weights": {
+        "f30": 0.30,
+        "f120": 0.20,
+        "f240": 0.12,
+        "gap": 0.16,
+        "head": 0.10,
+        "tail": 0.10,
+        "adj": 0.07,
+    },
+    # 遺漏期數 <= 上限 時套用該分數；None 為其餘全部
+    "gap_buckets": [[1, 0.10], [5, 0.55], [14, 1.00], [28, 0.78], [None, 0.62]],
+}
+
+ENGINE_CONFIG_539_PATH = os.getenv(
+    "ENGINE_CONFIG_539_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "engine_config_539.json")
+)
+
+
+def load_engine_config_539(path=None):
+    """讀取調校後的引擎參數；檔案不存在或格式錯誤時使用預設值。"""
+    path = path or ENGINE_CONFIG_539_PATH
+    cfg = json.loads(json.dumps(ENGINE_CONFIG_539_DEFAULT))
+    if not os.path.exists(path):
+        return cfg
+
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+
+        weights = data.get("weights", {})
+        for k in FEATURES_539:
+            if k in weights:
+                cfg["weights"][k] = float(weights[k])
+
+        buckets = data.get("gap_buckets")
+        if buckets:
+            parsed = [[None if b is None else int(b), float(v)] for b, v in buckets]
+            if parsed[-1][0] is not None:
+                raise ValueError("gap_buckets 最後一段上限必須為 null")
+            cfg["gap_buckets"] = parsed
+
+        cfg["version"] = int(data.get("version", 0))
+    except Exception as e:
+        log_event(logging.ERROR, "load_engine_config_539_error", error=repr(e))
+        return json.loads(json.dumps(ENGINE_CONFIG_539_DEFAULT))
+
+    return cfg
+
+
+ENGINE_CONFIG_539 = load_engine_config_539()
+
+
 def freq_539(draws_240):
     f = {i: 0 for i in range(1, 40)}
     for _, nums in draws_240:
@@ -749,6 +2696,27 @@ def _freq_slice(draws, size):
     return freq_539(draws[:size]) if draws else {i: 0 for i in range(1, 40)}
 
 
+def _gap_raw_539(draws):
+    gap = {i: len(draws) + 5 for i in range(1, 40)}
+    for idx, (_, nums) in enumerate(draws):
+        for n in nums:
+            if gap[n] == len(draws) + 5:
+                gap[n] = idx
+    return gap
+
+
+def _gap_bucket_score_539(gap, buckets=None):
+    """依 gap_buckets [[上限, 分數], ..., [None, 分數]] 把遺漏期數換成分數。"""
+    buckets = buckets or ENGINE_CONFIG_539["gap_buckets"]
+    score = {}
+    for n, gap_n in gap.items():
+        for max_gap, value in buckets:
+            if max_gap is None or gap_n <= max_gap:
+                score[n] = value
+                break
+    return score
+
+
 def _gap_score_539(draws):
     """
     遺漏值 / 回補分數：
@@ -756,25 +2724,60 @@ def _gap_score_539(draws):
     - 中度遺漏：加權
     - 超長遺漏：保留爆發補位
     """
-    gap = {i: len(draws) + 5 for i in range(1, 40)}
-    for idx, (_, nums) in enumerate(draws):
+    gap = _gap_raw_539(draws)
+    return _gap_bucket_score_539(gap), gap
+
+
+class DrawWindows539:
+    """
+    539 滾動視窗：依時間順序 push 開獎，同時維持 30/120/240 期頻率與遺漏值。
+    每期只加新開獎、扣掉離開視窗的那期，回測逐日重播不必每天重算。
+    """
+
+    SIZES = (30, 120, 240)
+
+    def __init__(self, sizes=SIZES):
+        self.sizes = tuple(sizes)
+        self.history = deque(maxlen=max(self.sizes))
+        self.freq = {size: [0] * 40 for size in self.sizes}
+        self.last_seen = [None] * 40
+        self.total = 0
+
+    def push(self, draw_date, nums):
+        for size in self.sizes:
+            counts = self.freq[size]
+            if len(self.history) >= size:
+                for n in self.history[-size][1]:
+                    counts[n] -= 1
+            for n in nums:
+                counts[n] += 1
+        self.history.append((draw_date, nums))
         for n in nums:
-            if gap[n] == len(draws) + 5:
-                gap[n] = idx
+            self.last_seen[n] = self.total
+        self.total += 1
 
-    score = {}
-    for n, g in gap.items():
-        if g <= 1:
-            score[n] = 0.10
-        elif 2 <= g <= 5:
-            score[n] = 0.55
-        elif 6 <= g <= 14:
-            score[n] = 1.00
-        elif 15 <= g <= 28:
-            score[n] = 0.78
-        else:
-            score[n] = 0.62
-    return score, gap
+    def __len__(self):
+        return len(self.history)
+
+    def recent(self, limit):
+        """最新在前，與 load_539_draws 排序相同。"""
+        out = []
+        for i in range(1, min(limit, len(self.history)) + 1):
+            out.append(self.history[-i])
+        return out
+
+    def freq_dict(self, size):
+        counts = self.freq[size]
+        return {n: counts[n] for n in range(1, 40)}
+
+    def gap(self):
+        length = len(self.history)
+        gap = {}
+        for n in range(1, 40):
+            last = self.last_seen[n]
+            idx = self.total - 1 - last if last is not None else length + 5
+            gap[n] = idx if idx < length else length + 5
+        return gap
 
 
 def _head_of(n):
@@ -865,24 +2868,73 @@ def _adjacency_score_539(draws):
     return score
 
 
-def _weighted_sample_without_replacement(items, weights, k, rng):
-    pool = list(items)
+def weighted_sample_without_replacement(items, weights, k, rng):
+    """
+    依權重不重複抽 k 個（weights 與 items 等長、皆 > 0）。
+    以 Fenwick tree 做前綴和搜尋，每抽一次 O(log n)；
+    抽法與「uniform(0, total) 後線性累加」相同，同一個 rng 種子結果可重現。
+    """
+    n = len(items)
+    w = list(weights)
+    tree = [0.0] * (n + 1)
+    for i in range(1, n + 1):
+        tree[i] += w[i - 1]
+        j = i + (i & -i)
+        if j <= n:
+            tree[j] += tree[i]
+
+    top = 1 << (n.bit_length() - 1) if n else 0
     chosen = []
-    while pool and len(chosen) < k:
-        total = sum(max(0.001, weights.get(n, 0.001)) for n in pool)
+    while len(chosen) < min(k, n):
+        total = 0.0
+        i = n
+        while i > 0:
+            total += tree[i]
+            i -= i & -i
         r = rng.uniform(0, total)
-        acc = 0
-        pick = pool[-1]
-        for n in pool:
-            acc += max(0.001, weights.get(n, 0.001))
-            if r <= acc:
-                pick = n
-                break
-        chosen.append(pick)
-        pool.remove(pick)
+
+        # 找第一個前綴和 >= r 的位置
+        pos = 0
+        step = top
+        while step:
+            nxt = pos + step
+            if nxt <= n and tree[nxt] < r:
+                pos = nxt
+                r -= tree[nxt]
+            step >>= 1
+
+        # 浮點誤差落在已抽走的位置或超出尾端時，就近取仍在池中的號碼：
+        # 先往後找，後面都已抽走再往前找
+        pos = min(pos, n - 1)
+        nxt = pos
+        while nxt < n and w[nxt] == 0:
+            nxt += 1
+        if nxt < n:
+            pos = nxt
+        else:
+            while w[pos] == 0:
+                pos -= 1
+
+        chosen.append(items[pos])
+        delta = -w[pos]
+        w[pos] = 0
+        i = pos + 1
+        while i <= n:
+            tree[i] += delta
+            i += i & -i
     return chosen
 
 
+def _weighted_sample_without_replacement(items, weights, k, rng):
+    pool = list(items)
+    return weighted_sample_without_replacement(
+        pool,
+        [max(0.001, weights.get(n, 0.001)) for n in pool],
+        k,
+        rng
+    )
+
+
 def _zone_counts(nums):
     return {
         "low": sum(1 for n in nums if 1 <= n <= 13),
@@ -932,7 +2984,43 @@ def _repair_motherboard_zone(nums, ranked_candidates):
     return sorted(nums[:9])
 
 
-def build_motherboard_models_539(draws_240):
+def motherboard_features_539(draws_240, windows=None):
+    """
+    母盤引擎的特徵：正規化後的頻率/頭數/尾數/鄰號分數與原始遺漏值。
+    遺漏值分數依設定的 gap_buckets 另外計算，方便調校時重複使用。
+    """
+    if windows is not None:
+        f30 = windows.freq_dict(30)
+        f120 = windows.freq_dict(120)
+        f240 = windows.freq_dict(240)
+        gap_raw = windows.gap()
+        draws_240 = windows.recent(5)
+    else:
+        f30 = _freq_slice(draws_240, 30)
+        f120 = _freq_slice(draws_240, 120)
+        f240 = _freq_slice(draws_240, 240)
+        gap_raw = _gap_raw_539(draws_240)
+    head_score, head_note = _head_pattern_score_539(draws_240)
+    tail_score, tail_note = _tail_pattern_score_539(draws_240)
+    adj_score = _adjacency_score_539(draws_240)
+
+    return {
+        "norm": {
+            "f30": _normalize_score(f30),
+            "f120": _normalize_score(f120),
+            "f240": _normalize_score(f240),
+            "head": _normalize_score(head_score),
+            "tail": _normalize_score(tail_score),
+            "adj": _normalize_score(adj_score),
+        },
+        "gap_raw": gap_raw,
+        "head_note": head_note,
+        "tail_note": tail_note,
+    }
+
+
+@traced
+def build_motherboard_models_539(draws_240, pick_date=None, windows=None, config=None):
     """
     539 商業版母盤引擎：
     - 頻率：30/120/240期
@@ -941,10 +3029,16 @@ def build_motherboard_models_539(draws_240):
     - 尾數型態：同尾爆量、關聯尾、斷層尾
     - 鄰號補位：近期開出號碼的前後鄰號
     最後產出：9碼母盤、3碼主軸、5碼主攻、8碼爆發。
+    pick_date 決定亂數種子（預設今天）；windows 為 DrawWindows539 時
+    直接使用滾動視窗的頻率與遺漏值，不再從 draws_240 重算。
+    config 預設為啟動時載入的 ENGINE_CONFIG_539。
     """
-    today = datetime.now(TZ_TW).date()
+    today = pick_date or datetime.now(TZ_TW).date()
     rng = random.Random(f"539-motherboard-v3-{today.isoformat()}")
 
+    if windows is not None:
+        draws_240 = windows.recent(5)
+
     if not draws_240:
         fallback = [4, 8, 13, 18, 21, 27, 33, 36, 39]
         return {
@@ -959,35 +3053,20 @@ def build_motherboard_models_539(draws_240):
             "head_note": "資料不足"
         }
 
-    f30 = _freq_slice(draws_240, 30)
-    f120 = _freq_slice(draws_240, 120)
-    f240 = _freq_slice(draws_240, 240)
-    gap_score, gap_raw = _gap_score_539(draws_240)
-    head_score, head_note = _head_pattern_score_539(draws_240)
-    tail_score, tail_note = _tail_pattern_score_539(draws_240)
-    adj_score = _adjacency_score_539(draws_240)
+    cfg = config or ENGINE_CONFIG_539
+    feats = motherboard_features_539(draws_240, windows=windows)
+    gap_raw = feats["gap_raw"]
+    head_note = feats["head_note"]
+    tail_note = feats["tail_note"]
 
-    nf30 = _normalize_score(f30)
-    nf120 = _normalize_score(f120)
-    nf240 = _normalize_score(f240)
-    ngap = _normalize_score(gap_score)
-    nhead = _normalize_score(head_score)
-    ntail = _normalize_score(tail_score)
-    nadj = _normalize_score(adj_score)
+    norm = dict(feats["norm"])
+    norm["gap"] = _normalize_score(_gap_bucket_score_539(gap_raw, cfg["gap_buckets"]))
+    weights = cfg["weights"]
 
     score = {}
     for n in range(1, 40):
         noise = rng.uniform(0, 0.035)
-        score[n] = (
-            0.30 * nf30[n] +
-            0.20 * nf120[n] +
-            0.12 * nf240[n] +
-            0.16 * ngap[n] +
-            0.10 * nhead[n] +
-            0.10 * ntail[n] +
-            0.07 * nadj[n] +
-            noise
-        )
+        score[n] = sum(weights[k] * norm[k][n] for k in FEATURES_539) + noise
 
     ranked = [n for n, _ in sorted(score.items(), key=lambda x: x[1], reverse=True)]
     candidate_pool = ranked[:24]
@@ -1091,60 +3170,160 @@ def build_daily_top_hot(ranked_candidates, pick_date):
     return " ".join([f"{n:02d}" for n in sorted(list(chosen)[:5])])
 
 
-def get_or_build_today_pick_539():
-    today = datetime.now(TZ_TW).date()
+def _pick_row_to_pack(pick_date, row):
+    try:
+        rendered = json.loads(row[4]) if row[4] else {}
+    except Exception:
+        rendered = {}
+    return {
+        "pick_date": pick_date,
+        "numbers": row[0],
+        "hot_zone": row[1],
+        "top_hot": row[2],
+        "note": row[3],
+        "rendered": rendered,
+        "source_draw_date": row[5],
+        "warmed_at": row[6],
+        "market_state": row[7],
+    }
+
 
+@observe_db
+def get_cached_pick_539(pick_date):
     conn = get_conn()
     cur = conn.cursor()
     cur.execute("""
-        SELECT numbers, hot_zone, top_hot, note
+        SELECT numbers, hot_zone, top_hot, note, rendered, source_draw_date, warmed_at, market_state
         FROM daily_pick_cache
         WHERE pick_date = %s;
-    """, (today,))
+    """, (pick_date,))
     row = cur.fetchone()
     cur.close()
     conn.close()
+    return _pick_row_to_pack(pick_date, row) if row else None
 
-    if row:
-        return {"numbers": row[0], "hot_zone": row[1], "top_hot": row[2], "note": row[3]}
 
+def build_pick_539(pick_date):
+    """
+    抓最新開獎、建立指定日期的母盤，並預先產生推播 / 今日陪跑訊息一起寫入快取。
+    """
     ensure_latest_539_in_db()
     draws_240 = load_539_draws(limit=240)
     d30 = draws_240[:30] if len(draws_240) >= 30 else draws_240
 
     hot_zone, ranked_candidates, f30 = hot_zone_and_hotnums_539(d30)
-    prev_top_hot = get_prev_day_top_hot(today - timedelta(days=1))
-    top_hot = build_daily_top_hot(ranked_candidates, today)
+    prev_top_hot = get_prev_day_top_hot(pick_date - timedelta(days=1))
+    top_hot = build_daily_top_hot(ranked_candidates, pick_date)
 
     if prev_top_hot and prev_top_hot == top_hot:
-        top_hot = build_daily_top_hot(ranked_candidates[::-1], today)
+        top_hot = build_daily_top_hot(ranked_candidates[::-1], pick_date)
 
-    models = build_motherboard_models_539(draws_240)
+    models = build_motherboard_models_539(draws_240, pick_date=pick_date)
 
     note = json.dumps(models, ensure_ascii=False)
+    now_tw = datetime.now(TZ_TW)
+    pack = {
+        "pick_date": pick_date,
+        "numbers": models["motherboard"],
+        "hot_zone": hot_zone,
+        "top_hot": top_hot,
+        "note": note,
+        "source_draw_date": draws_240[0][0] if draws_240 else None,
+        "warmed_at": now_tw,
+        "market_state": market_state_from_draws(d30),
+    }
+    pack["rendered"] = {
+        "push": render_539_push(pack),
+        "companion": render_today_companion(pack),
+        "bet_plans": render_standard_bet_plans(pack),
+    }
 
     conn = get_conn()
     cur = conn.cursor()
     cur.execute("""
-        INSERT INTO daily_pick_cache (pick_date, numbers, hot_zone, top_hot, note, created_at)
-        VALUES (%s, %s, %s, %s, %s, %s)
+        INSERT INTO daily_pick_cache (
+            pick_date, numbers, hot_zone, top_hot, note, created_at,
+            rendered, source_draw_date, warmed_at, market_state
+        )
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
         ON CONFLICT (pick_date) DO UPDATE
         SET numbers = EXCLUDED.numbers,
             hot_zone = EXCLUDED.hot_zone,
             top_hot = EXCLUDED.top_hot,
             note = EXCLUDED.note,
-            created_at = EXCLUDED.created_at;
-    """, (today, models["motherboard"], hot_zone, top_hot, note, datetime.now(TZ_TW)))
+            created_at = EXCLUDED.created_at,
+            rendered = EXCLUDED.rendered,
+            source_draw_date = EXCLUDED.source_draw_date,
+            warmed_at = EXCLUDED.warmed_at,
+            market_state = EXCLUDED.market_state;
+    """, (
+        pick_date, models["motherboard"], hot_zone, top_hot, note, now_tw,
+        json.dumps(pack["rendered"], ensure_ascii=False), pack["source_draw_date"], now_tw,
+        pack["market_state"]
+    ))
+    conn.commit()
+    cur.close()
+    conn.close()
+
+    return pack
+
+
+def get_or_build_pick_539(pick_date=None):
+    pick_date = pick_date or datetime.now(TZ_TW).date()
+    pack = get_cached_pick_539(pick_date)
+    count_cache("daily_pick_539", pack is not None)
+    if pack:
+        return pack
+    with timed("pick_build_seconds", game="539"):
+        return build_pick_539(pick_date)
+
+
+def get_or_build_today_pick_539():
+    return get_or_build_pick_539(datetime.now(TZ_TW).date())
+
+
+def expected_latest_539_draw(pick_date):
+    """pick_date 當天的母盤應該用到的最新開獎日（539 週一至週六開獎）。"""
+    d = pick_date - timedelta(days=1)
+    while d.weekday() == 6:
+        d -= timedelta(days=1)
+    return d
+
+
+@observe_db
+def delete_cached_pick_539(pick_date):
+    conn = get_conn()
+    cur = conn.cursor()
+    cur.execute("DELETE FROM daily_pick_cache WHERE pick_date = %s;", (pick_date,))
     conn.commit()
     cur.close()
     conn.close()
 
-    return {
-        "numbers": models["motherboard"],
-        "hot_zone": hot_zone,
-        "top_hot": top_hot,
-        "note": note
-    }
+
+def warmup_next_day_pick_539(now=None):
+    """
+    預先建立明天的母盤快取（晚間開獎入庫後或每日推播時呼叫）。
+    明天的快取若已用到目前最新一期開獎則略過；
+    今天的開獎還沒入庫時不建立（並清掉舊資料建的快取），留給當天第一次查詢即時建立。
+    回傳 (狀態, pack)；狀態為 fresh / built / waiting。
+    """
+    tomorrow = (now or datetime.now(TZ_TW)).date() + timedelta(days=1)
+    expected = expected_latest_539_draw(tomorrow)
+
+    ensure_latest_539_in_db()
+    latest = load_539_draws(limit=1)
+    latest_date = latest[0][0] if latest else None
+
+    cached = get_cached_pick_539(tomorrow)
+    if latest_date is None or latest_date < expected:
+        if cached and (cached.get("source_draw_date") is None or cached["source_draw_date"] < expected):
+            delete_cached_pick_539(tomorrow)
+        return "waiting", {"pick_date": tomorrow, "source_draw_date": latest_date}
+
+    if cached and cached.get("rendered") and cached.get("source_draw_date") == latest_date:
+        return "fresh", cached
+    with timed("pick_build_seconds", game="539"):
+        return "built", build_pick_539(tomorrow)
 
 
 def parse_models_from_note(note_text: str):
@@ -1197,45 +3376,81 @@ def structure_text_from_numbers(nums_text: str):
     return f"低區{low}｜中區{mid}｜高區{high}"
 
 
+def render_539_push(pack):
+    pick_date = pack["pick_date"]
+    today_str = pick_date.strftime("%Y.%m.%d")
+    quote = get_daily_quote(pick_date)
+    m = parse_models_from_note(pack["note"])
+
+    rank_lines = pack["top_hot"].split()
+    rank_text = "\n".join(rank_lines[:5])
+
+    return (
+        "【理性陪跑研究室｜539 AI母盤日報】\n\n"
+        f"日期\n{today_str}\n\n"
+        "▍今日核心母盤（9碼）\n"
+        f"{m['motherboard']}\n\n"
+        "▍主軸號（2星穩定）\n"
+        f"{m['stable2']}\n\n"
+        "▍3星主攻盤\n"
+        f"{m['attack3']}\n\n"
+        "▍4星爆發盤\n"
+        f"{m['burst4']}\n\n"
+        "▍結構分析\n"
+        f"{structure_text_from_numbers(m['motherboard'])}\n"
+        f"近30期活躍區段：{pack['hot_zone']}\n"
+        f"冷號補位：{m.get('cold_note', '無')}\n"
+        f"高頻樣本：{'・'.join(rank_lines[:4])}\n\n"
+        "▍型態判斷\n"
+        f"{m.get('pattern_note', '')}\n\n"
+        "▍AI熱度排行\n"
+        f"{rank_text}\n\n"
+        "▍使用邏輯\n"
+        "2星看主軸，3星看主攻，4星看爆發盤。\n"
+        "三層都來自同一組母盤，不是分開亂數。\n\n"
+        "—— AI陪跑語錄 ——\n"
+        f"{quote}\n\n"
+        "（數據結構參考，非保證）"
+    )
+
+
+def render_today_companion(pack):
+    m = parse_models_from_note(pack["note"])
+    quote = get_daily_quote(pack["pick_date"])
+
+    return (
+        "【今日539 AI母盤】\n\n"
+        "▍核心母盤\n"
+        f"{m['motherboard']}\n\n"
+        "▍主軸號｜2星穩定\n"
+        f"{m['stable2']}\n\n"
+        "▍3星主攻\n"
+        f"{m['attack3']}\n\n"
+        "▍4星爆發\n"
+        f"{m['burst4']}\n\n"
+        "▍結構分析\n"
+        f"{structure_text_from_numbers(m['motherboard'])}\n"
+        f"活躍區段：{pack['hot_zone']}\n"
+        f"冷號補位：{m.get('cold_note', '無')}\n"
+        f"高頻樣本：{'・'.join(pack['top_hot'].split()[:4])}\n\n"
+        "▍型態判斷\n"
+        f"{m.get('pattern_note', '')}\n\n"
+        "▍策略解讀\n"
+        "主軸號：偏穩定，適合抓2星。\n"
+        "3星主攻：主軸加延伸號，抓今日主要節奏。\n"
+        "4星爆發：加入冷號與型態補位，拚波動放大。\n\n"
+        "▍AI陪跑語錄\n"
+        f"{quote}\n\n"
+        "（數據結構參考，非保證）"
+    )
+
+
 def format_539_push():
     try:
         pack = get_or_build_today_pick_539()
-        today_str = datetime.now(TZ_TW).strftime("%Y.%m.%d")
-        quote = get_daily_quote()
-        m = parse_models_from_note(pack["note"])
-
-        rank_lines = pack["top_hot"].split()
-        rank_text = "\n".join(rank_lines[:5])
-
-        return (
-            "【理性陪跑研究室｜539 AI母盤日報】\n\n"
-            f"日期\n{today_str}\n\n"
-            "▍今日核心母盤（9碼）\n"
-            f"{m['motherboard']}\n\n"
-            "▍主軸號（2星穩定）\n"
-            f"{m['stable2']}\n\n"
-            "▍3星主攻盤\n"
-            f"{m['attack3']}\n\n"
-            "▍4星爆發盤\n"
-            f"{m['burst4']}\n\n"
-            "▍結構分析\n"
-            f"{structure_text_from_numbers(m['motherboard'])}\n"
-            f"近30期活躍區段：{pack['hot_zone']}\n"
-            f"冷號補位：{m.get('cold_note', '無')}\n"
-            f"高頻樣本：{'・'.join(rank_lines[:4])}\n\n"
-            "▍型態判斷\n"
-            f"{m.get('pattern_note', '')}\n\n"
-            "▍AI熱度排行\n"
-            f"{rank_text}\n\n"
-            "▍使用邏輯\n"
-            "2星看主軸，3星看主攻，4星看爆發盤。\n"
-            "三層都來自同一組母盤，不是分開亂數。\n\n"
-            "—— AI陪跑語錄 ——\n"
-            f"{quote}\n\n"
-            "（數據結構參考，非保證）"
-        )
+        return pack["rendered"].get("push") or render_539_push(pack)
     except Exception as e:
-        print("FORMAT_539_PUSH ERROR:", repr(e))
+        log_event(logging.ERROR, "format_539_push_error", error=repr(e))
         return (
             "【理性陪跑研究室｜539 AI母盤日報】\n\n"
             "核心母盤\n04 08 13 18 21 27 33 36 39\n\n"
@@ -1248,36 +3463,9 @@ def format_539_push():
 def format_today_companion():
     try:
         pack = get_or_build_today_pick_539()
-        m = parse_models_from_note(pack["note"])
-        quote = get_daily_quote()
-
-        return (
-            "【今日539 AI母盤】\n\n"
-            "▍核心母盤\n"
-            f"{m['motherboard']}\n\n"
-            "▍主軸號｜2星穩定\n"
-            f"{m['stable2']}\n\n"
-            "▍3星主攻\n"
-            f"{m['attack3']}\n\n"
-            "▍4星爆發\n"
-            f"{m['burst4']}\n\n"
-            "▍結構分析\n"
-            f"{structure_text_from_numbers(m['motherboard'])}\n"
-            f"活躍區段：{pack['hot_zone']}\n"
-            f"冷號補位：{m.get('cold_note', '無')}\n"
-            f"高頻樣本：{'・'.join(pack['top_hot'].split()[:4])}\n\n"
-            "▍型態判斷\n"
-            f"{m.get('pattern_note', '')}\n\n"
-            "▍策略解讀\n"
-            "主軸號：偏穩定，適合抓2星。\n"
-            "3星主攻：主軸加延伸號，抓今日主要節奏。\n"
-            "4星爆發：加入冷號與型態補位，拚波動放大。\n\n"
-            "▍AI陪跑語錄\n"
-            f"{quote}\n\n"
-            "（數據結構參考，非保證）"
-        )
+        return pack["rendered"].get("companion") or render_today_companion(pack)
     except Exception as e:
-        print("FORMAT_TODAY_COMPANION ERROR:", repr(e))
+        log_event(logging.ERROR, "format_today_companion_error", error=repr(e))
         return (
             "【今日539 AI母盤】\n\n"
             "核心母盤\n04 08 13 18 21 27 33 36 39\n\n"
@@ -1286,40 +3474,137 @@ def format_today_companion():
 
 
 # =========================
-# 539 智能點數配置
+# 539 組合覆蓋計算
 # =========================
-def detect_market_state_for_bet():
+TOTAL_DRAWS_539 = math.comb(39, 5)  # 575,757 種開獎結果
+
+# 每碰賠率（2星 / 3星 / 4星）
+BET_ODDS_539 = {2: 70.44, 3: 840, 4: 12000}
+
+
+@functools.lru_cache(maxsize=64)
+def coverage_table_539(tiers):
     """
-    依近30期539熱度集中度判斷盤勢。
-    抓不到資料時回傳 normal，避免影響 webhook。
+    tiers 為 ((號碼 tuple, 星數 k), ...)，每層把號碼任選 k 顆全碰。
+    對全部 C(39,5) 種開獎結果統計各層中獎碰數，回傳 {(各層中獎碰數...): 開獎結果數}。
+
+    中獎情形只取決於「聯集內開出哪些號碼」，所以只需列舉聯集內至多 5 顆的子集合，
+    其餘號碼的開法以 C(39-聯集, 5-開出顆數) 計入，結果與逐一列舉 575,757 期完全相同。
     """
-    try:
-        ensure_latest_539_in_db()
-        draws = load_539_draws(limit=30)
+    union = sorted(set(n for nums, _ in tiers for n in nums))
+    bit = {n: 1 << i for i, n in enumerate(union)}
+    tier_masks = [(sum(bit[n] for n in nums), k) for nums, k in tiers]
+    rest = 39 - len(union)
+
+    table = {}
+    for h in range(0, min(5, len(union)) + 1):
+        ways = math.comb(rest, 5 - h)
+        if not ways:
+            continue
+        for hit_nums in combinations(union, h):
+            mask = sum(bit[n] for n in hit_nums)
+            key = tuple(math.comb((mask & tm).bit_count(), k) for tm, k in tier_masks)
+            table[key] = table.get(key, 0) + ways
+    return table
+
+
+def bet_coverage_539(tiers, stakes):
+    """
+    依 coverage_table_539 計算各層命中機率與期望回收。
+    stakes 為各層每碰點數；回傳 dict（機率為 0~1）。
+    """
+    table = coverage_table_539(tuple((tuple(sorted(nums)), k) for nums, k in tiers))
+
+    hit_prob = [0.0] * len(tiers)
+    expected = 0.0
+    any_hit = 0
+    for key, ways in table.items():
+        if any(key):
+            any_hit += ways
+        for i, hits in enumerate(key):
+            if hits:
+                hit_prob[i] += ways
+            expected += ways * hits * stakes[i] * BET_ODDS_539[tiers[i][1]]
 
-        freq30 = {i: 0 for i in range(1, 40)}
-        for _, nums in draws:
-            for n in nums:
-                freq30[n] += 1
+    return {
+        "hit_prob": [w / TOTAL_DRAWS_539 for w in hit_prob],
+        "max_hits": [math.comb(min(len(nums), 5), k) for nums, k in tiers],
+        "any_prob": any_hit / TOTAL_DRAWS_539,
+        "expected_return": expected / TOTAL_DRAWS_539,
+    }
 
-        values = list(freq30.values())
-        avg = sum(values) / len(values) if values else 0
-        if avg <= 0:
-            return "normal"
 
-        high = sum(1 for v in values if v > avg * 1.3)
-        low = sum(1 for v in values if v < avg * 0.7)
+# =========================
+# 539 智能點數配置
+# =========================
+@traced
+def market_state_from_draws(draws):
+    """依近30期539熱度集中度判斷盤勢：stable / chaos / normal。"""
+    freq30 = {i: 0 for i in range(1, 40)}
+    for _, nums in draws:
+        for n in nums:
+            freq30[n] += 1
 
-        if high >= 6:
-            return "stable"
-        elif low >= 10:
-            return "chaos"
-        else:
-            return "normal"
+    values = list(freq30.values())
+    avg = sum(values) / len(values) if values else 0
+    if avg <= 0:
+        return "normal"
+
+    high = sum(1 for v in values if v > avg * 1.3)
+    low = sum(1 for v in values if v < avg * 0.7)
+
+    if high >= 6:
+        return "stable"
+    elif low >= 10:
+        return "chaos"
+    else:
+        return "normal"
+
+
+_MARKET_STATE_MEMO = {}
+
+
+@observe_db
+def _save_market_state(pick_date, state):
+    conn = get_conn()
+    cur = conn.cursor()
+    cur.execute("""
+        UPDATE daily_pick_cache
+        SET market_state = %s
+        WHERE pick_date = %s;
+    """, (state, pick_date))
+    conn.commit()
+    cur.close()
+    conn.close()
+
+
+def detect_market_state_for_bet():
+    """
+    盤勢跟著每日母盤一起算好存在 daily_pick_cache，這裡只讀快取；
+    同一天之後直接從記憶體回傳，不再抓網頁。
+    抓不到資料時回傳 normal，避免影響 webhook。
+    """
+    today = datetime.now(TZ_TW).date()
+    state = _MARKET_STATE_MEMO.get(today)
+    count_cache("market_state", state is not None)
+    if state:
+        return state
+
+    try:
+        pack = get_or_build_today_pick_539()
+        state = pack.get("market_state")
+        if not state:
+            # 舊版快取沒有盤勢欄位：用資料庫現有開獎補算一次
+            state = market_state_from_draws(load_539_draws(limit=30))
+            _save_market_state(today, state)
     except Exception as e:
-        print("DETECT_MARKET_STATE_FOR_BET ERROR:", repr(e))
+        log_event(logging.ERROR, "detect_market_state_for_bet_error", error=repr(e))
         return "normal"
 
+    _MARKET_STATE_MEMO.clear()
+    _MARKET_STATE_MEMO[today] = state
+    return state
+
 
 def get_combo_by_state(state):
     if state == "stable":
@@ -1330,103 +3615,99 @@ def get_combo_by_state(state):
         return 15, 10, 15, "一般盤｜平衡配置"
 
 
-def build_bet_plan(total, mode="balanced"):
-    """
-    539 點數配置：
-    - 直接引用今日陪跑號碼
-    - 顯示 2/3/4 星要選幾顆、共幾碰
-    - 不展開全部組合，避免畫面太亂
-    """
-    try:
-        total = int(total)
-    except Exception:
-        total = 3000
+BET_PLAN_MODES = {
+    "safe": {
+        "name": "穩健模式",
+        "desc": "2星回補為主｜3星主攻｜4星小注爆發",
+        "p2": 0.45,
+        "p3": 0.40,
+        "p4": 0.15,
+    },
+    "balanced": {
+        "name": "均衡模式",
+        "desc": "2星回補｜3星主攻｜4星爆發",
+        "p2": 0.30,
+        "p3": 0.50,
+        "p4": 0.20,
+    },
+    "burst": {
+        "name": "爆發模式",
+        "desc": "降低2星配置，提高3星與4星攻擊",
+        "p2": 0.20,
+        "p3": 0.50,
+        "p4": 0.30,
+    }
+}
 
-    if total <= 0:
-        total = 3000
+# 點數配置選單上的固定金額，建立每日母盤時先算好
+BET_PLAN_STANDARD = (("safe", 1000), ("balanced", 3000), ("burst", 5000), ("burst", 10000))
 
-    modes = {
-        "safe": {
-            "name": "穩健模式",
-            "desc": "2星回補為主｜3星主攻｜4星小注爆發",
-            "p2": 0.45,
-            "p3": 0.40,
-            "p4": 0.15,
-        },
-        "balanced": {
-            "name": "均衡模式",
-            "desc": "2星回補｜3星主攻｜4星爆發",
-            "p2": 0.30,
-            "p3": 0.50,
-            "p4": 0.20,
-        },
-        "burst": {
-            "name": "爆發模式",
-            "desc": "降低2星配置，提高3星與4星攻擊",
-            "p2": 0.20,
-            "p3": 0.50,
-            "p4": 0.30,
-        }
-    }
-    cfg = modes.get(mode, modes["balanced"])
 
-    def money(x):
-        return f"{int(x):,}"
+def _bet_nums_from_text(text, limit=None):
+    out = []
+    for part in (text or "").split():
+        try:
+            n = int(part)
+            if 1 <= n <= 39 and n not in out:
+                out.append(n)
+        except Exception:
+            pass
+    return out[:limit] if limit else out
+
+
+def _bet_plan_numbers(pack):
+    """從今日母盤取 2/3/4 星號碼（3/5/6 顆），不足時依母盤與 1~39 補齊。"""
+    m = parse_models_from_note(pack.get("note", ""))
+    two_nums = _bet_nums_from_text(m.get("stable2", ""), 3)
+    three_nums = _bet_nums_from_text(m.get("attack3", ""), 5)
+    four_nums = _bet_nums_from_text(m.get("burst4", ""), 6)
+
+    # 防呆：若舊快取或資料異常，從母盤補齊
+    mother = _bet_nums_from_text(m.get("motherboard", ""))
+    for n in mother:
+        if len(two_nums) < 3 and n not in two_nums:
+            two_nums.append(n)
+        if len(three_nums) < 5 and n not in three_nums:
+            three_nums.append(n)
+        if len(four_nums) < 6 and n not in four_nums:
+            four_nums.append(n)
+
+    # 最後防呆，避免任何情況下不足顆數
+    for n in range(1, 40):
+        if len(two_nums) < 3 and n not in two_nums:
+            two_nums.append(n)
+        if len(three_nums) < 5 and n not in three_nums:
+            three_nums.append(n)
+        if len(four_nums) < 6 and n not in four_nums:
+            four_nums.append(n)
+        if len(two_nums) >= 3 and len(three_nums) >= 5 and len(four_nums) >= 6:
+            break
 
-    def nums_from_text(text, limit=None):
-        out = []
-        for part in (text or "").split():
-            try:
-                n = int(part)
-                if 1 <= n <= 39 and n not in out:
-                    out.append(n)
-            except Exception:
-                pass
-        return out[:limit] if limit else out
+    return sorted(two_nums[:3]), sorted(three_nums[:5]), sorted(four_nums[:6])
 
-    def fmt_nums(nums):
-        return " ".join([f"{n:02d}" for n in nums])
 
-    try:
-        pack = get_or_build_today_pick_539()
-        m = parse_models_from_note(pack.get("note", ""))
-        two_nums = nums_from_text(m.get("stable2", ""), 3)
-        three_nums = nums_from_text(m.get("attack3", ""), 5)
-        four_nums = nums_from_text(m.get("burst4", ""), 6)
-
-        # 防呆：若舊快取或資料異常，從母盤補齊
-        mother = nums_from_text(m.get("motherboard", ""))
-        for n in mother:
-            if len(two_nums) < 3 and n not in two_nums:
-                two_nums.append(n)
-            if len(three_nums) < 5 and n not in three_nums:
-                three_nums.append(n)
-            if len(four_nums) < 6 and n not in four_nums:
-                four_nums.append(n)
-
-        # 最後防呆，避免任何情況下不足顆數
-        for n in range(1, 40):
-            if len(two_nums) < 3 and n not in two_nums:
-                two_nums.append(n)
-            if len(three_nums) < 5 and n not in three_nums:
-                three_nums.append(n)
-            if len(four_nums) < 6 and n not in four_nums:
-                four_nums.append(n)
-            if len(two_nums) >= 3 and len(three_nums) >= 5 and len(four_nums) >= 6:
-                break
+@traced
+def compute_bet_plan(total, mode, pack):
+    """
+    539 點數配置的計算步驟，回傳結構化結果（dict），不含訊息文字。
+    pack 為今日母盤快取；None 或資料異常時使用備援號碼。
+    """
+    cfg = BET_PLAN_MODES.get(mode, BET_PLAN_MODES["balanced"])
 
-        two_nums = sorted(two_nums[:3])
-        three_nums = sorted(three_nums[:5])
-        four_nums = sorted(four_nums[:6])
-    except Exception as e:
-        print("BUILD_BET_PLAN_NUMBERS_ERROR:", repr(e))
-        two_nums = [18, 21, 33]
-        three_nums = [8, 18, 21, 33, 36]
-        four_nums = [4, 8, 18, 21, 27, 33]
+    two_nums = [18, 21, 33]
+    three_nums = [8, 18, 21, 33, 36]
+    four_nums = [4, 8, 18, 21, 27, 33]
+    if pack is not None:
+        try:
+            two_nums, three_nums, four_nums = _bet_plan_numbers(pack)
+        except Exception as e:
+            log_event(logging.ERROR, "build_bet_plan_numbers_error", error=repr(e))
 
-    # 固定顆數 / 碰數，與今日陪跑對齊
-    c2, c3, c4 = 3, 10, 15
-    odd2, odd3, odd4 = 70.44, 840, 12000
+    # 碰數 = C(顆數, 星數)，與今日陪跑對齊（3/5/6 顆 → 3/10/15 碰）
+    c2 = math.comb(len(two_nums), 2)
+    c3 = math.comb(len(three_nums), 3)
+    c4 = math.comb(len(four_nums), 4)
+    odd2, odd3, odd4 = BET_ODDS_539[2], BET_ODDS_539[3], BET_ODDS_539[4]
 
     amt2 = int(total * cfg["p2"])
     amt3 = int(total * cfg["p3"])
@@ -1436,47 +3717,72 @@ def build_bet_plan(total, mode="balanced"):
     per3 = max(1, amt3 // c3)
     per4 = max(1, amt4 // c4)
 
-    real2 = per2 * c2
-    real3 = per3 * c3
-    real4 = per4 * c4
-    real_total = real2 + real3 + real4
+    return {
+        "total": total,
+        "name": cfg["name"],
+        "desc": cfg["desc"],
+        "two_nums": two_nums,
+        "three_nums": three_nums,
+        "four_nums": four_nums,
+        "combos": (c2, c3, c4),
+        "per": (per2, per3, per4),
+        "real": (per2 * c2, per3 * c3, per4 * c4),
+        "real_total": per2 * c2 + per3 * c3 + per4 * c4,
+        "win": (int(per2 * odd2), int(per3 * odd3), int(per4 * odd4)),
+        "coverage": bet_coverage_539(
+            ((two_nums, 2), (three_nums, 3), (four_nums, 4)),
+            (per2, per3, per4)
+        ),
+    }
 
-    win2 = int(per2 * odd2)
-    win3 = int(per3 * odd3)
-    win4 = int(per4 * odd4)
 
-    two_combo_text = (
-        f"{two_nums[0]:02d}-{two_nums[1]:02d}\n"
-        f"{two_nums[0]:02d}-{two_nums[2]:02d}\n"
-        f"{two_nums[1]:02d}-{two_nums[2]:02d}"
-    )
+def render_bet_plan(plan):
+    def money(x):
+        return f"{int(x):,}"
+
+    def fmt_nums(nums):
+        return " ".join([f"{n:02d}" for n in nums])
+
+    def pct(x):
+        return f"{x * 100:.2f}%"
+
+    two_nums = plan["two_nums"]
+    c2, c3, c4 = plan["combos"]
+    per2, per3, per4 = plan["per"]
+    real2, real3, real4 = plan["real"]
+    win2, win3, win4 = plan["win"]
+    cov = plan["coverage"]
+    prob2, prob3, prob4 = cov["hit_prob"]
+    max2, max3, max4 = cov["max_hits"]
+
+    two_combo_text = "\n".join([f"{a:02d}-{b:02d}" for a, b in combinations(two_nums, 2)])
 
     return (
-        f"【539 點數配置｜{money(total)}點】\n\n"
-        f"模式：{cfg['name']}\n"
-        f"策略：{cfg['desc']}\n\n"
+        f"【539 點數配置｜{money(plan['total'])}點】\n\n"
+        f"模式：{plan['name']}\n"
+        f"策略：{plan['desc']}\n\n"
 
         "▍使用號碼（直接照下）\n\n"
 
         f"2星：{fmt_nums(two_nums)}\n"
-        "👉 選3顆，全碰\n"
+        f"👉 選{len(two_nums)}顆，全碰\n"
         f"{two_combo_text}\n"
-        "共3碰\n\n"
+        f"共{c2}碰\n\n"
 
-        f"3星：{fmt_nums(three_nums)}\n"
-        "👉 任選3顆組合，共10碰\n\n"
+        f"3星：{fmt_nums(plan['three_nums'])}\n"
+        f"👉 任選3顆組合，共{c3}碰\n\n"
 
-        f"4星：{fmt_nums(four_nums)}\n"
-        "👉 任選4顆組合，共15碰\n\n"
+        f"4星：{fmt_nums(plan['four_nums'])}\n"
+        f"👉 任選4顆組合，共{c4}碰\n\n"
 
         "━━━━━━━━━━━━━━━\n\n"
 
         "▍點數分配\n\n"
-        f"2星：每碰 {money(per2)} × 3碰 = {money(real2)}\n"
-        f"3星：每碰 {money(per3)} × 10碰 = {money(real3)}\n"
-        f"4星：每碰 {money(per4)} × 15碰 = {money(real4)}\n\n"
+        f"2星：每碰 {money(per2)} × {c2}碰 = {money(real2)}\n"
+        f"3星：每碰 {money(per3)} × {c3}碰 = {money(real3)}\n"
+        f"4星：每碰 {money(per4)} × {c4}碰 = {money(real4)}\n\n"
 
-        f"實際投入：約 {money(real_total)} 點\n\n"
+        f"實際投入：約 {money(plan['real_total'])} 點\n\n"
 
         "━━━━━━━━━━━━━━━\n\n"
 
@@ -1485,6 +3791,13 @@ def build_bet_plan(total, mode="balanced"):
         f"中3星：約 {money(win3)}\n"
         f"中4星：約 {money(win4)}\n\n"
 
+        "▍命中機率（全部 575,757 種開獎精算）\n\n"
+        f"2星：至少中1碰 {pct(prob2)}｜最多中{max2}碰\n"
+        f"3星：至少中1碰 {pct(prob3)}｜最多中{max3}碰\n"
+        f"4星：至少中1碰 {pct(prob4)}｜最多中{max4}碰\n"
+        f"任一星級命中：{pct(cov['any_prob'])}\n"
+        f"期望回收：約 {money(cov['expected_return'])} 點\n\n"
+
         "━━━━━━━━━━━━━━━\n\n"
 
         "▍下注說明\n\n"
@@ -1496,9 +3809,54 @@ def build_bet_plan(total, mode="balanced"):
         "（點數配置僅供策略參考）"
     )
 
+
+def render_standard_bet_plans(pack):
+    return {
+        f"{mode}-{total}": render_bet_plan(compute_bet_plan(total, mode, pack))
+        for mode, total in BET_PLAN_STANDARD
+    }
+
+
+@functools.lru_cache(maxsize=256)
+def _bet_plan_text(pick_date, total, mode):
+    pack = get_or_build_pick_539(pick_date)
+    text = (pack.get("rendered") or {}).get("bet_plans", {}).get(f"{mode}-{total}")
+    if text:
+        return text
+    return render_bet_plan(compute_bet_plan(total, mode, pack))
+
+
+def build_bet_plan(total, mode="balanced"):
+    """
+    539 點數配置：
+    - 直接引用今日陪跑號碼
+    - 顯示 2/3/4 星要選幾顆、共幾碰
+    - 不展開全部組合，避免畫面太亂
+    選單固定金額在建立母盤時已算好，其餘金額以 (日期, 金額, 模式) 做 LRU 快取。
+    """
+    try:
+        total = int(total)
+    except Exception:
+        total = 3000
+
+    if total <= 0:
+        total = 3000
+
+    if mode not in BET_PLAN_MODES:
+        mode = "balanced"
+
+    try:
+        hits = _bet_plan_text.cache_info().hits
+        text = _bet_plan_text(datetime.now(TZ_TW).date(), total, mode)
+        count_cache("bet_plan", _bet_plan_text.cache_info().hits > hits)
+        return text
+    except Exception as e:
+        log_event(logging.ERROR, "build_bet_plan_numbers_error", error=repr(e))
+        return render_bet_plan(compute_bet_plan(total, mode, None))
+
 def reply_bet_plan_menu(reply_token: str):
     if not CHANNEL_ACCESS_TOKEN:
-        print("CHANNEL_ACCESS_TOKEN empty")
+        log_event(logging.WARNING, "channel_access_token_empty")
         return
 
     payload = {
@@ -1522,9 +3880,10 @@ def reply_bet_plan_menu(reply_token: str):
         ]
     }
 
+    started = time.perf_counter()
     try:
         r = requests.post(
-            "https://api.line.me/v2/bot/message/reply",
+            f"{LINE_API_BASE}/v2/bot/message/reply",
             headers={
                 "Authorization": f"Bearer {CHANNEL_ACCESS_TOKEN}",
                 "Content-Type": "application/json"
@@ -1532,28 +3891,371 @@ def reply_bet_plan_menu(reply_token: str):
             json=payload,
             timeout=10
         )
-        print("LINE BET MENU STATUS:", r.status_code)
+        _observe_line("reply", started, r.status_code)
+        log_sampled("line_bet_menu", status=r.status_code)
         if r.status_code >= 400:
-            print("LINE BET MENU BODY:", r.text[:500])
+            log_event(logging.WARNING, "line_bet_menu_failed", status=r.status_code, body=r.text[:500])
     except Exception as e:
-        print("LINE BET MENU EXCEPTION:", repr(e))
+        _observe_line("reply", started, None)
+        log_event(logging.ERROR, "line_bet_menu_exception", error=repr(e))
+
+
+# =========================
+# Bingo 位元集合
+# =========================
+# 號碼 n 對應第 n 個 bit（bit 0 不用），一期 20 個號碼就是一個 81-bit 整數
+BINGO_ZONE_MASKS = tuple(((1 << 20) - 1) << (1 + 20 * z) for z in range(4))
+
+
+def bingo_mask(nums):
+    mask = 0
+    for n in nums:
+        mask |= 1 << n
+    return mask
+
+
+def bingo_mask_numbers(mask):
+    out = []
+    while mask:
+        low = mask & -mask
+        out.append(low.bit_length() - 1)
+        mask ^= low
+    return out
+
+
+def bingo_mask_zone_counts(masks):
+    """各區段（1-20/21-40/41-60/61-80）在所有期數的出現次數。"""
+    counts = [0, 0, 0, 0]
+    for m in masks:
+        for z, zm in enumerate(BINGO_ZONE_MASKS):
+            counts[z] += (m & zm).bit_count()
+    return counts
+
+
+def bingo_mask_frequency(masks):
+    """
+    以 bit-sliced 計數器一次累加 80 個號碼：planes[i] 存每個號碼計數的第 i 位，
+    每期只需幾次整數位元運算；回傳 index 為號碼的 list（長度 81）。
+    """
+    planes = []
+    for m in masks:
+        carry = m
+        i = 0
+        while carry:
+            if i == len(planes):
+                planes.append(0)
+            p = planes[i]
+            planes[i] = p ^ carry
+            carry = p & carry
+            i += 1
+
+    freq = [0] * 81
+    for i, p in enumerate(planes):
+        for n in bingo_mask_numbers(p):
+            freq[n] += 1 << i
+    return freq
+
+
+def bingo_consecutive_overlaps(masks):
+    """相鄰兩期重複開出的號碼數。"""
+    return [(a & b).bit_count() for a, b in zip(masks, masks[1:])]
+
+
+class BingoDraw:
+    """單期開獎：號碼存成一個位元遮罩，時間存成當日分鐘數。"""
+
+    __slots__ = ("period", "minute", "mask")
+
+    def __init__(self, period, numbers=(), time="", mask=None):
+        self.period = int(period)
+        self.mask = bingo_mask(numbers) if mask is None else mask
+        if time:
+            hh, mm = time.split(":")
+            self.minute = int(hh) * 60 + int(mm)
+        else:
+            self.minute = -1
+
+    @property
+    def numbers(self):
+        return bingo_mask_numbers(self.mask)
+
+    @property
+    def time(self):
+        return f"{self.minute // 60:02d}:{self.minute % 60:02d}" if self.minute >= 0 else ""
+
+    def overlap(self, other):
+        return (self.mask & other.mask).bit_count()
+
+    def as_dict(self):
+        return {"period": str(self.period), "time": self.time, "numbers": self.numbers}
+
+
+class BingoDrawHistory:
+    """
+    長期歷史的欄式儲存：每期只佔 20 bytes（期別 8 + 遮罩低 64 位 8 + 高位 2 + 分鐘 2），
+    10,000 期約 200KB；掃描時直接拿遮罩做位元運算。資料依期別由舊到新 append。
+    """
+
+    def __init__(self):
+        self.periods = array("Q")
+        self.lo = array("Q")
+        self.hi = array("H")
+        self.minutes = array("h")
+
+    def __len__(self):
+        return len(self.periods)
+
+    def append(self, draw):
+        # bit 0 不用，右移一位後剛好 80 bits
+        packed = draw.mask >> 1
+        self.periods.append(draw.period)
+        self.lo.append(packed & 0xFFFFFFFFFFFFFFFF)
+        self.hi.append(packed >> 64)
+        self.minutes.append(draw.minute)
+
+    def mask(self, i):
+        return ((self.hi[i] << 64) | self.lo[i]) << 1
+
+    def masks(self, start=0, stop=None):
+        stop = len(self) if stop is None else stop
+        hi, lo = self.hi, self.lo
+        return [((hi[i] << 64) | lo[i]) << 1 for i in range(start, stop)]
+
+    def __getitem__(self, i):
+        d = BingoDraw(self.periods[i], mask=self.mask(i))
+        d.minute = self.minutes[i]
+        return d
+
+    def recent(self, limit):
+        """最新的 limit 期，由新到舊的 BingoDraw。"""
+        n = len(self)
+        return [self[i] for i in range(n - 1, max(n - limit, 0) - 1, -1)]
+
+    def nbytes(self):
+        return sum(a.itemsize * len(a) for a in (self.periods, self.lo, self.hi, self.minutes))
+
+
+def as_bingo_draw(draw):
+    """解析結果 / 舊格式的 dict 轉成 BingoDraw；已是 BingoDraw 直接回傳。"""
+    if isinstance(draw, BingoDraw):
+        return draw
+    return BingoDraw(draw["period"], draw["numbers"], draw.get("time") or "")
+
+
+# =========================
+# Bingo 開獎資料
+# =========================
+BINGO_PERIOD_PATTERN = re.compile(r"(?<!\d)(\d{9})(?!\d)")
+BINGO_DATE_PATTERN = re.compile(r"(\d{4})[/-](\d{1,2})[/-](\d{1,2})")
+BINGO_TIME_PATTERN = re.compile(r"(?<!\d)(\d{1,2}):(\d{2})(?!\d)")
+BINGO_NUM_PATTERN = re.compile(r"(?<!\d)(\d{2})(?!\d)")
+
+
+def bingo_source_enabled() -> bool:
+    return bool(SOURCE_BINGO_URL or BINGO_SOURCE_FILE)
+
+
+def parse_bingo_results(html: str, default_date=None):
+    """
+    解析官方格式開獎結果（每期：9碼期別、開獎時間、20個號碼）。
+    回傳 [{"period", "time", "numbers", "draw_time"}, ...]，依期別由新到舊。
+    """
+    text = re.sub(r"<[^>]+>", " ", html or "")
+    default_date = default_date or datetime.now(TZ_TW).date()
+    m = BINGO_DATE_PATTERN.search(text)
+    if m:
+        try:
+            default_date = date(int(m.group(1)), int(m.group(2)), int(m.group(3)))
+        except ValueError:
+            pass
+
+    matches = list(BINGO_PERIOD_PATTERN.finditer(text))
+    out = {}
+    for i, m in enumerate(matches):
+        seg = text[m.end():matches[i + 1].start() if i + 1 < len(matches) else len(text)]
+
+        draw_time = None
+        tm = BINGO_TIME_PATTERN.search(seg)
+        if tm:
+            hh, mm = int(tm.group(1)), int(tm.group(2))
+            if hh < 24 and mm < 60:
+                draw_time = datetime(
+                    default_date.year, default_date.month, default_date.day, hh, mm, tzinfo=TZ_TW
+                )
+            seg = seg[:tm.start()] + " " + seg[tm.end():]
+
+        nums = []
+        for nm in BINGO_NUM_PATTERN.finditer(seg):
+            n = int(nm.group(1))
+            if 1 <= n <= 80 and n not in nums:
+                nums.append(n)
+            if len(nums) >= 20:
+                break
+        if len(nums) != 20:
+            continue
+
+        period = m.group(1)
+        out[period] = {
+            "period": period,
+            "time": draw_time.strftime("%H:%M") if draw_time else "",
+            "numbers": sorted(nums),
+            "draw_time": draw_time,
+        }
+
+    return [out[k] for k in sorted(out, key=int, reverse=True)]
+
+
+@traced
+def fetch_bingo_source():
+    if BINGO_SOURCE_FILE:
+        with open(BINGO_SOURCE_FILE, "r", encoding="utf-8") as f:
+            return f.read()
+    r = requests.get(
+        SOURCE_BINGO_URL,
+        timeout=15,
+        headers={"User-Agent": "Mozilla/5.0"}
+    )
+    r.encoding = "utf-8"
+    return r.text
+
+
+@observe_db
+def upsert_bingo_draws(draws):
+    """以期別為鍵寫入，已存在的期別略過；回傳新寫入筆數。"""
+    if not draws:
+        return 0
+    now_tw = datetime.now(TZ_TW)
+    conn = get_conn()
+    cur = conn.cursor()
+    inserted = execute_values(cur, """
+        INSERT INTO bingo_draws (period, draw_time, numbers, created_at)
+        VALUES %s
+        ON CONFLICT (period) DO NOTHING
+        RETURNING period;
+    """, [
+        (int(d["period"]), d.get("draw_time"), " ".join([f"{n:02d}" for n in d["numbers"]]), now_tw)
+        for d in draws
+    ], fetch=True)
+    conn.commit()
+    cur.close()
+    conn.close()
+    return len(inserted)
+
+
+@observe_db
+def load_bingo_draws(limit=BINGO_RING_SIZE):
+    """由新到舊讀取最近 limit 期，回傳 BingoDraw。"""
+    conn = get_conn()
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT period, draw_time, numbers
+        FROM bingo_draws
+        ORDER BY period DESC
+        LIMIT %s;
+    """, (limit,))
+    rows = cur.fetchall()
+    cur.close()
+    conn.close()
+
+    out = []
+    for period, draw_time, numbers in rows:
+        try:
+            nums = [int(x) for x in numbers.split()]
+        except Exception:
+            continue
+        if len(nums) != 20:
+            continue
+        out.append(BingoDraw(
+            period,
+            nums,
+            draw_time.astimezone(TZ_TW).strftime("%H:%M") if draw_time else ""
+        ))
+    return out
+
+
+def load_bingo_history(limit=BINGO_RING_SIZE):
+    """讀取最近 limit 期為 BingoDrawHistory（由舊到新）。"""
+    history = BingoDrawHistory()
+    for d in reversed(load_bingo_draws(limit=limit)):
+        history.append(d)
+    return history
+
+
+class BingoRing:
+    """
+    最近 N 期的記憶體緩衝，底層為 BingoDrawHistory（每期 20 bytes）。
+    每隔 ttl 秒或收到新資料時才重新讀取資料庫，分析函式直接讀這裡。
+    """
+
+    def __init__(self, size=BINGO_RING_SIZE, ttl=30):
+        self.size = size
+        self.history = BingoDrawHistory()
+        self.ttl = ttl
+        self.loaded_at = 0.0
+        self.lock = threading.Lock()
+
+    def reload(self):
+        history = load_bingo_history(limit=self.size)
+        with self.lock:
+            self.history = history
+            self.loaded_at = datetime.now(TZ_TW).timestamp()
+
+    def recent(self, limit):
+        if datetime.now(TZ_TW).timestamp() - self.loaded_at > self.ttl:
+            self.reload()
+        with self.lock:
+            return self.history.recent(limit)
+
+    def latest_period(self):
+        if datetime.now(TZ_TW).timestamp() - self.loaded_at > self.ttl:
+            self.reload()
+        with self.lock:
+            history = self.history
+            return str(history.periods[-1]) if len(history) else None
+
+
+BINGO_RING = BingoRing()
+
+
+def ingest_bingo_draws():
+    """抓取 / 讀取開獎結果並補齊缺期（重複執行不會重複寫入）。"""
+    if not bingo_source_enabled():
+        return 0
+    draws = parse_bingo_results(fetch_bingo_source())
+    inserted = upsert_bingo_draws(draws)
+    if inserted:
+        BINGO_RING.reload()
+    return inserted
 
 
 # =========================
 # Bingo 備援模式
 # =========================
-def fetch_recent_bingo_results(max_rows: int = 60):
-    now = datetime.now(TZ_TW)
+def _current_bingo_index(now=None):
+    """回傳 (當日首期時間, 目前期數 index)；非開獎時段回傳 (首期時間, None)。"""
+    now = now or datetime.now(TZ_TW)
     start_dt = now.replace(hour=7, minute=5, second=0, microsecond=0)
 
     if now < start_dt:
-        return []
+        return start_dt, None
 
     minutes_passed = int((now - start_dt).total_seconds() // 60)
     current_index = minutes_passed // 5
 
     max_index = ((23 - 7) * 60 + (55 - 5)) // 5
     if current_index < 0 or current_index > max_index:
+        return start_dt, None
+    return start_dt, current_index
+
+
+def fetch_recent_bingo_results(max_rows: int = 60):
+    if bingo_source_enabled():
+        draws = BINGO_RING.recent(max_rows)
+        if draws:
+            return draws
+
+    start_dt, current_index = _current_bingo_index()
+    if current_index is None:
         return []
 
     draws = []
@@ -1565,37 +4267,92 @@ def fetch_recent_bingo_results(max_rows: int = 60):
         draw_dt = start_dt + timedelta(minutes=idx * 5)
         period = f"{draw_dt.strftime('%Y%m%d')}{idx:03d}"
         rng = random.Random(f"bingo-backup-{period}")
-        nums = sorted(rng.sample(range(1, 81), 20))
+        nums = rng.sample(range(1, 81), 20)
 
-        draws.append({
-            "period": period,
-            "time": draw_dt.strftime("%H:%M"),
-            "numbers": nums
-        })
+        draws.append(BingoDraw(period, nums, draw_dt.strftime("%H:%M")))
 
     return draws
 
 
+BINGO_ZONE_NAMES = ("1-20", "21-40", "41-60", "61-80")
+
+
+def _bingo_summary_from_counts(freq, zones, top=4):
+    hot_zone = BINGO_ZONE_NAMES[max(range(4), key=zones.__getitem__)]
+    hot_samples = heapq.nlargest(top, range(1, 81), key=freq.__getitem__)
+    freq_dict = {n: freq[n] for n in range(1, 81)}
+    return hot_zone, "・".join([f"{n:02d}" for n in hot_samples]), freq_dict
+
+
 def bingo_zone_summary(draws):
-    zones = {"1-20": 0, "21-40": 0, "41-60": 0, "61-80": 0}
-    freq = {i: 0 for i in range(1, 81)}
-
-    for draw in draws:
-        for n in draw["numbers"]:
-            freq[n] += 1
-            if 1 <= n <= 20:
-                zones["1-20"] += 1
-            elif 21 <= n <= 40:
-                zones["21-40"] += 1
-            elif 41 <= n <= 60:
-                zones["41-60"] += 1
-            else:
-                zones["61-80"] += 1
+    """一次性統計（不維持狀態）；回傳 (活躍區段, 高頻樣本字串, 頻率 dict)。"""
+    masks = [as_bingo_draw(d).mask for d in draws]
+    return _bingo_summary_from_counts(bingo_mask_frequency(masks), bingo_mask_zone_counts(masks))
+
 
-    hot_zone = max(zones.items(), key=lambda x: x[1])[0]
-    hot_samples = sorted(freq.items(), key=lambda x: x[1], reverse=True)[:4]
-    hot_samples_str = "・".join([f"{n:02d}" for n, _ in hot_samples])
-    return hot_zone, hot_samples_str, freq
+class BingoWindowStats:
+    """
+    多個視窗（例如 1/5/10/20/50 期）同時維持號碼頻率與區段計數。
+    每來一期只加新開獎、扣掉各視窗最舊那期，更新成本 O(20 × 視窗數)；
+    離開視窗的那期從最近幾期的位元遮罩取得。
+    """
+
+    def __init__(self, windows=BINGO_WINDOWS):
+        self.windows = tuple(sorted(set(windows)))
+        # 多留一期：push 之後 masks[-w - 1] 就是剛離開視窗 w 的那期
+        self.periods = deque(maxlen=max(self.windows))
+        self.masks = deque(maxlen=max(self.windows) + 1)
+        self.freq = {w: [0] * 81 for w in self.windows}
+        self.zones = {w: [0] * 4 for w in self.windows}
+        self.lock = threading.Lock()
+
+    def reset(self):
+        self.periods.clear()
+        self.masks.clear()
+        for w in self.windows:
+            self.freq[w] = [0] * 81
+            self.zones[w] = [0] * 4
+
+    def push(self, draw):
+        self.periods.append(draw.period)
+        self.masks.append(draw.mask)
+        added = bingo_mask_numbers(draw.mask)
+        for w in self.windows:
+            freq = self.freq[w]
+            zones = self.zones[w]
+            for n in added:
+                freq[n] += 1
+                zones[(n - 1) // 20] += 1
+            if len(self.masks) > w:
+                for n in bingo_mask_numbers(self.masks[-w - 1]):
+                    freq[n] -= 1
+                    zones[(n - 1) // 20] -= 1
+
+    def sync(self, draws):
+        """
+        draws 為由新到舊的 BingoDraw；只推進目前最新一期之後的新期數。
+        對不上（換日、資料來源重整）時整批重建。
+        """
+        with self.lock:
+            latest = self.periods[-1] if self.periods else None
+            new = None
+            for i, d in enumerate(draws):
+                if d.period == latest:
+                    new = draws[:i]
+                    break
+            if new is None:
+                self.reset()
+                new = draws[:self.periods.maxlen]
+            for d in reversed(new):
+                self.push(d)
+
+    def summary(self, window, top=4):
+        """回傳 (活躍區段, 高頻樣本字串, 頻率 dict)，與 bingo_zone_summary 相同格式。"""
+        with self.lock:
+            return _bingo_summary_from_counts(self.freq[window], self.zones[window], top)
+
+
+BINGO_STATS = BingoWindowStats()
 
 
 def _time_bucket(minutes_step: int):
@@ -1607,101 +4364,176 @@ def _weighted_pick_bingo(freq_dict, seed_text: str):
     rng = random.Random(seed_text)
 
     max_f = max(freq_dict.values()) or 1
-    weights = {}
-    for n in range(1, 81):
-        weights[n] = (freq_dict[n] / max_f) + 0.05
-
-    chosen = []
-    pool = dict(weights)
-    while len(chosen) < 5 and pool:
-        total = sum(pool.values())
-        r = rng.uniform(0, total)
-        acc = 0
-        pick = None
-        for n, w in pool.items():
-            acc += w
-            if r <= acc:
-                pick = n
-                break
-        if pick is None:
-            pick = rng.choice(list(pool.keys()))
-        chosen.append(pick)
-        pool.pop(pick, None)
+    pool = list(range(1, 81))
+    weights = [(freq_dict[n] / max_f) + 0.05 for n in pool]
 
-    chosen = sorted(chosen[:5])
+    chosen = sorted(weighted_sample_without_replacement(pool, weights, 5, rng))
     return " ".join([f"{n:02d}" for n in chosen])
 
 
-def get_bingo_analysis_bundle():
-    try:
-        draws = fetch_recent_bingo_results(max_rows=30)
-    except Exception as e:
-        print("GET_BINGO_ANALYSIS_BUNDLE ERROR:", repr(e))
-        draws = []
+BINGO_BUNDLE_FALLBACK = {
+    "one": "07 19 34 52 71",
+    "five": "05 22 31 46 68",
+    "ten": "09 18 27 55 79",
+    "one_zone": "21-40",
+    "five_zone": "21-40",
+    "ten_zone": "41-60",
+    "one_hot": "07・19・34・52",
+    "five_hot": "05・22・31・46",
+    "ten_hot": "09・18・27・55",
+    "latest": None
+}
+
+_BINGO_BUNDLE_MEMO = {}
+_BINGO_BUNDLE_LOCK = threading.Lock()
+_BINGO_BUNDLE_MEMO_SIZE = 8
+
+
+def _bingo_bundle_key():
+    """
+    分析結果只跟「目前期數」與 5/15/25 分鐘時間桶有關；
+    三種時間桶邊界都落在 5 分鐘上，所以同一期內 key 不變。
+    """
+    idx = None
+    if bingo_source_enabled():
+        try:
+            idx = BINGO_RING.latest_period()
+        except Exception as e:
+            log_event(logging.ERROR, "bingo_ring_error", error=repr(e))
+    if idx is None:
+        _, idx = _current_bingo_index()
+    seed_base = datetime.now(TZ_TW).strftime("%Y%m%d")
+    return f"{seed_base}-{idx}-{_time_bucket(5)}-{_time_bucket(15)}-{_time_bucket(25)}"
+
+
+@traced
+def _build_bingo_analysis_bundle(draws, stats=None):
+    if not draws:
+        return dict(BINGO_BUNDLE_FALLBACK)
+
+    draws = [as_bingo_draw(d) for d in draws]
+    stats = stats or BINGO_STATS
+    stats.sync(draws)
+
+    # bundle 會存進 Postgres 快取，只有最新一期轉成 dict
+    latest = draws[0].as_dict()
+    summaries = {w: stats.summary(w) for w in stats.windows}
+    zone1, hot1, freq1 = summaries[1]
+    zone5, hot5, freq5 = summaries[5]
+    zone10, hot10, freq10 = summaries[10]
+    # 最新一期與上一期重複開出的號碼數
+    overlaps = bingo_consecutive_overlaps([d.mask for d in draws[:2]])
+
+    seed_base = datetime.now(TZ_TW).strftime("%Y%m%d")
+    one = _weighted_pick_bingo(freq1, f"{seed_base}-b1-{_time_bucket(5)}")
+    five = _weighted_pick_bingo(freq5, f"{seed_base}-b5-{_time_bucket(15)}")
+    ten = _weighted_pick_bingo(freq10, f"{seed_base}-b10-{_time_bucket(25)}")
+
+    seen = {one}
+    if five in seen:
+        five = _weighted_pick_bingo(freq5, f"{seed_base}-b5-alt-{_time_bucket(15)}")
+    seen.add(five)
+    if ten in seen:
+        ten = _weighted_pick_bingo(freq10, f"{seed_base}-b10-alt-{_time_bucket(25)}")
+
+    return {
+        "one": one,
+        "five": five,
+        "ten": ten,
+        "one_zone": zone1,
+        "five_zone": zone5,
+        "ten_zone": zone10,
+        "one_hot": hot1,
+        "five_hot": hot5,
+        "ten_hot": hot10,
+        "latest": latest,
+        "repeat": overlaps[0] if overlaps else None,
+        "windows": {
+            str(w): {"zone": zone, "hot": hot}
+            for w, (zone, hot, _) in summaries.items()
+        }
+    }
+
+
+@observe_db
+def _load_bingo_bundle_pg(cache_key):
+    conn = get_conn()
+    cur = conn.cursor()
+    cur.execute("SELECT bundle FROM bingo_bundle_cache WHERE cache_key = %s;", (cache_key,))
+    row = cur.fetchone()
+    cur.close()
+    conn.close()
+    return json.loads(row[0]) if row else None
+
+
+@observe_db
+def _save_bingo_bundle_pg(cache_key, bundle):
+    conn = get_conn()
+    cur = conn.cursor()
+    cur.execute("""
+        INSERT INTO bingo_bundle_cache (cache_key, bundle, created_at)
+        VALUES (%s, %s, %s)
+        ON CONFLICT (cache_key) DO NOTHING;
+    """, (cache_key, json.dumps(bundle, ensure_ascii=False), datetime.now(TZ_TW)))
+    cur.execute("""
+        DELETE FROM bingo_bundle_cache
+        WHERE created_at < %s;
+    """, (datetime.now(TZ_TW) - timedelta(days=1),))
+    conn.commit()
+    cur.close()
+    conn.close()
+
+
+def get_bingo_analysis_bundle():
+    """
+    同一期（同一組時間桶）內重複點選只查一次 dict；
+    開啟 BINGO_BUNDLE_PG_CACHE 時多個 worker 共用 Postgres 上的結果。
+    """
+    cache_key = _bingo_bundle_key()
+    with _BINGO_BUNDLE_LOCK:
+        bundle = _BINGO_BUNDLE_MEMO.get(cache_key)
+    count_cache("bingo_bundle", bundle is not None)
+    if bundle is not None:
+        return bundle
+
+    if BINGO_BUNDLE_PG_CACHE:
+        try:
+            bundle = _load_bingo_bundle_pg(cache_key)
+        except Exception as e:
+            log_event(logging.ERROR, "bingo_bundle_pg_load_error", error=repr(e))
+
+    if bundle is None:
+        try:
+            draws = fetch_recent_bingo_results(max_rows=max(30, max(BINGO_WINDOWS)))
+        except Exception as e:
+            log_event(logging.ERROR, "get_bingo_analysis_bundle_error", error=repr(e))
+            draws = []
+
+        try:
+            with timed("pick_build_seconds", game="bingo"):
+                bundle = _build_bingo_analysis_bundle(draws)
+        except Exception as e:
+            log_event(logging.ERROR, "get_bingo_analysis_bundle_build_error", error=repr(e))
+            return dict(BINGO_BUNDLE_FALLBACK)
 
-    if not draws:
-        return {
-            "one": "07 19 34 52 71",
-            "five": "05 22 31 46 68",
-            "ten": "09 18 27 55 79",
-            "one_zone": "21-40",
-            "five_zone": "21-40",
-            "ten_zone": "41-60",
-            "one_hot": "07・19・34・52",
-            "five_hot": "05・22・31・46",
-            "ten_hot": "09・18・27・55",
-            "latest": None
-        }
+        if BINGO_BUNDLE_PG_CACHE:
+            try:
+                _save_bingo_bundle_pg(cache_key, bundle)
+            except Exception as e:
+                log_event(logging.ERROR, "bingo_bundle_pg_save_error", error=repr(e))
 
-    try:
-        latest = draws[0]
-        d1 = draws[:1]
-        d5 = draws[:5]
-        d10 = draws[:10]
-
-        zone1, hot1, freq1 = bingo_zone_summary(d1)
-        zone5, hot5, freq5 = bingo_zone_summary(d5)
-        zone10, hot10, freq10 = bingo_zone_summary(d10)
-
-        seed_base = datetime.now(TZ_TW).strftime("%Y%m%d")
-        one = _weighted_pick_bingo(freq1, f"{seed_base}-b1-{_time_bucket(5)}")
-        five = _weighted_pick_bingo(freq5, f"{seed_base}-b5-{_time_bucket(15)}")
-        ten = _weighted_pick_bingo(freq10, f"{seed_base}-b10-{_time_bucket(25)}")
-
-        seen = {one}
-        if five in seen:
-            five = _weighted_pick_bingo(freq5, f"{seed_base}-b5-alt-{_time_bucket(15)}")
-        seen.add(five)
-        if ten in seen:
-            ten = _weighted_pick_bingo(freq10, f"{seed_base}-b10-alt-{_time_bucket(25)}")
+    with _BINGO_BUNDLE_LOCK:
+        _BINGO_BUNDLE_MEMO[cache_key] = bundle
+        while len(_BINGO_BUNDLE_MEMO) > _BINGO_BUNDLE_MEMO_SIZE:
+            _BINGO_BUNDLE_MEMO.pop(next(iter(_BINGO_BUNDLE_MEMO)))
+    return bundle
 
-        return {
-            "one": one,
-            "five": five,
-            "ten": ten,
-            "one_zone": zone1,
-            "five_zone": zone5,
-            "ten_zone": zone10,
-            "one_hot": hot1,
-            "five_hot": hot5,
-            "ten_hot": hot10,
-            "latest": latest
-        }
 
-    except Exception as e:
-        print("GET_BINGO_ANALYSIS_BUNDLE BUILD ERROR:", repr(e))
-        return {
-            "one": "07 19 34 52 71",
-            "five": "05 22 31 46 68",
-            "ten": "09 18 27 55 79",
-            "one_zone": "21-40",
-            "five_zone": "21-40",
-            "ten_zone": "41-60",
-            "one_hot": "07・19・34・52",
-            "five_hot": "05・22・31・46",
-            "ten_hot": "09・18・27・55",
-            "latest": None
-        }
+def _bingo_repeat_line(b):
+    repeat = b.get("repeat")
+    if repeat is None:
+        return ""
+    return f"與上期重複\n{repeat} 個號碼\n\n"
 
 
 def format_bingo_1_message():
@@ -1716,6 +4548,7 @@ def format_bingo_1_message():
             f"{b['one_zone']}\n\n"
             "高頻樣本\n"
             f"{b['one_hot']}\n\n"
+            f"{_bingo_repeat_line(b)}"
             "數據觀察\n"
             "短線熱度集中在中區，\n"
             "高段號碼出現間隔拉長。\n\n"
@@ -1726,7 +4559,7 @@ def format_bingo_1_message():
         )
 
     except Exception as e:
-        print("FORMAT_BINGO_1 ERROR:", repr(e))
+        log_event(logging.ERROR, "format_bingo_1_error", error=repr(e))
         return (
             "【Bingo AI短線分析】\n\n"
             "1期分析\n"
@@ -1756,7 +4589,7 @@ def format_bingo_5_message():
         )
 
     except Exception as e:
-        print("FORMAT_BINGO_5 ERROR:", repr(e))
+        log_event(logging.ERROR, "format_bingo_5_error", error=repr(e))
         return (
             "【Bingo AI節奏分析】\n\n"
             "5期分析\n"
@@ -1785,7 +4618,7 @@ def format_bingo_10_message():
         )
 
     except Exception as e:
-        print("FORMAT_BINGO_10 ERROR:", repr(e))
+        log_event(logging.ERROR, "format_bingo_10_error", error=repr(e))
         return (
             "【Bingo AI結構分析】\n\n"
             "10期分析\n"
@@ -1810,7 +4643,7 @@ def format_bingo_evening_push():
             f"{quote}"
         )
     except Exception as e:
-        print("FORMAT_BINGO_EVENING ERROR:", repr(e))
+        log_event(logging.ERROR, "format_bingo_evening_error", error=repr(e))
         return "【理性陪跑研究室｜Bingo Bingo】\n\n07 19 34 52 71"
 
 
@@ -1855,6 +4688,58 @@ def health():
     return "OK", 200
 
 
+@app.route("/metrics")
+def metrics():
+    token = request.args.get("secret", "")
+    auth = request.headers.get("Authorization", "")
+    if auth.startswith("Bearer "):
+        token = auth[len("Bearer "):].strip()
+    if not hmac.compare_digest(token.encode("utf-8"), METRICS_TOKEN.encode("utf-8")):
+        abort(403)
+
+    METRICS.flush(force=True)
+    return Response(METRICS.render(), mimetype="text/plain; version=0.0.4")
+
+
+@app.before_request
+def _start_request_trace():
+    g.trace_state = _open_span(f"{request.method} {request.path}", {}, root=True)
+
+
+@app.after_request
+def _flush_metrics(response):
+    METRICS.flush()
+    trace_id = current_trace_id()
+    if trace_id:
+        response.headers["X-Trace-Id"] = trace_id
+    return response
+
+
+@app.teardown_request
+def _finish_request_trace(error=None):
+    state = g.pop("trace_state", None)
+    if state is not None:
+        state[1]["attrs"]["status"] = "error" if error is not None else "ok"
+    _close_span(state, error)
+
+
+@app.route("/debug/slow")
+def debug_slow():
+    """本 process 最近 TRACE_KEEP 條 trace 中最慢的幾條。"""
+    secret = request.args.get("secret", "")
+    if secret != CRON_SECRET:
+        abort(403)
+
+    try:
+        limit = max(1, min(int(request.args.get("limit", "20")), TRACE_KEEP))
+        min_ms = float(request.args.get("min_ms", "0"))
+    except ValueError:
+        abort(400)
+
+    body = {"pid": os.getpid(), "traces": slowest_traces(limit, min_ms)}
+    return Response(json.dumps(body, ensure_ascii=False, default=str), mimetype="application/json")
+
+
 # =========================
 # Cron Routes
 # =========================
@@ -1863,66 +4748,200 @@ def home():
     return "Bot is running.", 200
 
 
+def observe_cron(job):
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with timed("cron_job_seconds", job=job):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
 @app.route("/cron/daily-push")
+@observe_cron("daily_push")
 def cron_daily_push():
     secret = request.args.get("secret", "")
     if secret != CRON_SECRET:
         abort(403)
+    return run_daily_push()
 
+
+def run_daily_push(now=None):
+    """每日推播本體（cron route 與 cron_sim.py 共用），回傳 (訊息, 狀態碼)。"""
     try:
         init_db()
-        members = get_daily_push_users()
-        now = datetime.now(TZ_TW)
+        now = now or datetime.now(TZ_TW)
         today_key = now.strftime("%Y-%m-%d")
+        _sweep_members_once(now)
+        members = get_daily_push_users()
+        # 三種推播共用一份時間預算；沒送完的不標記 done，下次 cron 只補送剩下的人
+        run = PushRun()
+        incomplete = []
 
         # 到期前三天提醒
         reminder_key = f"expiry_reminder_{today_key}"
         if get_push_state(reminder_key) is None:
-            expiring_rows = get_expiring_members(days_before=3)
-            for uid, exp_dt in expiring_rows:
-                push_message(uid, format_expiry_reminder(exp_dt))
-            set_push_state(reminder_key, "done")
+            expiring_rows = get_expiring_members(days_before=3, today=now.date())
+            _, complete = deliver_pushes(
+                [(uid, format_expiry_reminder(exp_dt)) for uid, exp_dt in expiring_rows],
+                "expiry_reminder", reminder_key, run
+            )
+            if complete:
+                set_push_state(reminder_key, "done")
+                finish_pushes(reminder_key)
+            else:
+                incomplete.append("expiry_reminder")
+
+        _rotate_delivery_log_quietly(now.date())
 
         if not members:
             return "No active members", 200
 
+        sent = failed = 0
+        verb = "queued" if PUSH_OUTBOX_ENABLED else "pushed"
+
         # 539：週日不推
         if now.weekday() != 6:
             key_539 = f"daily_539_{today_key}"
-            if get_push_state(key_539) is None:
+            if get_push_state(key_539) is None and not run.stopped():
                 msg539 = format_539_push()
-                for uid in members:
-                    push_message(uid, msg539)
-                set_push_state(key_539, "done")
+                ok, complete = deliver_pushes([(uid, msg539) for uid in members], "daily_539", key_539, run)
+                sent = sent + ok
+                if complete:
+                    failed += len(members) - ok
+                    set_push_state(key_539, "done")
+                    finish_pushes(key_539)
+                else:
+                    incomplete.append("daily_539")
 
         # Bingo：每天都推
         key_bingo = f"daily_bingo_{today_key}"
-        if get_push_state(key_bingo) is None:
+        if get_push_state(key_bingo) is None and not run.stopped():
             msg_bingo = format_bingo_evening_push()
-            for uid in members:
-                push_message(uid, msg_bingo)
-            set_push_state(key_bingo, "done")
+            ok, complete = deliver_pushes([(uid, msg_bingo) for uid in members], "daily_bingo", key_bingo, run)
+            sent = sent + ok
+            if complete:
+                failed += len(members) - ok
+                set_push_state(key_bingo, "done")
+                finish_pushes(key_bingo)
+            else:
+                incomplete.append("daily_bingo")
 
-        return "OK", 200
+        if run.stopped():
+            return (
+                f"PARTIAL. {verb}={sent}, failed={failed}, stopped={run.reason}, "
+                f"incomplete={','.join(incomplete) or '-'}"
+            ), 200
+
+        _warmup_539_quietly(now)
+        return f"OK. {verb}={sent}, failed={failed}", 200
     except Exception as e:
-        print("CRON_DAILY_ERROR:", repr(e))
+        log_event(logging.ERROR, "cron_daily_error", error=repr(e))
         return "ERROR", 500
 
 
+def _sweep_members_once(now):
+    # 當天已由 /cron/sweep-members 跑過就不重跑；失敗時提醒仍讀前一次的結果
+    sweep_key = f"member_sweep_{now.strftime('%Y-%m-%d')}"
+    if get_push_state(sweep_key) is not None:
+        return
+    try:
+        result = sweep_members(now)
+        set_push_state(sweep_key, json.dumps(result))
+        log_event(logging.INFO, "member_sweep", **result)
+    except Exception as e:
+        log_event(logging.ERROR, "member_sweep_error", error=repr(e))
+
+
+@app.route("/cron/sweep-members")
+@observe_cron("sweep_members")
+def cron_sweep_members():
+    secret = request.args.get("secret", "")
+    if secret != CRON_SECRET:
+        abort(403)
+
+    try:
+        init_db()
+        now = datetime.now(TZ_TW)
+        result = sweep_members(now)
+        set_push_state(f"member_sweep_{now.strftime('%Y-%m-%d')}", json.dumps(result))
+        return f"OK. deactivated={result['deactivated']}, expiring={result['expiring']}", 200
+    except Exception as e:
+        log_event(logging.ERROR, "cron_sweep_members_error", error=repr(e))
+        return f"ERROR: {repr(e)}", 500
+
+
+def _rotate_delivery_log_quietly(today):
+    # 清理送達紀錄分區失敗不影響推播
+    if not DELIVERY_LOG_ENABLED:
+        return
+    try:
+        dropped = drop_old_delivery_partitions(today=today)
+        if dropped:
+            log_event(logging.INFO, "delivery_partitions_dropped", partitions=dropped)
+    except Exception as e:
+        log_event(logging.ERROR, "delivery_rotate_error", error=repr(e))
+
+
+def _warmup_539_quietly(now=None):
+    # 預熱失敗不影響推播結果，隔天第一位使用者仍會走即時建立
+    try:
+        status, pack = warmup_next_day_pick_539(now)
+        log_event(
+            logging.INFO, "warmup_539",
+            status=status, pick_date=pack["pick_date"], source_draw_date=pack.get("source_draw_date")
+        )
+    except Exception as e:
+        log_event(logging.ERROR, "warmup_539_error", error=repr(e))
+
+
+@app.route("/cron/warmup-539")
+@observe_cron("warmup_539")
+def cron_warmup_539():
+    """晚間開獎入庫後呼叫，預先建立明天的母盤與訊息。"""
+    secret = request.args.get("secret", "")
+    if secret != CRON_SECRET:
+        abort(403)
+
+    try:
+        init_db()
+        status, pack = warmup_next_day_pick_539()
+        warmed_at = pack.get("warmed_at")
+        return (
+            f"OK. {status} pick_date={pack['pick_date']} "
+            f"source_draw_date={pack.get('source_draw_date')} "
+            f"warmed_at={warmed_at.isoformat() if warmed_at else None}"
+        ), 200
+    except Exception as e:
+        log_event(logging.ERROR, "cron_warmup_539_error", error=repr(e))
+        return f"ERROR: {repr(e)}", 500
+
+
 @app.route("/cron/check-bingo")
+@observe_cron("check_bingo")
 def cron_check_bingo():
     secret = request.args.get("secret", "")
     if secret != CRON_SECRET:
         return "Forbidden: bad secret", 403
+    return run_check_bingo()
 
+
+def run_check_bingo(now=None):
+    """Bingo 即時推播本體（cron route 與 cron_sim.py 共用），回傳 (訊息, 狀態碼)。"""
     try:
         init_db()
 
-        now = datetime.now(TZ_TW)
+        now = now or datetime.now(TZ_TW)
         hhmm = now.strftime("%H:%M")
         if hhmm < "07:05" or hhmm > "23:55":
             return f"Outside draw hours: {hhmm}", 200
 
+        try:
+            ingest_bingo_draws()
+        except Exception as e:
+            log_event(logging.ERROR, "ingest_bingo_error", error=repr(e))
+
         period, msg = format_bingo_latest_push()
         if not period or not msg:
             return "No bingo data fetched", 200
@@ -1935,23 +4954,645 @@ def cron_check_bingo():
         if not users:
             return f"No prediction subscribers. Current period={period}", 200
 
-        success_count = 0
-        for uid in users:
-            ok = push_message(uid, msg)
-            if ok:
-                success_count += 1
+        push_key = f"bingo_latest_{period}"
+        success_count, complete = deliver_pushes([(uid, msg) for uid in users], "bingo_latest", push_key)
+        verb = "queued" if PUSH_OUTBOX_ENABLED else "pushed"
+        if not complete:
+            # 不更新 latest_bingo_period，下一次 check 補送同一期剩下的人
+            return f"PARTIAL. period={period}, {verb}={success_count}", 200
 
         set_push_state("latest_bingo_period", period)
-        return f"OK. period={period}, pushed={success_count}", 200
+        finish_pushes(push_key)
+        return f"OK. period={period}, {verb}={success_count}, failed={len(users) - success_count}", 200
+
+    except Exception as e:
+        log_event(logging.ERROR, "cron_bingo_error", error=repr(e))
+        return f"ERROR: {repr(e)}", 500
+
+
+@app.route("/cron/delivery-report")
+def cron_delivery_report():
+    """最近的推播 / 回覆失敗統計（JSON），?hours=24&job=daily_bingo。"""
+    secret = request.args.get("secret", "")
+    if secret != CRON_SECRET:
+        abort(403)
 
+    try:
+        init_db()
+        hours = max(1, min(int(request.args.get("hours", "24")), 24 * DELIVERY_RETENTION_DAYS))
+        limit = max(0, min(int(request.args.get("limit", "20")), 200))
+        report = delivery_failure_report(hours=hours, job=request.args.get("job") or None, limit=limit)
+        return Response(json.dumps(report, ensure_ascii=False), mimetype="application/json")
     except Exception as e:
-        print("CRON_BINGO_ERROR:", repr(e))
+        log_event(logging.ERROR, "cron_delivery_report_error", error=repr(e))
         return f"ERROR: {repr(e)}", 500
 
 
+# =========================
+# 流量限制
+# =========================
+# 每位使用者、每類指令一個 token bucket；設定格式「次數/秒數」，額度平均回補。
+# admin_fail 只在管理密碼錯誤時扣，用完即鎖定管理指令。
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "1").strip() != "0"
+RATE_LIMIT_DEFAULTS = {
+    "heavy": "8/60",
+    "account": "5/300",
+    "admin": "30/600",
+    "admin_fail": "5/900",
+    "light": "30/60",
+}
+# 列在這裡的類別改用 Postgres 滑動視窗，多個 worker 共用計數（例如 admin_fail）
+RATE_LIMIT_PG_CLASSES = {
+    x.strip() for x in os.getenv("RATE_LIMIT_PG_CLASSES", "").split(",") if x.strip()
+}
+RATE_LIMIT_MAX_KEYS = 50000
+
+COMMAND_CLASSES = {
+    "today_539": "heavy",
+    "bingo_1": "heavy",
+    "bingo_5": "heavy",
+    "bingo_10": "heavy",
+    "bingo_menu": "heavy",
+    "bet_menu": "heavy",
+    "bet_plan": "heavy",
+    "bet_custom": "heavy",
+    "join": "account",
+    "free_trial": "account",
+    "game_account": "account",
+    "admin_pending": "admin",
+    "admin_confirm": "admin",
+    "admin_deliveries": "admin",
+}
+
+SHED_REPLY = "操作太頻繁，請稍後再試。"
+ADMIN_LOCKED_REPLY = "管理密碼錯誤次數過多，請稍後再試。"
+
+
+def _parse_rate(spec):
+    count, _, seconds = spec.partition("/")
+    return max(1, int(count)), max(1.0, float(seconds or 60))
+
+
+RATE_LIMITS = {
+    cls: _parse_rate(os.getenv(f"RATE_LIMIT_{cls.upper()}", spec))
+    for cls, spec in RATE_LIMIT_DEFAULTS.items()
+}
+
+
+_RATE_LIMIT_WINDOW_SQL = """
+    SELECT COUNT(*) FILTER (WHERE NOT rejected), COALESCE(BOOL_OR(rejected), FALSE)
+    FROM rate_limit_hits
+    WHERE user_id = %s
+      AND command_class = %s
+      AND hit_at > NOW() - %s * INTERVAL '1 second';
+"""
+
+
+@observe_db
+def _rate_limit_pg_hit(user_id, command_class, capacity, seconds):
+    """
+    Postgres 滑動視窗版的 RateLimiter.hit。
+    以 advisory lock 讓同一使用者同一類別的判斷與寫入在各 worker 間互斥；
+    只有放行的請求計入額度，超量時只記一筆 rejected 標記（本視窗已回覆過提示）。
+    """
+    conn = get_conn()
+    cur = conn.cursor()
+    try:
+        cur.execute("SELECT pg_advisory_xact_lock(hashtext(%s));", (f"rate:{command_class}:{user_id}",))
+        cur.execute(_RATE_LIMIT_WINDOW_SQL, (user_id, command_class, seconds))
+        allowed, replied = cur.fetchone()
+        if allowed < capacity:
+            action = "allow"
+        elif not replied:
+            action = "reply"
+        else:
+            action = "drop"
+        if action != "drop":
+            cur.execute("""
+                INSERT INTO rate_limit_hits (user_id, command_class, hit_at, rejected)
+                VALUES (%s, %s, NOW(), %s);
+            """, (user_id, command_class, action == "reply"))
+        # 偶爾順手清掉一天前的紀錄
+        if random.random() < 0.01:
+            cur.execute("DELETE FROM rate_limit_hits WHERE hit_at < NOW() - INTERVAL '1 day';")
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+        conn.close()
+    return action
+
+
+@observe_db
+def _rate_limit_pg_count(user_id, command_class, seconds):
+    """視窗內已放行的次數。"""
+    conn = get_conn()
+    cur = conn.cursor()
+    cur.execute(_RATE_LIMIT_WINDOW_SQL, (user_id, command_class, seconds))
+    count = cur.fetchone()[0]
+    cur.close()
+    conn.close()
+    return count
+
+
+class RateLimiter:
+    """
+    in-memory token bucket，key 為 (user_id, 指令類別)。
+    bucket 為 [剩餘額度, 上次更新時間, 本輪是否已回覆過提示]。
+    """
+
+    def __init__(self, limits, pg_classes=()):
+        self.limits = limits
+        self.pg_classes = set(pg_classes)
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def _refill(self, key, b, now):
+        capacity, seconds = self.limits[key[1]]
+        b[0] = min(capacity, b[0] + (now - b[1]) * capacity / seconds)
+        b[1] = now
+
+    def _evict(self, now):
+        # 先丟已回滿的 bucket；還是太多就整個清掉（最壞情況只是多給一次額度）
+        for key in list(self.buckets):
+            b = self.buckets[key]
+            self._refill(key, b, now)
+            if b[0] >= self.limits[key[1]][0]:
+                del self.buckets[key]
+        if len(self.buckets) >= RATE_LIMIT_MAX_KEYS:
+            self.buckets.clear()
+
+    def hit(self, user_id, command_class):
+        """
+        消耗一次額度，回傳 "allow"、"reply"（本輪第一次超量，回覆提示）或 "drop"。
+        """
+        capacity, seconds = self.limits[command_class]
+        if command_class in self.pg_classes:
+            return _rate_limit_pg_hit(user_id, command_class, capacity, seconds)
+
+        now = time.monotonic()
+        key = (user_id, command_class)
+        with self.lock:
+            b = self.buckets.get(key)
+            if b is None:
+                if len(self.buckets) >= RATE_LIMIT_MAX_KEYS:
+                    self._evict(now)
+                b = self.buckets[key] = [float(capacity), now, False]
+            else:
+                self._refill(key, b, now)
+            if b[0] >= 1:
+                b[0] -= 1
+                b[2] = False
+                return "allow"
+            if b[2]:
+                return "drop"
+            b[2] = True
+            return "reply"
+
+    def exhausted(self, user_id, command_class):
+        """額度是否已用完（不消耗）。"""
+        capacity, seconds = self.limits[command_class]
+        if command_class in self.pg_classes:
+            return _rate_limit_pg_count(user_id, command_class, seconds) >= capacity
+
+        key = (user_id, command_class)
+        with self.lock:
+            b = self.buckets.get(key)
+            if b is None:
+                return False
+            self._refill(key, b, time.monotonic())
+            return b[0] < 1
+
+
+RATE_LIMITER = RateLimiter(RATE_LIMITS, RATE_LIMIT_PG_CLASSES)
+
+
+def shed_event(event):
+    """
+    超過該使用者該類指令的額度時回傳 True：本輪第一次回覆提示，之後直接丟棄。
+    限制器本身出錯時放行。
+    """
+    if not RATE_LIMIT_ENABLED or event.get("type") != "message":
+        return False
+    user_id = event.get("source", {}).get("userId")
+    if not user_id:
+        return False
+
+    command_class = COMMAND_CLASSES.get(command_of(event), "light")
+    try:
+        action = RATE_LIMITER.hit(user_id, command_class)
+    except Exception as e:
+        log_event(logging.ERROR, "rate_limit_error", error=repr(e))
+        return False
+    if action == "allow":
+        return False
+
+    METRICS.inc("webhook_shed_total", {"command_class": command_class, "action": action})
+    log_sampled("webhook_shed", command_class=command_class, action=action, user=user_ref(user_id))
+    if action == "reply" and event.get("replyToken"):
+        token = _DELIVERY_USER.set(user_id)
+        try:
+            reply_message(event["replyToken"], SHED_REPLY)
+        finally:
+            _DELIVERY_USER.reset(token)
+    return True
+
+
+def admin_locked(user_id):
+    if not RATE_LIMIT_ENABLED:
+        return False
+    try:
+        return RATE_LIMITER.exhausted(user_id, "admin_fail")
+    except Exception as e:
+        log_event(logging.ERROR, "rate_limit_error", error=repr(e))
+        return False
+
+
+def note_admin_failure(user_id):
+    METRICS.inc("admin_auth_failures_total")
+    log_event(logging.WARNING, "admin_auth_failed", user=user_ref(user_id))
+    if not RATE_LIMIT_ENABLED:
+        return
+    try:
+        RATE_LIMITER.hit(user_id, "admin_fail")
+    except Exception as e:
+        log_event(logging.ERROR, "rate_limit_error", error=repr(e))
+
+
 # =========================
 # Webhook
 # =========================
+COMMAND_EXACT = {
+    "申請加入會員": "join",
+    "賓果分析": "bingo_menu",
+    "免費試用": "free_trial",
+    "免費體驗": "free_trial",
+    "試用一天": "free_trial",
+    "免費使用1天": "free_trial",
+    "免費使用一天": "free_trial",
+    "點數配置": "bet_menu",
+    "指令": "help",
+    "help": "help",
+    "HELP": "help",
+    "我的到期日": "expiry",
+    "預測分析": "prediction_on",
+    "取消預測分析": "prediction_off",
+    "開啟每日推播": "daily_push_on",
+    "取消每日推播": "daily_push_off",
+    "今日陪跑": "today_539",
+    "1期": "bingo_1",
+    "賓果1期分析": "bingo_1",
+    "5期": "bingo_5",
+    "賓果5期分析": "bingo_5",
+    "10期": "bingo_10",
+    "賓果10期分析": "bingo_10",
+}
+
+COMMAND_PREFIX = (
+    (("穩健", "均衡", "爆發"), "bet_plan"),
+    (("下注",), "bet_custom"),
+    (("遊戲帳號 ",), "game_account"),
+    (("待確認 ",), "admin_pending"),
+    (("推播失敗 ",), "admin_deliveries"),
+    (("確認 ",), "admin_confirm"),
+)
+
+
+def command_of(event):
+    """把事件歸類成固定的指令名稱（metrics / log 用，避免 label 爆量）。"""
+    if event.get("type") != "message":
+        return event.get("type") or "unknown"
+    message = event.get("message", {})
+    if message.get("type") != "text":
+        return "non_text"
+
+    text = (message.get("text") or "").replace("\u3000", " ").strip()
+    if text in COMMAND_EXACT:
+        return COMMAND_EXACT[text]
+    for prefixes, name in COMMAND_PREFIX:
+        if text.startswith(prefixes):
+            return name
+    return "other"
+
+
+def handle_event(event):
+    """處理單一 LINE 事件（目前只處理文字訊息）。"""
+    if event.get("type") != "message":
+        return
+
+    message = event.get("message", {})
+    if message.get("type") != "text":
+        return
+
+    text = (message.get("text") or "").replace("\u3000", " ").strip()
+    reply_token = event.get("replyToken")
+    user_id = event.get("source", {}).get("userId", "")
+
+    log_sampled("webhook_text", command=command_of(event), user=user_ref(user_id), length=len(text))
+
+    if text == "申請加入會員":
+        reply_message(
+            reply_token,
+            "請輸入:\n"
+            "(遊戲帳號 XXXXXX)\n"
+            "X為3A帳號 ()內都要輸入\n\n"
+            "範例: 遊戲帳號 123456"
+        )
+        return
+
+    if text == "賓果分析":
+        reply_bingo_menu(reply_token)
+        return
+
+    if text in ("免費試用", "免費體驗", "試用一天", "免費使用1天", "免費使用一天"):
+        exp_dt, status = start_free_trial(user_id, hours=24)
+        if status == "already_member" and exp_dt:
+            exp_tw = exp_dt.astimezone(TZ_TW)
+            reply_message(
+                reply_token,
+                "✅ 你目前已經是會員\n\n"
+                f"到期時間：{exp_tw.strftime('%Y-%m-%d %H:%M')}\n\n"
+                "可直接輸入：今日陪跑 / 賓果分析"
+            )
+        elif status == "used":
+            reply_message(
+                reply_token,
+                "你已使用過免費試用。\n\n"
+                "若要繼續使用完整模型，請輸入：申請加入會員"
+            )
+        elif status == "opened" and exp_dt:
+            exp_tw = exp_dt.astimezone(TZ_TW)
+            reply_message(
+                reply_token,
+                "✅ 免費試用已開通\n\n"
+                "可使用時間：24小時\n"
+                f"到期時間：{exp_tw.strftime('%Y-%m-%d %H:%M')}\n\n"
+                "可輸入：\n"
+                "今日陪跑\n"
+                "點數配置\n"
+                "賓果分析\n"
+                "預測分析\n\n"
+                "提醒：數據模型僅供參考，請理性使用。"
+            )
+        else:
+            reply_message(reply_token, "暫時無法開通試用，請稍後再試。")
+        return
+
+
+    if text == "點數配置":
+        if not is_member(user_id):
+            reply_message(reply_token, "🌿 點數配置屬於會員內容\n\n請先輸入：免費試用 或 遊戲帳號 XXXXX")
+        else:
+            reply_bet_plan_menu(reply_token)
+        return
+
+    if text.startswith(("穩健", "均衡", "爆發")):
+        if not is_member(user_id):
+            reply_message(reply_token, "🌿 點數配置屬於會員內容\n\n請先輸入：免費試用 或 遊戲帳號 XXXXX")
+            return
+        try:
+            parts = text.split()
+            if len(parts) != 2:
+                raise ValueError("bad format")
+            mode_word = parts[0]
+            amount = int(parts[1])
+
+            mode_map = {
+                "穩健": "safe",
+                "均衡": "balanced",
+                "爆發": "burst",
+            }
+
+            msg = build_bet_plan(amount, mode_map.get(mode_word, "balanced"))
+            reply_message(reply_token, msg)
+        except Exception as e:
+            log_event(logging.ERROR, "bet_plan_input_error", error=repr(e))
+            reply_message(reply_token, "格式錯誤\n例如：穩健 3000 / 均衡 3000 / 爆發 5000")
+        return
+
+    if text.startswith("下注"):
+        if not is_member(user_id):
+            reply_message(reply_token, "🌿 點數配置屬於會員內容\n\n請先輸入：免費試用 或 遊戲帳號 XXXXX")
+            return
+        try:
+            amount = int(text.replace("下注", "").strip())
+            msg = build_bet_plan(amount, "balanced")
+            reply_message(reply_token, msg)
+        except Exception as e:
+            log_event(logging.ERROR, "bet_plan_custom_error", error=repr(e))
+            reply_message(reply_token, "格式錯誤\n例如：下注 3000")
+        return
+
+    if text in ("指令", "help", "HELP"):
+        reply_message(
+            reply_token,
+            "【功能選單】\n\n"
+            "今日陪跑\n"
+            "查看539 AI模型\n\n"
+            "免費試用\n"
+            "免費體驗24小時（每人一次）\n\n"
+            "點數配置\n"
+            "539 2星/3星/4星智能配置\n\n"
+            "賓果分析\n"
+            "查看賓果模型\n\n"
+            "賓果1期分析\n"
+            "賓果5期分析\n"
+            "賓果10期分析\n\n"
+            "預測分析\n"
+            "開啟即時模型推播\n\n"
+            "取消預測分析\n"
+            "停止即時推播\n\n"
+            "開啟每日推播\n"
+            "取消每日推播\n\n"
+            "我的到期日\n"
+            "查看會員期限"
+        )
+        return
+
+    if text.startswith("遊戲帳號 "):
+        parts = text.split(maxsplit=1)
+        if len(parts) != 2 or not parts[1].strip():
+            reply_message(reply_token, "格式：遊戲帳號 XXXXX")
+        else:
+            game_account = parts[1].strip()
+            save_pending_account(game_account, user_id)
+            reply_message(
+                reply_token,
+                "✅ 已收到你的申請加入會員\n\n"
+                f"帳號：{game_account}\n\n"
+                "請等待管理員確認開通。\n"
+                "（開通後可輸入：今日陪跑 / 賓果分析 / 預測分析 / 我的到期日）"
+            )
+        return
+
+    if text.startswith("待確認 "):
+        if admin_locked(user_id):
+            reply_message(reply_token, ADMIN_LOCKED_REPLY)
+            return
+
+        parts = text.split()
+        if len(parts) not in (2, 3) or parts[1] != ADMIN_SECRET:
+            note_admin_failure(user_id)
+            reply_message(reply_token, "管理密碼錯誤。")
+            return
+        if len(parts) == 3 and parts[2].lower() != "next":
+            reply_message(reply_token, "格式：待確認 <管理密碼> [next]")
+            return
+
+        next_page = len(parts) == 3
+        msg, _ = pending_accounts_page(user_id, next_page=next_page)
+        if msg is None:
+            reply_message(reply_token, "沒有更多待確認帳號。" if next_page else "目前沒有待確認帳號。")
+            return
+        reply_message(reply_token, msg)
+        return
+
+    if text.startswith("推播失敗 "):
+        if admin_locked(user_id):
+            reply_message(reply_token, ADMIN_LOCKED_REPLY)
+            return
+
+        parts = text.split()
+        if len(parts) != 2 or parts[1] != ADMIN_SECRET:
+            note_admin_failure(user_id)
+            reply_message(reply_token, "管理密碼錯誤。")
+            return
+
+        reply_message(reply_token, render_delivery_report(delivery_failure_report(hours=24)))
+        return
+
+    if text.startswith("確認 "):
+        if admin_locked(user_id):
+            reply_message(reply_token, ADMIN_LOCKED_REPLY)
+            return
+
+        parts = text.split()
+        if len(parts) != 3:
+            reply_message(reply_token, "格式：確認 <遊戲帳號> <管理密碼>\n例：確認 123456 aaa888")
+            return
+
+        _, game_account, secret = parts
+        if secret != ADMIN_SECRET:
+            note_admin_failure(user_id)
+            reply_message(reply_token, "管理密碼錯誤。")
+            return
+
+        target_user_id = pop_pending_user_id(game_account)
+        if not target_user_id:
+            reply_message(reply_token, f"找不到待確認帳號：{game_account}")
+            return
+
+        dt_tw = set_expiry_plus_days(target_user_id, 30)
+        enable_daily_push(target_user_id)
+
+        reply_message(
+            reply_token,
+            "✅ 已開通\n\n"
+            f"帳號：{game_account}\n"
+            f"到期（台灣時間）：{dt_tw.strftime('%Y-%m-%d %H:%M')}"
+        )
+        return
+
+    if text == "我的到期日":
+        exp = get_expiry(user_id)
+        if not exp:
+            reply_message(reply_token, "你目前尚未開通。\n請先輸入：遊戲帳號 XXXXX")
+        else:
+            exp_tw = exp.astimezone(TZ_TW)
+            reply_message(reply_token, "⏳ 你的到期時間（台灣時間）：\n" + exp_tw.strftime("%Y-%m-%d %H:%M"))
+        return
+
+    if text == "預測分析":
+        if not is_member(user_id):
+            reply_message(reply_token, "🌿 預測分析屬於會員內容\n\n請先輸入：遊戲帳號 XXXXX")
+        else:
+            enable_prediction(user_id)
+            reply_message(
+                reply_token,
+                "✅ 已開啟預測分析\n\n"
+                "之後若有 Bingo 即時分析更新，\n"
+                "你會收到：\n"
+                "1) 下一期短線模型"
+            )
+        return
+
+    if text == "取消預測分析":
+        disable_prediction(user_id)
+        reply_message(reply_token, "✅ 已取消預測分析推播")
+        return
+
+    if text == "開啟每日推播":
+        if not is_member(user_id):
+            reply_message(reply_token, "🌿 此功能屬於會員內容\n\n請先輸入：遊戲帳號 XXXXX")
+        else:
+            enable_daily_push(user_id)
+            reply_message(reply_token, "✅ 已開啟每日推播")
+        return
+
+    if text == "取消每日推播":
+        disable_daily_push(user_id)
+        reply_message(reply_token, "✅ 已取消每日推播")
+        return
+
+    if text == "今日陪跑":
+        if not is_member(user_id):
+            reply_message(reply_token, "🌿 今日陪跑屬於會員內容\n\n請先輸入：遊戲帳號 XXXXX")
+        else:
+            reply_message(reply_token, format_today_companion())
+        return
+
+    if text in ("1期", "賓果1期分析"):
+        if not is_member(user_id):
+            reply_message(reply_token, "🌿 賓果1期分析屬於會員內容\n\n請先輸入：遊戲帳號 XXXXX")
+        else:
+            reply_message(reply_token, format_bingo_1_message())
+        return
+
+    if text in ("5期", "賓果5期分析"):
+        if not is_member(user_id):
+            reply_message(reply_token, "🌿 賓果5期分析屬於會員內容\n\n請先輸入：遊戲帳號 XXXXX")
+        else:
+            reply_message(reply_token, format_bingo_5_message())
+        return
+
+    if text in ("10期", "賓果10期分析"):
+        if not is_member(user_id):
+            reply_message(reply_token, "🌿 賓果10期分析屬於會員內容\n\n請先輸入：遊戲帳號 XXXXX")
+        else:
+            reply_message(reply_token, format_bingo_10_message())
+        return
+
+    reply_message(reply_token, "輸入「指令」查看功能。")
+
+
+def handle_event_safely(event):
+    """處理單一事件；失敗時記錄並回覆忙碌訊息，不影響同批其他事件。"""
+    token = _DELIVERY_USER.set(event.get("source", {}).get("userId"))
+    try:
+        with timed("webhook_event_seconds", command=command_of(event)):
+            handle_event(event)
+    except Exception as e:
+        log_event(logging.ERROR, "event_handle_error", error=repr(e))
+        try:
+            if event.get("replyToken"):
+                reply_message(event.get("replyToken"), "系統忙碌中，請稍後再試一次。")
+        except Exception as e2:
+            log_event(logging.ERROR, "reply_fail_after_event_error", error=repr(e2))
+    finally:
+        _DELIVERY_USER.reset(token)
+
+
+async def _handle_event_async(event):
+    # webhook 已回應，事件自成一條 trace
+    state = _open_span("webhook_event_async", {"command": command_of(event)}, root=True)
+    try:
+        await asyncio.to_thread(handle_event_safely, event)
+    finally:
+        _close_span(state)
+
+
 @app.route("/webhook", methods=["POST"])
 def webhook():
     try:
@@ -1959,300 +5600,32 @@ def webhook():
         signature = request.headers.get("X-Line-Signature", "")
 
         if not verify_line_signature(raw, signature):
-            print("SIGNATURE ERROR")
+            log_event(logging.WARNING, "signature_error")
             abort(403)
 
         body = request.get_json(silent=True) or {}
         events = body.get("events", [])
 
-        print("WEBHOOK HIT AT:", datetime.now(TZ_TW).strftime("%Y-%m-%d %H:%M:%S"))
+        log_sampled("webhook_hit", events=len(events))
 
         try:
             init_db()
         except Exception as e:
-            print("INIT_DB ERROR:", repr(e))
+            log_event(logging.ERROR, "init_db_error", error=repr(e))
             return "OK"
 
         for event in events:
-            try:
-                if event.get("type") != "message":
-                    continue
-
-                message = event.get("message", {})
-                if message.get("type") != "text":
-                    continue
-
-                text = (message.get("text") or "").replace("\u3000", " ").strip()
-                reply_token = event.get("replyToken")
-                user_id = event.get("source", {}).get("userId", "")
-
-                print("WEBHOOK TEXT:", text)
-                print("WEBHOOK USER:", user_id)
-
-                if text == "申請加入會員":
-                    reply_message(
-                        reply_token,
-                        "請輸入:\n"
-                        "(遊戲帳號 XXXXXX)\n"
-                        "X為3A帳號 ()內都要輸入\n\n"
-                        "範例: 遊戲帳號 123456"
-                    )
-                    continue
-
-                if text == "賓果分析":
-                    reply_bingo_menu(reply_token)
-                    continue
-
-                if text in ("免費試用", "免費體驗", "試用一天", "免費使用1天", "免費使用一天"):
-                    exp_dt, status = start_free_trial(user_id, hours=24)
-                    if status == "already_member" and exp_dt:
-                        exp_tw = exp_dt.astimezone(TZ_TW)
-                        reply_message(
-                            reply_token,
-                            "✅ 你目前已經是會員\n\n"
-                            f"到期時間：{exp_tw.strftime('%Y-%m-%d %H:%M')}\n\n"
-                            "可直接輸入：今日陪跑 / 賓果分析"
-                        )
-                    elif status == "used":
-                        reply_message(
-                            reply_token,
-                            "你已使用過免費試用。\n\n"
-                            "若要繼續使用完整模型，請輸入：申請加入會員"
-                        )
-                    elif status == "opened" and exp_dt:
-                        exp_tw = exp_dt.astimezone(TZ_TW)
-                        reply_message(
-                            reply_token,
-                            "✅ 免費試用已開通\n\n"
-                            "可使用時間：24小時\n"
-                            f"到期時間：{exp_tw.strftime('%Y-%m-%d %H:%M')}\n\n"
-                            "可輸入：\n"
-                            "今日陪跑\n"
-                            "點數配置\n"
-                            "賓果分析\n"
-                            "預測分析\n\n"
-                            "提醒：數據模型僅供參考，請理性使用。"
-                        )
-                    else:
-                        reply_message(reply_token, "暫時無法開通試用，請稍後再試。")
-                    continue
-
-
-                if text == "點數配置":
-                    if not is_member(user_id):
-                        reply_message(reply_token, "🌿 點數配置屬於會員內容\n\n請先輸入：免費試用 或 遊戲帳號 XXXXX")
-                    else:
-                        reply_bet_plan_menu(reply_token)
-                    continue
-
-                if text.startswith(("穩健", "均衡", "爆發")):
-                    if not is_member(user_id):
-                        reply_message(reply_token, "🌿 點數配置屬於會員內容\n\n請先輸入：免費試用 或 遊戲帳號 XXXXX")
-                        continue
-                    try:
-                        parts = text.split()
-                        if len(parts) != 2:
-                            raise ValueError("bad format")
-                        mode_word = parts[0]
-                        amount = int(parts[1])
-
-                        mode_map = {
-                            "穩健": "safe",
-                            "均衡": "balanced",
-                            "爆發": "burst",
-                        }
-
-                        msg = build_bet_plan(amount, mode_map.get(mode_word, "balanced"))
-                        reply_message(reply_token, msg)
-                    except Exception as e:
-                        print("BET_PLAN_INPUT_ERROR:", repr(e))
-                        reply_message(reply_token, "格式錯誤\n例如：穩健 3000 / 均衡 3000 / 爆發 5000")
-                    continue
-
-                if text.startswith("下注"):
-                    if not is_member(user_id):
-                        reply_message(reply_token, "🌿 點數配置屬於會員內容\n\n請先輸入：免費試用 或 遊戲帳號 XXXXX")
-                        continue
-                    try:
-                        amount = int(text.replace("下注", "").strip())
-                        msg = build_bet_plan(amount, "balanced")
-                        reply_message(reply_token, msg)
-                    except Exception as e:
-                        print("BET_PLAN_CUSTOM_ERROR:", repr(e))
-                        reply_message(reply_token, "格式錯誤\n例如：下注 3000")
-                    continue
-
-                if text in ("指令", "help", "HELP"):
-                    reply_message(
-                        reply_token,
-                        "【功能選單】\n\n"
-                        "今日陪跑\n"
-                        "查看539 AI模型\n\n"
-                        "免費試用\n"
-                        "免費體驗24小時（每人一次）\n\n"
-                        "點數配置\n"
-                        "539 2星/3星/4星智能配置\n\n"
-                        "賓果分析\n"
-                        "查看賓果模型\n\n"
-                        "賓果1期分析\n"
-                        "賓果5期分析\n"
-                        "賓果10期分析\n\n"
-                        "預測分析\n"
-                        "開啟即時模型推播\n\n"
-                        "取消預測分析\n"
-                        "停止即時推播\n\n"
-                        "開啟每日推播\n"
-                        "取消每日推播\n\n"
-                        "我的到期日\n"
-                        "查看會員期限"
-                    )
-                    continue
-
-                if text.startswith("遊戲帳號 "):
-                    parts = text.split(maxsplit=1)
-                    if len(parts) != 2 or not parts[1].strip():
-                        reply_message(reply_token, "格式：遊戲帳號 XXXXX")
-                    else:
-                        game_account = parts[1].strip()
-                        save_pending_account(game_account, user_id)
-                        reply_message(
-                            reply_token,
-                            "✅ 已收到你的申請加入會員\n\n"
-                            f"帳號：{game_account}\n\n"
-                            "請等待管理員確認開通。\n"
-                            "（開通後可輸入：今日陪跑 / 賓果分析 / 預測分析 / 我的到期日）"
-                        )
-                    continue
-
-                if text.startswith("待確認 "):
-                    parts = text.split()
-                    if len(parts) != 2 or parts[1] != ADMIN_SECRET:
-                        reply_message(reply_token, "管理密碼錯誤。")
-                        continue
-
-                    rows = get_latest_pending(50)
-                    if not rows:
-                        reply_message(reply_token, "目前沒有待確認帳號。")
-                        continue
-
-                    msg = "📋 最近待確認帳號（最多50筆）\n\n"
-                    for ga, uid, ts in rows:
-                        ts_str = ts.astimezone(TZ_TW).strftime("%Y-%m-%d %H:%M")
-                        msg += f"帳號：{ga}\nuserId：{uid}\n時間：{ts_str}\n-----------------\n"
-                    reply_message(reply_token, msg[:5000])
-                    continue
-
-                if text.startswith("確認 "):
-                    parts = text.split()
-                    if len(parts) != 3:
-                        reply_message(reply_token, "格式：確認 <遊戲帳號> <管理密碼>\n例：確認 123456 aaa888")
-                        continue
-
-                    _, game_account, secret = parts
-                    if secret != ADMIN_SECRET:
-                        reply_message(reply_token, "管理密碼錯誤。")
-                        continue
-
-                    target_user_id = pop_pending_user_id(game_account)
-                    if not target_user_id:
-                        reply_message(reply_token, f"找不到待確認帳號：{game_account}")
-                        continue
-
-                    dt_tw = set_expiry_plus_days(target_user_id, 30)
-                    enable_daily_push(target_user_id)
-
-                    reply_message(
-                        reply_token,
-                        "✅ 已開通\n\n"
-                        f"帳號：{game_account}\n"
-                        f"到期（台灣時間）：{dt_tw.strftime('%Y-%m-%d %H:%M')}"
-                    )
-                    continue
-
-                if text == "我的到期日":
-                    exp = get_expiry(user_id)
-                    if not exp:
-                        reply_message(reply_token, "你目前尚未開通。\n請先輸入：遊戲帳號 XXXXX")
-                    else:
-                        exp_tw = exp.astimezone(TZ_TW)
-                        reply_message(reply_token, "⏳ 你的到期時間（台灣時間）：\n" + exp_tw.strftime("%Y-%m-%d %H:%M"))
-                    continue
-
-                if text == "預測分析":
-                    if not is_member(user_id):
-                        reply_message(reply_token, "🌿 預測分析屬於會員內容\n\n請先輸入：遊戲帳號 XXXXX")
-                    else:
-                        enable_prediction(user_id)
-                        reply_message(
-                            reply_token,
-                            "✅ 已開啟預測分析\n\n"
-                            "之後若有 Bingo 即時分析更新，\n"
-                            "你會收到：\n"
-                            "1) 下一期短線模型"
-                        )
-                    continue
-
-                if text == "取消預測分析":
-                    disable_prediction(user_id)
-                    reply_message(reply_token, "✅ 已取消預測分析推播")
-                    continue
-
-                if text == "開啟每日推播":
-                    if not is_member(user_id):
-                        reply_message(reply_token, "🌿 此功能屬於會員內容\n\n請先輸入：遊戲帳號 XXXXX")
-                    else:
-                        enable_daily_push(user_id)
-                        reply_message(reply_token, "✅ 已開啟每日推播")
-                    continue
-
-                if text == "取消每日推播":
-                    disable_daily_push(user_id)
-                    reply_message(reply_token, "✅ 已取消每日推播")
-                    continue
-
-                if text == "今日陪跑":
-                    if not is_member(user_id):
-                        reply_message(reply_token, "🌿 今日陪跑屬於會員內容\n\n請先輸入：遊戲帳號 XXXXX")
-                    else:
-                        reply_message(reply_token, format_today_companion())
-                    continue
-
-                if text in ("1期", "賓果1期分析"):
-                    if not is_member(user_id):
-                        reply_message(reply_token, "🌿 賓果1期分析屬於會員內容\n\n請先輸入：遊戲帳號 XXXXX")
-                    else:
-                        reply_message(reply_token, format_bingo_1_message())
-                    continue
-
-                if text in ("5期", "賓果5期分析"):
-                    if not is_member(user_id):
-                        reply_message(reply_token, "🌿 賓果5期分析屬於會員內容\n\n請先輸入：遊戲帳號 XXXXX")
-                    else:
-                        reply_message(reply_token, format_bingo_5_message())
-                    continue
-
-                if text in ("10期", "賓果10期分析"):
-                    if not is_member(user_id):
-                        reply_message(reply_token, "🌿 賓果10期分析屬於會員內容\n\n請先輸入：遊戲帳號 XXXXX")
-                    else:
-                        reply_message(reply_token, format_bingo_10_message())
-                    continue
-
-                reply_message(reply_token, "輸入「指令」查看功能。")
-
-            except Exception as e:
-                print("EVENT HANDLE ERROR:", repr(e))
-                try:
-                    if event.get("replyToken"):
-                        reply_message(event.get("replyToken"), "系統忙碌中，請稍後再試一次。")
-                except Exception as e2:
-                    print("REPLY FAIL AFTER EVENT ERROR:", repr(e2))
+            if shed_event(event):
                 continue
+            if ASYNC_MODE:
+                run_async(_handle_event_async(event))
+            else:
+                handle_event_safely(event)
 
         return "OK"
 
     except Exception as e:
-        print("WEBHOOK FATAL ERROR:", repr(e))
+        log_event(logging.ERROR, "webhook_fatal_error", error=repr(e))
         return "OK"
 
 
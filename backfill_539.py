@@ -0,0 +1,114 @@
+"""
+539 歷史開獎大量匯入
+
+用法：
+    python backfill_539.py draws.csv
+    python backfill_539.py list539BIG.html --progress-every 10000
+    python backfill_539.py draws.csv --dry-run
+
+支援格式：
+- CSV / 純文字：每行一筆，日期在前，後面接 5 個號碼
+  例：2024-01-02,03,15,22,31,38 或 113/01/02 03 15 22 31 38（民國年）
+- HTML：pilio 539 列表頁存檔（與線上抓取同一套解析）
+"""
+import argparse
+import re
+import sys
+import time
+from datetime import date
+
+import app
+
+LINE_PATTERN = re.compile(r"(\d{2,4})[-/.](\d{1,2})[-/.](\d{1,2})(.*)")
+NUM_PATTERN = re.compile(r"\d{1,2}")
+
+
+def parse_539_line(line: str):
+    """解析一行 CSV / 文字資料；表頭或格式不符回傳 None。"""
+    m = LINE_PATTERN.search(line)
+    if not m:
+        return None
+
+    y, mo, d = int(m.group(1)), int(m.group(2)), int(m.group(3))
+    if y < 1911:
+        y += 1911
+
+    nums = [int(x) for x in NUM_PATTERN.findall(m.group(4))[:5]]
+    if len(nums) != 5 or len(set(nums)) != 5 or not all(1 <= n <= 39 for n in nums):
+        return None
+
+    try:
+        draw_date = date(y, mo, d)
+    except ValueError:
+        return None
+    return draw_date, " ".join([f"{n:02d}" for n in sorted(nums)])
+
+
+def iter_draws_from_file(path: str, stats=None):
+    """依副檔名 / 內容判斷格式，逐筆產生 (draw_date, numbers)。"""
+    stats = stats if stats is not None else {}
+    stats.setdefault("skipped", 0)
+
+    with open(path, "r", encoding="utf-8", errors="replace") as f:
+        head = f.read(4096)
+        f.seek(0)
+        is_html = path.lower().endswith((".htm", ".html")) or "<html" in head.lower()
+
+        if is_html:
+            yield from app.iter_539_html(f.read())
+            return
+
+        for line in f:
+            if not line.strip():
+                continue
+            row = parse_539_line(line)
+            if row is None:
+                stats["skipped"] += 1
+                continue
+            yield row
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="539 歷史開獎大量匯入（COPY FROM STDIN）")
+    parser.add_argument("path", help="CSV / 文字 / HTML 歷史資料檔")
+    parser.add_argument("--progress-every", type=int, default=5000, help="每幾筆回報一次進度")
+    parser.add_argument("--dry-run", action="store_true", help="只解析不寫入資料庫")
+    args = parser.parse_args(argv)
+
+    started = time.monotonic()
+    stats = {}
+
+    def on_progress(count):
+        elapsed = time.monotonic() - started
+        print(f"BACKFILL_539 PROGRESS: {count:,} rows ({count / max(elapsed, 1e-9):,.0f} rows/s)")
+
+    rows = iter_draws_from_file(args.path, stats)
+
+    if args.dry_run:
+        count = 0
+        first = last = None
+        for d, _ in rows:
+            count += 1
+            first = d if first is None or d < first else first
+            last = d if last is None or d > last else last
+            if args.progress_every and count % args.progress_every == 0:
+                on_progress(count)
+        print(f"BACKFILL_539 DRY RUN: parsed={count:,} skipped={stats.get('skipped', 0):,} range={first}~{last}")
+        return 0
+
+    app.init_db()
+    read, merged = app.bulk_load_539_draws(
+        rows,
+        progress_every=args.progress_every,
+        on_progress=on_progress
+    )
+    elapsed = time.monotonic() - started
+    print(
+        f"BACKFILL_539 DONE: read={read:,} merged={merged:,} "
+        f"skipped={stats.get('skipped', 0):,} elapsed={elapsed:.2f}s"
+    )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
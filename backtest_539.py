@@ -0,0 +1,205 @@
+"""
+539 母盤引擎歷史回測
+
+逐期重播開獎歷史：每一期只用「之前」的開獎建立母盤 / 主軸 / 主攻 / 爆發，
+再對照當期實際開獎計算命中數。日期切成連續區段分給多個 process，
+每個區段用 DrawWindows539 滾動更新，不必每天從頭重算。
+
+用法：
+    python backtest_539.py                       # 從資料庫讀取全部歷史
+    python backtest_539.py --csv draws.csv       # 從 backfill 用的歷史檔讀取
+    python backtest_539.py --start 2020-01-01 --workers 8 --output results.csv
+"""
+import argparse
+import csv
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date
+
+import app
+
+WARMUP = max(app.DrawWindows539.SIZES)
+
+# 各層號碼數、命中門檻（與點數配置的 2/3/4 星對齊）
+MODELS = (
+    ("motherboard", 9, None),
+    ("core", 3, 2),
+    ("attack3", 5, 3),
+    ("burst4", 8, 4),
+)
+
+RESULT_FIELDS = [
+    "draw_date", "actual",
+    "motherboard", "core", "attack3", "burst4",
+    "motherboard_hits", "core_hits", "attack3_hits", "burst4_hits",
+]
+
+
+def load_history(csv_path=None):
+    """回傳依日期由舊到新排序的 [(draw_date, [n1..n5]), ...]。"""
+    if csv_path:
+        import backfill_539
+
+        by_date = {}
+        for d, nums_text in backfill_539.iter_draws_from_file(csv_path):
+            by_date[d] = [int(x) for x in nums_text.split()]
+        return sorted(by_date.items())
+
+    app.init_db()
+    draws = app.load_539_draws(limit=1000000)
+    return list(reversed(draws))
+
+
+def score_day(models, actual):
+    actual_set = set(actual)
+    row = {}
+    for key, _, _ in MODELS:
+        nums = [int(x) for x in models[key].split()]
+        row[key] = models[key]
+        row[f"{key}_hits"] = sum(1 for n in nums if n in actual_set)
+    return row
+
+
+def replay_shard(history, start, end):
+    """
+    history 為由舊到新的開獎，回測 index 落在 [start, end) 的期數。
+    只把 start 之前最多 WARMUP 期推進視窗，之後逐期滾動。
+    """
+    windows = app.DrawWindows539()
+    for d, nums in history[max(0, start - WARMUP):start]:
+        windows.push(d, nums)
+
+    rows = []
+    for d, nums in history[start:end]:
+        models = app.build_motherboard_models_539(None, pick_date=d, windows=windows)
+        row = {"draw_date": d.isoformat(), "actual": app._fmt_nums(nums)}
+        row.update(score_day(models, nums))
+        rows.append(row)
+        windows.push(d, nums)
+    return rows
+
+
+def _replay_shard_args(args):
+    return replay_shard(*args)
+
+
+def shard_ranges(start, end, shards):
+    shards = max(1, min(shards, end - start))
+    size = (end - start + shards - 1) // shards
+    return [(i, min(i + size, end)) for i in range(start, end, size)]
+
+
+def run_backtest(history, min_history=30, start_date=None, end_date=None, workers=None):
+    """回傳依日期排序的每期結果列表。"""
+    start = min_history
+    end = len(history)
+    if start_date:
+        start = max(start, next((i for i, (d, _) in enumerate(history) if d >= start_date), end))
+    if end_date:
+        end = next((i for i, (d, _) in enumerate(history) if d > end_date), end)
+    if start >= end:
+        return []
+
+    workers = workers or os.cpu_count() or 1
+    ranges = shard_ranges(start, end, workers * 4)
+
+    if workers <= 1:
+        chunks = [replay_shard(history, a, b) for a, b in ranges]
+    else:
+        # 每個區段只帶自己需要的歷史（含暖機），避免整份歷史反覆序列化
+        tasks = []
+        for a, b in ranges:
+            lo = max(0, a - WARMUP)
+            tasks.append((history[lo:b], a - lo, b - lo))
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            chunks = list(pool.map(_replay_shard_args, tasks))
+
+    rows = []
+    for chunk in chunks:
+        rows.extend(chunk)
+    return rows
+
+
+def summarize(rows):
+    """各層平均命中、隨機基準、命中門檻達成率與命中數分布。"""
+    total = len(rows)
+    summary = {"days": total, "models": {}}
+    if not total:
+        return summary
+
+    for key, size, threshold in MODELS:
+        hits = [r[f"{key}_hits"] for r in rows]
+        dist = {h: hits.count(h) for h in range(0, 6) if hits.count(h)}
+        item = {
+            "size": size,
+            "avg_hits": sum(hits) / total,
+            "random_avg_hits": size * 5 / 39,
+            "distribution": dist,
+        }
+        if threshold is not None:
+            item["threshold"] = threshold
+            item["hit_rate"] = sum(1 for h in hits if h >= threshold) / total
+        summary["models"][key] = item
+    return summary
+
+
+def format_summary(summary, rows):
+    lines = [f"BACKTEST_539: {summary['days']:,} draws"]
+    if rows:
+        lines[0] += f" ({rows[0]['draw_date']} ~ {rows[-1]['draw_date']})"
+    for key, item in summary["models"].items():
+        line = (
+            f"  {key:<12} size={item['size']} avg_hits={item['avg_hits']:.3f} "
+            f"(random {item['random_avg_hits']:.3f})"
+        )
+        if "hit_rate" in item:
+            line += f" hit>={item['threshold']}: {item['hit_rate'] * 100:.2f}%"
+        dist = " ".join([f"{h}:{c}" for h, c in sorted(item["distribution"].items())])
+        lines.append(line + f" dist[{dist}]")
+    return "\n".join(lines)
+
+
+def write_results(rows, path):
+    out = open(path, "w", newline="", encoding="utf-8") if path != "-" else sys.stdout
+    try:
+        writer = csv.DictWriter(out, fieldnames=RESULT_FIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="539 母盤引擎歷史回測")
+    parser.add_argument("--csv", help="歷史開獎檔（未指定則讀資料庫）")
+    parser.add_argument("--start", type=date.fromisoformat, help="回測起始日 YYYY-MM-DD")
+    parser.add_argument("--end", type=date.fromisoformat, help="回測結束日 YYYY-MM-DD")
+    parser.add_argument("--min-history", type=int, default=30, help="至少累積幾期才開始回測")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--output", help="每期結果輸出 CSV（- 為 stdout）")
+    args = parser.parse_args(argv)
+
+    started = time.monotonic()
+    history = load_history(args.csv)
+    rows = run_backtest(
+        history,
+        min_history=args.min_history,
+        start_date=args.start,
+        end_date=args.end,
+        workers=args.workers
+    )
+    elapsed = time.monotonic() - started
+
+    if args.output:
+        write_results(rows, args.output)
+
+    print(format_summary(summarize(rows), rows))
+    print(f"BACKTEST_539 ELAPSED: {elapsed:.2f}s workers={args.workers}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,405 @@
+"""
+效能量測
+
+以固定種子產生的 539 歷史與 fixtures/ 下的 Bingo 開獎頁當資料，
+量測引擎、點數配置與各訊息 renderer 的每秒次數與單次呼叫的記憶體峰值。
+需要資料庫 / 網路的函式（今日母盤、Bingo 開獎抓取）在量測期間換成同一份固定資料。
+
+用法：
+    python benchmarks.py
+    python benchmarks.py --group engine --min-time 0.5
+    python benchmarks.py --save-baseline benchmarks_baseline.json
+    python benchmarks.py --baseline benchmarks_baseline.json   # 退步超過門檻時 exit 1
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+
+import app
+
+BENCH_DATE = date(2026, 6, 1)
+BINGO_FIXTURE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "bingo_results_sample.html")
+# BingoDrawHistory 存 10,000 期需遠低於 1MB
+BINGO_HISTORY_PERIODS = 10000
+BINGO_HISTORY_MAX_BYTES = 1024 * 1024
+
+
+def ops_per_sec(fn, min_time=0.2, repeat=3):
+    """重複執行 fn 至少 min_time 秒，取 repeat 輪中最快一輪的每秒次數。"""
+    fn()
+    loops = 1
+    best = 0.0
+    rounds = 0
+    while rounds < repeat:
+        started = time.perf_counter()
+        for _ in range(loops):
+            fn()
+        elapsed = time.perf_counter() - started
+        if elapsed < min_time:
+            loops *= 2
+            continue
+        best = max(best, loops / elapsed)
+        rounds += 1
+    return best
+
+
+def peak_alloc_kib(fn):
+    """單次呼叫期間 tracemalloc 的記憶體峰值（KiB）。"""
+    fn()
+    tracemalloc.start()
+    try:
+        tracemalloc.reset_peak()
+        base, _ = tracemalloc.get_traced_memory()
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return (peak - base) / 1024
+
+
+# =========================
+# 固定資料
+# =========================
+def synthetic_539_draws(count, seed="bench-539"):
+    """由新到舊的 [(draw_date, [n1..n5]), ...]，每天一期。"""
+    rng = random.Random(seed)
+    first = BENCH_DATE - timedelta(days=count)
+    draws = [(first + timedelta(days=i), sorted(rng.sample(range(1, 40), 5))) for i in range(count)]
+    return draws[::-1]
+
+
+def synthetic_bingo_draws(count=60):
+    """fixture 頁面解析出的開獎接上固定種子的舊期數，由新到舊的 BingoDraw。"""
+    with open(BINGO_FIXTURE, "r", encoding="utf-8") as f:
+        draws = app.parse_bingo_results(f.read(), default_date=BENCH_DATE)
+    oldest = int(draws[-1]["period"])
+    rng = random.Random("bench-bingo")
+    for i in range(1, count - len(draws) + 1):
+        draws.append({
+            "period": str(oldest - i),
+            "time": "",
+            "numbers": sorted(rng.sample(range(1, 81), 20)),
+            "draw_time": None,
+        })
+    # 與 fetch_recent_bingo_results 相同，回傳 BingoDraw
+    return [app.as_bingo_draw(d) for d in draws]
+
+
+def synthetic_bingo_history(count=BINGO_HISTORY_PERIODS, seed="bench-bingo-history"):
+    """固定種子的 BingoDrawHistory，期別由舊到新、每 5 分鐘一期。"""
+    rng = random.Random(seed)
+    history = app.BingoDrawHistory()
+    for i in range(count):
+        minute = 7 * 60 + 5 + (i % 203) * 5
+        history.append(app.BingoDraw(
+            115000001 + i,
+            rng.sample(range(1, 81), 20),
+            f"{minute // 60:02d}:{minute % 60:02d}",
+        ))
+    return history
+
+
+def check_bingo_history_size():
+    """10,000 期 BingoDrawHistory 的實際佔用（含 array 物件本身）需小於 BINGO_HISTORY_MAX_BYTES。"""
+    history = synthetic_bingo_history()
+    size = sum(sys.getsizeof(a) for a in (history.periods, history.lo, history.hi, history.minutes))
+    ok = size < BINGO_HISTORY_MAX_BYTES
+    print(
+        f"BINGO HISTORY {'OK' if ok else 'TOO LARGE'}: {len(history):,} periods "
+        f"{size / 1024:,.1f} KiB (limit {BINGO_HISTORY_MAX_BYTES / 1024:,.0f} KiB)"
+    )
+    return ok
+
+
+def fixture_pack():
+    """與 build_pick_539 相同步驟建立的母盤快取（不寫資料庫）。"""
+    draws_240 = synthetic_539_draws(240)
+    hot_zone, ranked, _ = app.hot_zone_and_hotnums_539(draws_240[:30])
+    models = app.build_motherboard_models_539(draws_240, pick_date=BENCH_DATE)
+    pack = {
+        "pick_date": BENCH_DATE,
+        "numbers": models["motherboard"],
+        "hot_zone": hot_zone,
+        "top_hot": app.build_daily_top_hot(ranked, BENCH_DATE),
+        "note": json.dumps(models, ensure_ascii=False),
+        "source_draw_date": draws_240[0][0],
+        "warmed_at": datetime(2026, 5, 31, 21, 0, tzinfo=app.TZ_TW),
+        "market_state": app.market_state_from_draws(draws_240[:30]),
+    }
+    pack["rendered"] = {
+        "push": app.render_539_push(pack),
+        "companion": app.render_today_companion(pack),
+        "bet_plans": app.render_standard_bet_plans(pack),
+    }
+    return pack
+
+
+@contextmanager
+def fixture_app():
+    """量測期間把需要資料庫 / 網路的來源換成固定資料。"""
+    pack = fixture_pack()
+    bingo = synthetic_bingo_draws()
+    patches = {
+        "get_or_build_pick_539": lambda pick_date=None: pack,
+        "get_or_build_today_pick_539": lambda: pack,
+        "fetch_recent_bingo_results": lambda max_rows=60: bingo[:max_rows],
+        "bingo_source_enabled": lambda: False,
+    }
+    saved = {name: getattr(app, name) for name in patches}
+    for name, fn in patches.items():
+        setattr(app, name, fn)
+    try:
+        yield
+    finally:
+        for name, fn in saved.items():
+            setattr(app, name, fn)
+
+
+# =========================
+# 加權抽樣
+# =========================
+def _legacy_linear_sample(items, weights, k, rng):
+    """舊版線性掃描抽樣，僅作為比較基準。"""
+    pool = list(items)
+    chosen = []
+    while pool and len(chosen) < k:
+        total = sum(max(0.001, weights.get(n, 0.001)) for n in pool)
+        r = rng.uniform(0, total)
+        acc = 0
+        pick = pool[-1]
+        for n in pool:
+            acc += max(0.001, weights.get(n, 0.001))
+            if r <= acc:
+                pick = n
+                break
+        chosen.append(pick)
+        pool.remove(pick)
+    return chosen
+
+
+def sampling_cases():
+    cases = []
+    for size, k in ((39, 9), (80, 5), (80, 20), (500, 50), (5000, 100)):
+        rng = random.Random(f"bench-weights-{size}")
+        items = list(range(1, size + 1))
+        weights = {n: rng.random() for n in items}
+
+        def legacy(items=items, weights=weights, k=k):
+            _legacy_linear_sample(items, weights, k, random.Random(1))
+
+        def fenwick(items=items, weights=weights, k=k):
+            app._weighted_sample_without_replacement(items, weights, k, random.Random(1))
+
+        cases.append((f"sample n={size} k={k} legacy", legacy))
+        cases.append((f"sample n={size} k={k} fenwick", fenwick))
+
+    rng = random.Random("bench-bingo-freq")
+    freq = {n: rng.randint(0, 10) for n in range(1, 81)}
+    cases.append(("weighted_pick_bingo", lambda: app._weighted_pick_bingo(freq, "bench-seed")))
+    return cases
+
+
+# =========================
+# 539 母盤引擎
+# =========================
+def engine_cases():
+    cases = []
+    for count in (240, 2000, 20000):
+        draws = synthetic_539_draws(count, seed=f"bench-539-{count}")
+        windows = app.DrawWindows539()
+        for d, nums in reversed(draws):
+            windows.push(d, nums)
+
+        def from_list(draws=draws):
+            app.build_motherboard_models_539(draws, pick_date=BENCH_DATE)
+
+        def from_windows(windows=windows):
+            app.build_motherboard_models_539(None, pick_date=BENCH_DATE, windows=windows)
+
+        cases.append((f"motherboard draws={count} list", from_list))
+        cases.append((f"motherboard draws={count} windows", from_windows))
+
+    draws_30 = synthetic_539_draws(30)
+    cases.append(("market_state_from_draws", lambda: app.market_state_from_draws(draws_30)))
+    return cases
+
+
+# =========================
+# Bingo 分析
+# =========================
+def bingo_cases():
+    draws = synthetic_bingo_draws()
+
+    def build_fresh():
+        app._build_bingo_analysis_bundle(draws, stats=app.BingoWindowStats())
+
+    stats = app.BingoWindowStats()
+    stats.sync(draws)
+
+    def build_synced():
+        app._build_bingo_analysis_bundle(draws, stats=stats)
+
+    def bundle_cold():
+        app._BINGO_BUNDLE_MEMO.clear()
+        app.get_bingo_analysis_bundle()
+
+    history = synthetic_bingo_history()
+
+    return [
+        ("bundle build (fresh stats)", build_fresh),
+        ("bundle build (synced stats)", build_synced),
+        ("get_bingo_analysis_bundle cold", bundle_cold),
+        ("get_bingo_analysis_bundle memo", app.get_bingo_analysis_bundle),
+        ("history 10k frequency", lambda: app.bingo_mask_frequency(history.masks())),
+        ("history 10k overlaps", lambda: app.bingo_consecutive_overlaps(history.masks())),
+        ("history recent(60)", lambda: history.recent(60)),
+    ]
+
+
+# =========================
+# 點數配置
+# =========================
+def bet_plan_cases():
+    pack = fixture_pack()
+    plan = app.compute_bet_plan(3000, "balanced", pack)
+    tiers = (
+        (tuple(plan["two_nums"]), 2),
+        (tuple(plan["three_nums"]), 3),
+        (tuple(plan["four_nums"]), 4),
+    )
+
+    def coverage_cold():
+        app.coverage_table_539.cache_clear()
+        app.coverage_table_539(tiers)
+
+    def build_cold():
+        app._bet_plan_text.cache_clear()
+        app.build_bet_plan(3000, "balanced")
+
+    note = pack["note"]
+    legacy_note = json.dumps({"trend_model": "06 09 18 24 33", "adjustment_model": "04 12 18 26 31"})
+
+    return [
+        ("coverage_table_539 cold", coverage_cold),
+        ("compute_bet_plan", lambda: app.compute_bet_plan(3000, "balanced", pack)),
+        ("render_bet_plan", lambda: app.render_bet_plan(plan)),
+        ("render_standard_bet_plans", lambda: app.render_standard_bet_plans(pack)),
+        ("build_bet_plan cold", build_cold),
+        ("build_bet_plan cached", lambda: app.build_bet_plan(3000, "balanced")),
+        ("parse_models_from_note", lambda: app.parse_models_from_note(note)),
+        ("parse_models_from_note legacy", lambda: app.parse_models_from_note(legacy_note)),
+    ]
+
+
+# =========================
+# 訊息 renderer
+# =========================
+def render_cases():
+    pack = fixture_pack()
+    exp_dt = datetime(2026, 6, 4, 12, 0, tzinfo=app.TZ_TW)
+    return [
+        ("render_539_push", lambda: app.render_539_push(pack)),
+        ("render_today_companion", lambda: app.render_today_companion(pack)),
+        ("format_539_push", app.format_539_push),
+        ("format_today_companion", app.format_today_companion),
+        ("format_bingo_1_message", app.format_bingo_1_message),
+        ("format_bingo_5_message", app.format_bingo_5_message),
+        ("format_bingo_10_message", app.format_bingo_10_message),
+        ("format_bingo_evening_push", app.format_bingo_evening_push),
+        ("format_bingo_latest_push", app.format_bingo_latest_push),
+        ("format_expiry_reminder", lambda: app.format_expiry_reminder(exp_dt)),
+    ]
+
+
+GROUPS = {
+    "sampling": sampling_cases,
+    "engine": engine_cases,
+    "bingo": bingo_cases,
+    "bet_plan": bet_plan_cases,
+    "render": render_cases,
+}
+
+
+# =========================
+# 基準比較
+# =========================
+def run(groups, min_time=0.2, match=None):
+    results = {}
+    with fixture_app():
+        for group in groups:
+            for name, fn in GROUPS[group]():
+                key = f"{group}/{name}"
+                if match and match not in key:
+                    continue
+                ops = ops_per_sec(fn, min_time)
+                peak = peak_alloc_kib(fn)
+                results[key] = {"ops": round(ops, 2), "peak_kib": round(peak, 2)}
+                print(f"{group:<10} {name:<40} {ops:>14,.1f} ops/s {peak:>10,.1f} KiB")
+    return results
+
+
+def compare(results, baseline, ops_tolerance=0.3, alloc_tolerance=0.2):
+    """回傳退步項目說明；每秒次數低於基準或記憶體峰值高於基準超過門檻即算退步。"""
+    regressions = []
+    for key, base in sorted(baseline.get("results", {}).items()):
+        cur = results.get(key)
+        if cur is None:
+            continue
+        if cur["ops"] < base["ops"] * (1 - ops_tolerance):
+            regressions.append(
+                f"{key}: {cur['ops']:,.1f} ops/s < baseline {base['ops']:,.1f} (-{1 - cur['ops'] / base['ops']:.0%})"
+            )
+        # 小於 1 KiB 的差異視為雜訊
+        if cur["peak_kib"] > base["peak_kib"] * (1 + alloc_tolerance) + 1:
+            regressions.append(f"{key}: peak {cur['peak_kib']:,.1f} KiB > baseline {base['peak_kib']:,.1f} KiB")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="效能量測")
+    parser.add_argument("--group", choices=sorted(GROUPS), action="append")
+    parser.add_argument("--match", help="只跑名稱包含此字串的項目")
+    parser.add_argument("--min-time", type=float, default=0.2)
+    parser.add_argument("--baseline", help="與此基準 JSON 比較，退步時 exit 1")
+    parser.add_argument("--save-baseline", help="把本次結果寫成基準 JSON")
+    parser.add_argument("--ops-tolerance", type=float, default=0.3, help="每秒次數允許下降比例")
+    parser.add_argument("--alloc-tolerance", type=float, default=0.2, help="記憶體峰值允許增加比例")
+    args = parser.parse_args(argv)
+
+    groups = args.group or list(GROUPS)
+    results = run(groups, args.min_time, args.match)
+    if "bingo" in groups and not check_bingo_history_size():
+        return 1
+
+    if args.save_baseline:
+        data = {
+            "created_at": datetime.now(app.TZ_TW).isoformat(),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "results": results,
+        }
+        with open(args.save_baseline, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+        print(f"BENCH BASELINE WROTE: {args.save_baseline}")
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.ops_tolerance, args.alloc_tolerance)
+        for line in regressions:
+            print("BENCH REGRESSION:", line)
+        if regressions:
+            return 1
+        print(f"BENCH OK: {len(results)} cases within tolerance of {args.baseline}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
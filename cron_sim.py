@@ -0,0 +1,174 @@
+"""
+Cron 推播吞吐量模擬
+
+在專用的本機資料庫建立 N 位會員（同時訂閱每日推播與預測分析），
+對 loadtest.py 的 LINE API 替身執行每日推播 / Bingo 即時推播，
+替身可加延遲與隨機 429 / 5xx，回報總耗時、每秒訊息數與重試次數。
+依序跑多個會員數，觀察推播時間隨人數成長的情形。
+
+注意：每個規模開始前會清空 members / 到期預算 / 訂閱 / push_state 資料表，請勿指向正式資料庫。
+
+用法：
+    python cron_sim.py --database-url postgresql://localhost/linebot_sim --truncate
+    python cron_sim.py --database-url ... --truncate --members 100,1000,10000,100000 --line-latency-ms 40
+    python cron_sim.py --database-url ... --truncate --throttle-rate 0.02 --error-rate 0.01 --jobs daily
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from datetime import datetime
+
+import loadtest
+
+# 週一晚上 / 中午：每日推播會送 539 + Bingo，Bingo 即時推播落在開獎時段內
+DAILY_AT = (2026, 6, 1, 21, 0)
+BINGO_AT = (2026, 6, 1, 12, 0)
+JOBS = ("daily", "bingo")
+
+
+def reset_tables(app):
+    conn = app.get_conn()
+    cur = conn.cursor()
+    cur.execute("""
+        TRUNCATE members, members_expiring_on, push_audience, daily_push_subscribers, prediction_subscribers,
+            push_state, push_progress;
+    """)
+    conn.commit()
+    cur.close()
+    conn.close()
+
+
+def retry_count(app):
+    with app.METRICS.lock:
+        return sum(v for (name, _), v in app.METRICS.counters.items() if name == "line_push_retries_total")
+
+
+def run_job(app, job):
+    if job == "daily":
+        return app.run_daily_push(now=datetime(*DAILY_AT, tzinfo=app.TZ_TW))
+    return app.run_check_bingo(now=datetime(*BINGO_AT, tzinfo=app.TZ_TW))
+
+
+def simulate(app, line, members, jobs):
+    """回傳每個 job 在此會員數下的結果。"""
+    reset_tables(app)
+    seed_started = time.monotonic()
+    loadtest.seed_members(app, members, prefix="Usim")
+    seed_elapsed = time.monotonic() - seed_started
+
+    rows = []
+    for job in jobs:
+        line.reset()
+        retries_before = retry_count(app)
+        started = time.monotonic()
+        body, status = run_job(app, job)
+        elapsed = time.monotonic() - started
+
+        summary = line.summary()
+        push_calls = summary["calls"].get("push", {})
+        delivered = summary["delivered"].get("push", 0)
+        retries = retry_count(app) - retries_before
+        # 每次重試對應一個失敗的請求，其餘失敗請求就是最後仍沒送出的訊息
+        failed_calls = sum(c for s, c in push_calls.items() if s not in ("200", "409"))
+        rows.append({
+            "job": job,
+            "members": members,
+            "status": status,
+            "result": str(body)[:80],
+            "seed_seconds": round(seed_elapsed, 3),
+            "seconds": round(elapsed, 3),
+            "delivered": delivered,
+            "messages_per_sec": round(delivered / elapsed, 1) if elapsed else 0.0,
+            "push_calls": push_calls,
+            "retries": retries,
+            "failed": max(0, failed_calls - retries),
+        })
+    return rows
+
+
+def format_rows(rows):
+    lines = [
+        f"{'job':<6} {'members':>8} {'seconds':>9} {'delivered':>10} {'msg/s':>9} {'retries':>8} {'failed':>7}  push calls"
+    ]
+    for r in rows:
+        calls = " ".join(f"{k}:{v}" for k, v in sorted(r["push_calls"].items()))
+        lines.append(
+            f"{r['job']:<6} {r['members']:>8,} {r['seconds']:>9.2f} {r['delivered']:>10,} "
+            f"{r['messages_per_sec']:>9,.1f} {r['retries']:>8,} {r['failed']:>7,}  {calls}"
+        )
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Cron 推播吞吐量模擬")
+    parser.add_argument("--database-url", default=os.getenv("LOADTEST_DATABASE_URL", ""), help="專用的本機 Postgres")
+    parser.add_argument("--sslmode", default="disable")
+    parser.add_argument("--truncate", action="store_true", help="確認可以清空會員 / 訂閱 / push_state 資料表")
+    parser.add_argument("--members", default="100,1000,10000", help="逗號分隔的會員數")
+    parser.add_argument("--jobs", default=",".join(JOBS), help="daily,bingo")
+    parser.add_argument("--line-latency-ms", type=float, default=20.0)
+    parser.add_argument("--line-jitter-ms", type=float, default=10.0)
+    parser.add_argument("--line-rate", type=float, default=0.0, help="LINE 替身每秒請求上限（0 為不限）")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="隨機回 429 的比例")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="隨機回 500 的比例")
+    parser.add_argument("--retry-base-seconds", type=float, default=0.1, help="push 重試退避基準秒數")
+    parser.add_argument("--max-retries", type=int, default=2)
+    parser.add_argument(
+        "--run-seconds", type=float, default=3600.0,
+        help="每次 cron 推播的時間預算（正式環境預設 90 秒，模擬時放寬以量測完整吞吐量）"
+    )
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="結果 JSON 輸出路徑")
+    args = parser.parse_args(argv)
+
+    if not args.database_url:
+        parser.error("需要 --database-url 或 LOADTEST_DATABASE_URL")
+    if not args.truncate:
+        parser.error("模擬會清空會員與推播狀態資料表，請指定專用資料庫並加上 --truncate")
+
+    jobs = [j.strip() for j in args.jobs.split(",") if j.strip() in JOBS]
+    sizes = [int(x) for x in args.members.split(",") if x.strip()]
+
+    line = loadtest.FakeLineAPI(
+        latency_ms=args.line_latency_ms,
+        jitter_ms=args.line_jitter_ms,
+        rate_limit=args.line_rate,
+        throttle_rate=args.throttle_rate,
+        error_rate=args.error_rate,
+        seed=args.seed,
+        pages={loadtest.FAKE_539_PATH: loadtest.synthetic_539_page()},
+    ).start()
+    app = loadtest.load_app(
+        args.database_url, line.base_url, sslmode=args.sslmode,
+        extra_env={
+            "PUSH_MAX_RETRIES": str(args.max_retries),
+            "PUSH_RETRY_BASE_SECONDS": str(args.retry_base_seconds),
+            "PUSH_RUN_SECONDS": str(args.run_seconds),
+        }
+    )
+
+    app.init_db()
+    app.ingest_bingo_draws()
+    # 訊息內容先建好，量測只看推播本身
+    app.format_539_push()
+    app.format_bingo_evening_push()
+
+    rows = []
+    for members in sizes:
+        result = simulate(app, line, members, jobs)
+        lines = format_rows(result).split("\n")
+        print("\n".join(lines if not rows else lines[1:]), flush=True)
+        rows.extend(result)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(rows, f, ensure_ascii=False, indent=2)
+
+    line.stop()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
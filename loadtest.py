@@ -0,0 +1,543 @@
+"""
+端到端壓測
+
+在本機起一個 LINE Messaging API 替身（reply / push / multicast，可加延遲、限流與 5xx），
+把 app 指向本機 Postgres 與替身，依 LINE 簽章規則送出 webhook，
+回報吞吐量、p50/p95/p99 延遲、LINE 呼叫統計與資料庫連線數。
+
+539 開獎來源由替身提供固定種子的列表頁，Bingo 使用 fixtures/ 的開獎頁，全程不連外網。
+
+用法：
+    python loadtest.py --database-url postgresql://localhost/linebot_load --requests 2000 --concurrency 16
+    python loadtest.py --database-url ... --duration 60 --line-latency-ms 80 --line-rate 500
+    python loadtest.py --database-url ... --mix "今日陪跑=50,1期=30,均衡 3000=20"
+    python loadtest.py --target http://127.0.0.1:10000 ...   # 打已啟動的 gunicorn（需以下方環境變數啟動）
+"""
+import argparse
+import base64
+import hashlib
+import hmac
+import itertools
+import json
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+BINGO_FIXTURE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "bingo_results_sample.html")
+FAKE_539_PATH = "/lto539/list539BIG.asp"
+LOAD_SECRET = "loadtest-channel-secret"
+LOAD_TOKEN = "loadtest-access-token"
+
+# 實際使用比例的粗估：今日陪跑與 Bingo 分析為主，點數配置次之
+DEFAULT_MIX = (
+    ("今日陪跑", 30),
+    ("1期", 12),
+    ("5期", 10),
+    ("10期", 8),
+    ("賓果分析", 5),
+    ("點數配置", 5),
+    ("均衡 3000", 10),
+    ("穩健 1000", 5),
+    ("我的到期日", 5),
+    ("指令", 5),
+    ("你好", 5),
+)
+
+
+# =========================
+# LINE API 替身
+# =========================
+class _FakeHTTPServer(ThreadingHTTPServer):
+    # 預設 backlog 只有 5，並行推播時會被 reset
+    request_queue_size = 1024
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # keep-alive 連線被 client 關掉屬正常情況
+        if not isinstance(sys.exc_info()[1], (ConnectionResetError, BrokenPipeError)):
+            super().handle_error(request, client_address)
+
+
+class FakeLineAPI:
+    """
+    本機 LINE API 替身。
+    - latency_ms / jitter_ms：每個請求的處理延遲
+    - rate_limit：每秒請求上限（token bucket），超過回 429
+    - throttle_rate / error_rate：隨機回 429 / 500 的比例
+    - X-Line-Retry-Key 已成功收過的請求回 409（與 LINE 相同），並計入重試次數
+    pages 為 GET 路徑 → HTML，用來替代外部資料來源。
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, latency_ms=0.0, jitter_ms=0.0,
+                 rate_limit=0.0, throttle_rate=0.0, error_rate=0.0, seed=0, pages=None):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.rate_limit = rate_limit
+        self.throttle_rate = throttle_rate
+        self.error_rate = error_rate
+        self.pages = pages or {}
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.tokens = rate_limit
+        self.refilled = time.monotonic()
+        self.reset()
+
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _send(self, status, body, content_type="application/json"):
+                data = body.encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                page = api.pages.get(self.path.split("?", 1)[0])
+                if page is None:
+                    self._send(404, "{}")
+                else:
+                    self._send(200, page, "text/html; charset=utf-8")
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                raw = self.rfile.read(length) if length else b""
+                if not self.path.startswith("/v2/bot/message/"):
+                    self._send(404, "{}")
+                    return
+                endpoint = self.path.rsplit("/", 1)[-1]
+                try:
+                    payload = json.loads(raw or b"{}")
+                except ValueError:
+                    self._send(400, '{"message":"invalid json"}')
+                    return
+                status = api.handle(endpoint, payload, self.headers.get("X-Line-Retry-Key"))
+                body = "{}" if status == 200 else json.dumps({"message": f"fake status {status}"})
+                self._send(status, body)
+
+        self.server = _FakeHTTPServer((host, port), Handler)
+        self.thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def reset(self):
+        with self.lock:
+            self.calls = Counter()
+            self.delivered = Counter()
+            self.recipients = set()
+            self.retry_keys = set()
+            self.accepted_keys = set()
+            self.retries = 0
+
+    def _take_token(self):
+        if self.rate_limit <= 0:
+            return True
+        now = time.monotonic()
+        self.tokens = min(self.rate_limit, self.tokens + (now - self.refilled) * self.rate_limit)
+        self.refilled = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def handle(self, endpoint, payload, retry_key=None):
+        with self.lock:
+            delay = self.latency_ms + (self.rng.uniform(0, self.jitter_ms) if self.jitter_ms else 0.0)
+            if retry_key:
+                if retry_key in self.retry_keys:
+                    self.retries += 1
+                self.retry_keys.add(retry_key)
+            if retry_key and retry_key in self.accepted_keys:
+                status = 409
+            elif not self._take_token():
+                status = 429
+            elif self.throttle_rate and self.rng.random() < self.throttle_rate:
+                status = 429
+            elif self.error_rate and self.rng.random() < self.error_rate:
+                status = 500
+            else:
+                status = 200
+        if delay:
+            time.sleep(delay / 1000)
+
+        to = payload.get("to")
+        targets = to if isinstance(to, list) else ([to] if to else [])
+        with self.lock:
+            self.calls[(endpoint, status)] += 1
+            if status == 200:
+                self.delivered[endpoint] += max(1, len(targets))
+                self.recipients.update(targets)
+                if retry_key:
+                    self.accepted_keys.add(retry_key)
+        return status
+
+    def summary(self):
+        with self.lock:
+            by_endpoint = {}
+            for (endpoint, status), count in sorted(self.calls.items()):
+                by_endpoint.setdefault(endpoint, {})[str(status)] = count
+            return {
+                "calls": by_endpoint,
+                "delivered": dict(self.delivered),
+                "unique_recipients": len(self.recipients),
+                "retried_requests": self.retries,
+            }
+
+
+def synthetic_539_page(count=300, seed="loadtest-539", last=None):
+    """pilio 列表頁格式的固定種子開獎（由新到舊），給 SOURCE_539_URL 使用。"""
+    rng = random.Random(seed)
+    last = last or date.today()
+    lines = ["<html><body>"]
+    for i in range(count):
+        d = last - timedelta(days=i)
+        nums = sorted(rng.sample(range(1, 40), 5))
+        lines.append(f"開獎日期:{d:%Y/%m/%d} {', '.join(f'{n:02d}' for n in nums)}<br>")
+    lines.append("</body></html>")
+    return "\n".join(lines)
+
+
+# =========================
+# app 設定與資料準備
+# =========================
+def load_app(database_url, line_api_base, sslmode="disable", extra_env=None):
+    """
+    設定環境變數後才 import app（app 在 import 時讀取設定）。
+    回傳 app 模組。
+    """
+    env = {
+        "DATABASE_URL": database_url,
+        "DATABASE_SSLMODE": sslmode,
+        "LINE_API_BASE": line_api_base,
+        "SOURCE_539_URL": line_api_base + FAKE_539_PATH,
+        "BINGO_SOURCE_FILE": BINGO_FIXTURE,
+        "CHANNEL_SECRET": LOAD_SECRET,
+        "CHANNEL_ACCESS_TOKEN": LOAD_TOKEN,
+    }
+    env.update(extra_env or {})
+    os.environ.update(env)
+
+    import app
+    return app
+
+
+def seed_members(app, count, prefix="Uload", days=30, daily_push=True, prediction=True, page_size=5000):
+    """建立 count 個有效會員（可同時訂閱每日推播 / 預測分析），回傳 user_id 列表。"""
+    from psycopg2.extras import execute_values
+
+    user_ids = [f"{prefix}{i:08d}" for i in range(count)]
+    conn = app.get_conn()
+    cur = conn.cursor()
+    execute_values(cur, """
+        INSERT INTO members (user_id, expires_at, is_active)
+        VALUES %s
+        ON CONFLICT (user_id) DO UPDATE SET expires_at = EXCLUDED.expires_at, is_active = TRUE;
+    """, [(u,) for u in user_ids], template=f"(%s, NOW() + INTERVAL '{int(days)} days', TRUE)", page_size=page_size)
+    if daily_push:
+        execute_values(cur, """
+            INSERT INTO daily_push_subscribers (user_id, enabled, updated_at)
+            VALUES %s
+            ON CONFLICT (user_id) DO UPDATE SET enabled = TRUE;
+        """, [(u,) for u in user_ids], template="(%s, TRUE, NOW())", page_size=page_size)
+    if prediction:
+        execute_values(cur, """
+            INSERT INTO prediction_subscribers (user_id, enabled, updated_at)
+            VALUES %s
+            ON CONFLICT (user_id) DO UPDATE SET enabled = TRUE;
+        """, [(u,) for u in user_ids], template="(%s, TRUE, NOW())", page_size=page_size)
+    conn.commit()
+    cur.close()
+    conn.close()
+    # 直接寫入資料表，不經過 app 的 helper，推播對象需要整張重建
+    app.rebuild_push_audience()
+    return user_ids
+
+
+def start_app_server(app, host="127.0.0.1", port=0):
+    """以多執行緒的 werkzeug server 在背景跑 Flask app，回傳 (server, base_url)。"""
+    from werkzeug.serving import make_server
+
+    server = make_server(host, port, app.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_port}"
+
+
+class ConnectionSampler:
+    """定期查 pg_stat_activity，記錄本資料庫的連線數（不含自己）。"""
+
+    def __init__(self, app, interval=0.25):
+        self.app = app
+        self.interval = interval
+        self.samples = []
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def _run(self):
+        conn = self.app.get_conn()
+        conn.autocommit = True
+        cur = conn.cursor()
+        try:
+            while not self.stopped.is_set():
+                cur.execute("""
+                    SELECT COUNT(*), COUNT(*) FILTER (WHERE state = 'active')
+                    FROM pg_stat_activity
+                    WHERE datname = current_database() AND pid <> pg_backend_pid();
+                """)
+                self.samples.append(cur.fetchone())
+                self.stopped.wait(self.interval)
+        finally:
+            cur.close()
+            conn.close()
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread:
+            self.thread.join(timeout=5)
+        if not self.samples:
+            return {"samples": 0}
+        totals = [t for t, _ in self.samples]
+        actives = [a for _, a in self.samples]
+        return {
+            "samples": len(self.samples),
+            "max": max(totals),
+            "avg": round(sum(totals) / len(totals), 1),
+            "max_active": max(actives),
+        }
+
+
+# =========================
+# Webhook 產生與送出
+# =========================
+def sign_body(secret, body):
+    """與 verify_line_signature 相同：base64(HMAC-SHA256(channel secret, body))。"""
+    mac = hmac.new(secret.encode("utf-8"), body, hashlib.sha256).digest()
+    return base64.b64encode(mac).decode("utf-8")
+
+
+def text_event(user_id, text):
+    now_ms = int(time.time() * 1000)
+    return {
+        "type": "message",
+        "mode": "active",
+        "timestamp": now_ms,
+        "webhookEventId": uuid.uuid4().hex.upper()[:26],
+        "deliveryContext": {"isRedelivery": False},
+        "replyToken": uuid.uuid4().hex,
+        "source": {"type": "user", "userId": user_id},
+        "message": {"id": str(now_ms), "type": "text", "quoteToken": uuid.uuid4().hex, "text": text},
+    }
+
+
+def parse_mix(text):
+    mix = []
+    for part in text.split(","):
+        if not part.strip():
+            continue
+        cmd, _, weight = part.rpartition("=")
+        mix.append((cmd.strip(), float(weight)))
+    return tuple(mix)
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    k = max(0, min(len(sorted_values) - 1, int(round(p / 100 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[k]
+
+
+def run_load(target, user_ids, mix, concurrency, total=None, duration=None, secret=LOAD_SECRET, seed=0):
+    """
+    以 concurrency 個執行緒送 webhook，直到送滿 total 筆或超過 duration 秒。
+    回傳 [(指令, 狀態碼, 秒數), ...]。
+    """
+    commands = [c for c, _ in mix]
+    weights = [w for _, w in mix]
+    counter = itertools.count()
+    deadline = time.monotonic() + duration if duration else None
+    results = []
+    lock = threading.Lock()
+
+    def worker(worker_id):
+        rng = random.Random(f"{seed}-{worker_id}")
+        session = requests.Session()
+        local = []
+        while True:
+            i = next(counter)
+            if total is not None and i >= total:
+                break
+            if deadline is not None and time.monotonic() >= deadline:
+                break
+            text = rng.choices(commands, weights)[0]
+            user_id = rng.choice(user_ids)
+            body = json.dumps(
+                {"destination": "Uloadtestbot", "events": [text_event(user_id, text)]},
+                ensure_ascii=False
+            ).encode("utf-8")
+            headers = {"Content-Type": "application/json", "X-Line-Signature": sign_body(secret, body)}
+            started = time.perf_counter()
+            try:
+                status = session.post(f"{target}/webhook", data=body, headers=headers, timeout=30).status_code
+            except requests.RequestException:
+                status = 0
+            local.append((text, status, time.perf_counter() - started))
+        with lock:
+            results.extend(local)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for w in range(concurrency):
+            pool.submit(worker, w)
+    return results
+
+
+def summarize(results, elapsed):
+    latencies = sorted(r[2] for r in results)
+    by_command = {}
+    for cmd, _, sec in results:
+        by_command.setdefault(cmd, []).append(sec)
+    return {
+        "requests": len(results),
+        "elapsed": round(elapsed, 3),
+        "throughput": round(len(results) / elapsed, 1) if elapsed else 0.0,
+        "status": dict(Counter(str(r[1]) for r in results)),
+        "latency_ms": {
+            f"p{p}": round(percentile(latencies, p) * 1000, 1) for p in (50, 95, 99)
+        } | {"max": round(latencies[-1] * 1000, 1) if latencies else 0.0},
+        "by_command_p95_ms": {
+            cmd: round(percentile(sorted(v), 95) * 1000, 1) for cmd, v in sorted(by_command.items())
+        },
+    }
+
+
+def format_report(report):
+    s = report["webhook"]
+    lines = [
+        f"LOADTEST: {s['requests']:,} webhooks in {s['elapsed']:.2f}s = {s['throughput']:,.1f} req/s",
+        "  latency ms: " + " ".join(f"{k}={v}" for k, v in s["latency_ms"].items()),
+        "  status: " + " ".join(f"{k}:{v}" for k, v in sorted(s["status"].items())),
+    ]
+    for cmd, p95 in s["by_command_p95_ms"].items():
+        lines.append(f"  {cmd:<12} p95={p95}ms")
+    line = report["line_api"]
+    for endpoint, statuses in line["calls"].items():
+        lines.append(f"  line {endpoint:<10} " + " ".join(f"{k}:{v}" for k, v in statuses.items()))
+    db = report["db_connections"]
+    if db.get("samples"):
+        lines.append(f"  db connections: max={db['max']} avg={db['avg']} max_active={db['max_active']}")
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="端到端 webhook 壓測")
+    parser.add_argument("--database-url", default=os.getenv("LOADTEST_DATABASE_URL", ""), help="本機 Postgres")
+    parser.add_argument("--sslmode", default="disable")
+    parser.add_argument("--target", help="已啟動的 app 位址（未指定則在本 process 內啟動）")
+    parser.add_argument("--requests", type=int, default=1000, help="總 webhook 數")
+    parser.add_argument("--duration", type=float, help="改以秒數為準")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--warmup", type=int, default=20, help="不計入結果的暖機請求數")
+    parser.add_argument("--members", type=int, default=500, help="預先建立的會員數")
+    parser.add_argument("--mix", help='指令比例，例如 "今日陪跑=50,1期=30"')
+    parser.add_argument("--line-port", type=int, default=0)
+    parser.add_argument("--line-latency-ms", type=float, default=30.0)
+    parser.add_argument("--line-jitter-ms", type=float, default=20.0)
+    parser.add_argument("--line-rate", type=float, default=0.0, help="LINE 替身每秒請求上限（0 為不限）")
+    parser.add_argument("--line-error-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="結果 JSON 輸出路徑")
+    args = parser.parse_args(argv)
+
+    if not args.database_url:
+        parser.error("需要 --database-url 或 LOADTEST_DATABASE_URL")
+
+    line = FakeLineAPI(
+        port=args.line_port,
+        latency_ms=args.line_latency_ms,
+        jitter_ms=args.line_jitter_ms,
+        rate_limit=args.line_rate,
+        error_rate=args.line_error_rate,
+        seed=args.seed,
+        pages={FAKE_539_PATH: synthetic_539_page()},
+    ).start()
+    app = load_app(args.database_url, line.base_url, sslmode=args.sslmode)
+
+    print("LOADTEST ENV:")
+    for k in ("LINE_API_BASE", "SOURCE_539_URL", "BINGO_SOURCE_FILE", "DATABASE_SSLMODE",
+              "CHANNEL_SECRET", "CHANNEL_ACCESS_TOKEN"):
+        print(f"  {k}={os.environ[k]}")
+
+    app.init_db()
+    user_ids = seed_members(app, args.members)
+    app.ingest_bingo_draws()
+
+    server = None
+    target = args.target
+    if not target:
+        server, target = start_app_server(app)
+
+    mix = parse_mix(args.mix) if args.mix else DEFAULT_MIX
+    if args.warmup:
+        run_load(target, user_ids, mix, min(args.concurrency, 4), total=args.warmup, seed=args.seed)
+    line.reset()
+
+    sampler = ConnectionSampler(app).start()
+    started = time.monotonic()
+    results = run_load(
+        target, user_ids, mix, args.concurrency,
+        total=None if args.duration else args.requests,
+        duration=args.duration,
+        seed=args.seed
+    )
+    elapsed = time.monotonic() - started
+
+    report = {
+        "concurrency": args.concurrency,
+        "webhook": summarize(results, elapsed),
+        "line_api": line.summary(),
+        "db_connections": sampler.stop(),
+    }
+    print(format_report(report))
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+    if server is not None:
+        server.shutdown()
+    line.stop()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,90 @@
+"""
+推播 outbox sender
+
+從 push_outbox 以 FOR UPDATE SKIP LOCKED 認領一批推播送出，送完再認領下一批；
+佇列空時每 --idle-seconds 秒檢查一次。可同時跑多個 sender（不同機器或 process），
+同一列只會被一個 sender 認領；sender 中途結束時，租約（OUTBOX_LEASE_SECONDS）過後由其他 sender 接手。
+
+cron 需以 PUSH_OUTBOX_ENABLED=1 啟動才會把推播排入 outbox。
+每批內以 aiohttp（未安裝時為執行緒池）並行送出，同時在途數為 PUSH_CONCURRENCY。
+
+用法：
+    python sender.py                      # 持續執行
+    python sender.py --once               # 送完目前佇列後結束
+    python sender.py --batch-size 1000 --idle-seconds 5
+"""
+import argparse
+import logging
+import signal
+import sys
+import time
+
+import app
+
+_STOP = {"requested": False}
+
+
+def _request_stop(signum, frame):
+    # 送完手上這批再結束
+    _STOP["requested"] = True
+
+
+def run(batch_size, idle_seconds, once=False, purge_every=3600):
+    """回傳累計的 {claimed, sent, retry, failed}。"""
+    totals = {"claimed": 0, "sent": 0, "retry": 0, "failed": 0}
+    last_purge = 0.0
+
+    while not _STOP["requested"]:
+        if time.monotonic() - last_purge >= purge_every:
+            try:
+                app.purge_outbox()
+            except Exception as e:
+                app.log_event(logging.ERROR, "outbox_purge_error", error=repr(e))
+            last_purge = time.monotonic()
+
+        started = time.monotonic()
+        try:
+            stats = app.send_outbox_batch(batch_size)
+        except Exception as e:
+            app.log_event(logging.ERROR, "outbox_send_error", error=repr(e))
+            time.sleep(idle_seconds)
+            continue
+
+        for k in totals:
+            totals[k] += stats[k]
+        if stats["claimed"]:
+            app.log_event(
+                logging.INFO, "outbox_batch",
+                seconds=round(time.monotonic() - started, 3), **stats
+            )
+            continue
+
+        if once:
+            break
+        time.sleep(idle_seconds)
+
+    app.flush_deliveries()
+    return totals
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="推播 outbox sender")
+    parser.add_argument("--batch-size", type=int, default=app.OUTBOX_BATCH_SIZE)
+    parser.add_argument("--idle-seconds", type=float, default=2.0, help="佇列空時的等待秒數")
+    parser.add_argument("--once", action="store_true", help="佇列送完即結束")
+    args = parser.parse_args(argv)
+
+    signal.signal(signal.SIGTERM, _request_stop)
+    signal.signal(signal.SIGINT, _request_stop)
+
+    app.init_db()
+    totals = run(args.batch_size, args.idle_seconds, once=args.once)
+    print(
+        f"SENDER DONE: claimed={totals['claimed']:,} sent={totals['sent']:,} "
+        f"retry={totals['retry']:,} failed={totals['failed']:,}"
+    )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,258 @@
+"""
+539 母盤引擎權重調校
+
+對 build_motherboard_models_539 的混合權重與遺漏值分段做 grid / random search，
+以回測指標評分，最佳結果寫成有版本號的 engine_config_539.json，
+app 啟動時會自動載入。
+
+每一期的特徵（正規化頻率/頭數/尾數/鄰號 + 原始遺漏值）只計算一次並快取，
+每個候選參數只需要做遺漏值分段查表與加權內積。
+
+評分指標：以混合分數（不含亂數擾動）排名前 N 碼（預設 9，對應母盤）
+對照實際開獎的平均命中數。
+
+用法：
+    python tune_539.py --mode random --candidates 5000
+    python tune_539.py --csv draws.csv --mode grid --grid 0,0.1,0.2,0.3
+    python tune_539.py --cache features.pkl --dry-run
+"""
+import argparse
+import json
+import os
+import pickle
+import random
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from itertools import product
+
+import app
+import backtest_539
+
+STATIC_FEATURES = [k for k in app.FEATURES_539 if k != "gap"]
+
+_CACHE = None
+
+
+def build_feature_cache(history, min_history=30):
+    """
+    逐期滾動，回傳每期的 (靜態特徵矩陣 39×6, 遺漏值 39, 實際開獎 set)。
+    矩陣列依號碼 1..39，欄依 STATIC_FEATURES。
+    """
+    windows = app.DrawWindows539()
+    cache = []
+    for i, (d, nums) in enumerate(history):
+        if i >= min_history:
+            feats = app.motherboard_features_539(None, windows=windows)
+            norm = feats["norm"]
+            matrix = [tuple(norm[k][n] for k in STATIC_FEATURES) for n in range(1, 40)]
+            gaps = [feats["gap_raw"][n] for n in range(1, 40)]
+            cache.append((matrix, gaps, frozenset(nums)))
+        windows.push(d, nums)
+    return cache
+
+
+def load_feature_cache(history, path=None, min_history=30):
+    """依歷史範圍做磁碟快取，同一份歷史重複調校不必重算特徵。"""
+    key = (len(history), history[0][0] if history else None, history[-1][0] if history else None, min_history)
+    if path and os.path.exists(path):
+        with open(path, "rb") as f:
+            saved = pickle.load(f)
+        if saved.get("key") == key:
+            return saved["cache"]
+
+    cache = build_feature_cache(history, min_history=min_history)
+    if path:
+        with open(path, "wb") as f:
+            pickle.dump({"key": key, "cache": cache}, f, protocol=pickle.HIGHEST_PROTOCOL)
+    return cache
+
+
+def _init_worker(cache):
+    global _CACHE
+    _CACHE = cache
+
+
+def _gap_lookup(buckets, max_gap):
+    """把分段設定展開成 gap → 分數的查表。"""
+    table = []
+    for g in range(max_gap + 1):
+        for limit, value in buckets:
+            if limit is None or g <= limit:
+                table.append(value)
+                break
+    return table
+
+
+def evaluate(candidate, cache=None, top_n=9):
+    """回傳候選參數在整段歷史的平均命中數。"""
+    cache = cache if cache is not None else _CACHE
+    if not cache:
+        return 0.0
+
+    weights = candidate["weights"]
+    static_w = [weights[k] for k in STATIC_FEATURES]
+    gap_w = weights["gap"]
+    max_gap = max(max(gaps) for _, gaps, _ in cache)
+    table = _gap_lookup(candidate["gap_buckets"], max_gap)
+
+    total_hits = 0
+    for matrix, gaps, actual in cache:
+        gap_vals = [table[g] for g in gaps]
+        mn, mx = min(gap_vals), max(gap_vals)
+        if mx == mn:
+            ngap = [0.5] * 39
+        else:
+            span = mx - mn
+            ngap = [(v - mn) / span for v in gap_vals]
+
+        scores = []
+        for idx in range(39):
+            row = matrix[idx]
+            s = gap_w * ngap[idx]
+            for w, v in zip(static_w, row):
+                s += w * v
+            scores.append((s, idx + 1))
+        scores.sort(reverse=True)
+        total_hits += sum(1 for _, n in scores[:top_n] if n in actual)
+
+    return total_hits / len(cache)
+
+
+def _evaluate_batch(args):
+    candidates, top_n = args
+    return [evaluate(c, top_n=top_n) for c in candidates]
+
+
+def _normalize_weights(weights):
+    total = sum(weights.values())
+    if total <= 0:
+        return None
+    return {k: round(v / total, 4) for k, v in weights.items()}
+
+
+def grid_candidates(steps, base_buckets):
+    for combo in product(steps, repeat=len(app.FEATURES_539)):
+        weights = _normalize_weights(dict(zip(app.FEATURES_539, combo)))
+        if weights:
+            yield {"weights": weights, "gap_buckets": base_buckets}
+
+
+def random_candidates(count, base, seed):
+    rng = random.Random(seed)
+    for _ in range(count):
+        weights = _normalize_weights({k: rng.expovariate(1.0) for k in app.FEATURES_539})
+
+        buckets = []
+        prev = 0
+        for limit, value in base["gap_buckets"]:
+            if limit is not None:
+                limit = max(prev + 1, limit + rng.randint(-2, 2))
+                prev = limit
+            buckets.append([limit, round(min(1.0, max(0.0, value + rng.uniform(-0.25, 0.25))), 2)])
+
+        yield {"weights": weights, "gap_buckets": buckets}
+
+
+def search(candidates, cache, workers, top_n=9, batch_size=200):
+    """分批丟給 worker process 評分，回傳 (最佳分數, 最佳參數, 評估數)。"""
+    batches = []
+    batch = []
+    for c in candidates:
+        batch.append(c)
+        if len(batch) >= batch_size:
+            batches.append(batch)
+            batch = []
+    if batch:
+        batches.append(batch)
+
+    if workers <= 1:
+        _init_worker(cache)
+        results = [_evaluate_batch((b, top_n)) for b in batches]
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(cache,)) as pool:
+            results = list(pool.map(_evaluate_batch, [(b, top_n) for b in batches]))
+
+    best_score, best = -1.0, None
+    count = 0
+    for b, scores in zip(batches, results):
+        for c, s in zip(b, scores):
+            count += 1
+            if s > best_score:
+                best_score, best = s, c
+    return best_score, best, count
+
+
+def write_config(best, score, baseline, days, top_n, path):
+    current = app.load_engine_config_539(path)
+    data = {
+        "version": current["version"] + 1,
+        "created_at": datetime.now(app.TZ_TW).isoformat(),
+        "metric": f"avg_hits_top{top_n}",
+        "score": round(score, 5),
+        "baseline_score": round(baseline, 5),
+        "days": days,
+        "weights": best["weights"],
+        "gap_buckets": best["gap_buckets"],
+    }
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, path)
+    return data
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="539 母盤引擎權重調校")
+    parser.add_argument("--csv", help="歷史開獎檔（未指定則讀資料庫）")
+    parser.add_argument("--mode", choices=("grid", "random"), default="random")
+    parser.add_argument("--grid", default="0,0.1,0.2,0.3", help="grid 模式每個權重的候選值")
+    parser.add_argument("--candidates", type=int, default=2000, help="random 模式候選數")
+    parser.add_argument("--seed", type=int, default=539)
+    parser.add_argument("--top-n", type=int, default=9)
+    parser.add_argument("--min-history", type=int, default=30)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--cache", help="特徵快取檔（pickle）")
+    parser.add_argument("--output", default=app.ENGINE_CONFIG_539_PATH)
+    parser.add_argument("--dry-run", action="store_true", help="只輸出結果不寫設定檔")
+    args = parser.parse_args(argv)
+
+    started = time.monotonic()
+    history = backtest_539.load_history(args.csv)
+    cache = load_feature_cache(history, path=args.cache, min_history=args.min_history)
+    print(f"TUNE_539 FEATURES: {len(cache):,} draws ({time.monotonic() - started:.2f}s)")
+    if not cache:
+        print("TUNE_539: 歷史資料不足")
+        return 1
+
+    base = app.ENGINE_CONFIG_539
+    baseline = evaluate(base, cache=cache, top_n=args.top_n)
+
+    if args.mode == "grid":
+        steps = [float(x) for x in args.grid.split(",")]
+        candidates = grid_candidates(steps, base["gap_buckets"])
+    else:
+        candidates = random_candidates(args.candidates, base, args.seed)
+
+    score, best, count = search(candidates, cache, args.workers, top_n=args.top_n)
+    elapsed = time.monotonic() - started
+    print(
+        f"TUNE_539 DONE: candidates={count:,} baseline={baseline:.4f} "
+        f"best={score:.4f} elapsed={elapsed:.2f}s"
+    )
+    print("TUNE_539 BEST:", json.dumps(best, ensure_ascii=False))
+
+    if args.dry_run or best is None:
+        return 0
+    if score <= baseline:
+        print("TUNE_539: 沒有優於目前設定的候選，不寫入設定檔")
+        return 0
+
+    data = write_config(best, score, baseline, len(cache), args.top_n, args.output)
+    print(f"TUNE_539 WROTE: {args.output} version={data['version']}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())